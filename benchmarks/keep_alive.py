@@ -0,0 +1,79 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import re
+import socket
+import sys
+import time
+
+class KeepAliveBenchmark:
+  """
+  コネクションを再利用した場合としない場合のスループットを比較するベンチマーク
+  事前に start.py でサーバを起動しておくこと
+  """
+  def __init__(self, host: str = "localhost", port: int = 8080, path: str = "/index.html"):
+    self.address = (host, port)
+    self.path = path
+
+  def run(self, count: int) -> None:
+    """
+    ベンチマークを実行し、結果を表示する
+    """
+    print(f"=== {self.path} へ {count} 回リクエストします ===")
+    close_rps = self.measure(self.without_reuse, count)
+    print(f"コネクションを毎回張り直す: {close_rps:.1f} req/sec")
+    keep_alive_rps = self.measure(self.with_reuse, count)
+    print(f"コネクションを再利用する:   {keep_alive_rps:.1f} req/sec")
+
+  def measure(self, func, count: int) -> float:
+    """
+    funcの実行にかかった時間から、1秒あたりのリクエスト数を求める
+    """
+    start = time.perf_counter()
+    func(count)
+    return count / (time.perf_counter() - start)
+
+  def without_reuse(self, count: int) -> None:
+    for _ in range(count):
+      with socket.create_connection(self.address) as client_socket:
+        client_socket.sendall(self.build_request(keep_alive=False))
+        self.read_response(client_socket, b"")
+
+  def with_reuse(self, count: int) -> None:
+    client_socket = socket.create_connection(self.address)
+    buffer = b""
+    try:
+      for i in range(count):
+        # サーバ側の上限に達したらコネクションを張り直す
+        if buffer is None:
+          client_socket.close()
+          client_socket = socket.create_connection(self.address)
+          buffer = b""
+        client_socket.sendall(self.build_request(keep_alive=True))
+        buffer = self.read_response(client_socket, buffer)
+    finally:
+      client_socket.close()
+
+  def build_request(self, keep_alive: bool) -> bytes:
+    connection = "keep-alive" if keep_alive else "close"
+    return f"GET {self.path} HTTP/1.1\r\nHost: localhost\r\nConnection: {connection}\r\n\r\n".encode()
+
+  def read_response(self, client_socket: socket.socket, buffer: bytes):
+    """
+    レスポンスを1件分読み込み、残りのbufferを返す
+    サーバがコネクションを閉じる場合はNoneを返す
+    """
+    while b"\r\n\r\n" not in buffer:
+      buffer += client_socket.recv(65536)
+    header_end = buffer.index(b"\r\n\r\n") + 4
+    header = buffer[:header_end]
+    content_length = int(re.search(rb"Content-Length: *(\d+)", header).group(1))
+    while len(buffer) < header_end + content_length:
+      buffer += client_socket.recv(65536)
+
+    if b"Connection: Close" in header:
+      return None
+    return buffer[header_end + content_length:]
+
+if __name__ == '__main__':
+  count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+  KeepAliveBenchmark().run(count)
@@ -0,0 +1,364 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import List, Optional, Tuple
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_DIR = os.path.join(ROOT_DIR, "benchmarks", "results")
+
+# シナリオ名と、送信するリクエスト
+SCENARIOS = {
+  "now": b"GET /now HTTP/1.1\r\nHost: localhost\r\n\r\n",
+  "user_profile": b"GET /user/1/profile HTTP/1.1\r\nHost: localhost\r\n\r\n",
+  "login_post": (
+    b"POST /login HTTP/1.1\r\n"
+    b"Host: localhost\r\n"
+    b"Content-Type: application/x-www-form-urlencoded\r\n"
+    b"Content-Length: 38\r\n"
+    b"\r\n"
+    b"username=hena&email=hena%40example.com"
+  ),
+  "static_html": b"GET /index.html HTTP/1.1\r\nHost: localhost\r\n\r\n",
+  "static_png": b"GET /logo.png HTTP/1.1\r\nHost: localhost\r\n\r\n",
+}
+
+# レスポンスを1件分読み込むための正規表現
+CONTENT_LENGTH_PATTERN = re.compile(rb"^Content-Length: *(\d+)", re.IGNORECASE | re.MULTILINE)
+STATUS_PATTERN = re.compile(rb"^HTTP/1\.[01] (\d{3})")
+
+
+class Connection:
+  """
+  keep-aliveでリクエストを繰り返し送信するクライアント
+  サーバがコネクションを閉じた場合は、次のリクエストの前に張り直す
+  """
+  def __init__(self, address: Tuple[str, int]):
+    self.address = address
+    self.socket: Optional[socket.socket] = None
+    self.buffer = b""
+
+  def request(self, data: bytes) -> int:
+    """
+    リクエストを1件送信してレスポンスを読み込み、ステータスコードを返す
+    """
+    if self.socket is None:
+      self.socket = socket.create_connection(self.address)
+      self.buffer = b""
+    self.socket.sendall(data)
+
+    while b"\r\n\r\n" not in self.buffer:
+      self.buffer += self.receive()
+    header_end = self.buffer.index(b"\r\n\r\n") + 4
+    header = self.buffer[:header_end]
+    match = CONTENT_LENGTH_PATTERN.search(header)
+    content_length = int(match.group(1)) if match else 0
+    while len(self.buffer) < header_end + content_length:
+      self.buffer += self.receive()
+    self.buffer = self.buffer[header_end + content_length:]
+
+    if b"Connection: Close" in header:
+      self.close()
+    return int(STATUS_PATTERN.match(header).group(1))
+
+  def receive(self) -> bytes:
+    chunk = self.socket.recv(65536)
+    if not chunk:
+      raise ConnectionError("サーバがレスポンスの途中でコネクションを閉じました")
+    return chunk
+
+  def close(self) -> None:
+    if self.socket is not None:
+      self.socket.close()
+      self.socket = None
+
+
+def run_client(address: Tuple[str, int], data: bytes, count: int) -> Tuple[List[float], int]:
+  """
+  1つのコネクションでcount件のリクエストを送信し、(レイテンシのリスト, エラー数)を返す
+  スレッドからもプロセスからも呼び出せるように、モジュールレベルの関数にしている
+  """
+  connection = Connection(address)
+  latencies = []
+  errors = 0
+  try:
+    for _ in range(count):
+      start = time.perf_counter()
+      try:
+        status = connection.request(data)
+      except OSError:
+        connection.close()
+        errors += 1
+        continue
+      latencies.append(time.perf_counter() - start)
+      if status >= 400:
+        errors += 1
+  finally:
+    connection.close()
+  return latencies, errors
+
+
+async def run_async_client(address: Tuple[str, int], data: bytes, count: int) -> Tuple[List[float], int]:
+  """
+  run_clientのasyncio版
+  """
+  reader, writer = await asyncio.open_connection(*address)
+  latencies = []
+  errors = 0
+  try:
+    for _ in range(count):
+      start = time.perf_counter()
+      if writer.is_closing():
+        reader, writer = await asyncio.open_connection(*address)
+      try:
+        writer.write(data)
+        header = await reader.readuntil(b"\r\n\r\n")
+        match = CONTENT_LENGTH_PATTERN.search(header)
+        await reader.readexactly(int(match.group(1)) if match else 0)
+      except (OSError, asyncio.IncompleteReadError):
+        writer.close()
+        errors += 1
+        continue
+      latencies.append(time.perf_counter() - start)
+      if int(STATUS_PATTERN.match(header).group(1)) >= 400:
+        errors += 1
+      if b"Connection: Close" in header:
+        writer.close()
+  finally:
+    writer.close()
+  return latencies, errors
+
+
+def run_async_clients(address: Tuple[str, int], data: bytes, counts: List[int]) -> List[Tuple[List[float], int]]:
+  async def main():
+    return await asyncio.gather(*(run_async_client(address, data, count) for count in counts))
+  return asyncio.run(main())
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+  """
+  ソート済みのリストから、最近傍法でパーセンタイル値を求める
+  """
+  if not sorted_values:
+    return 0.0
+  index = max(0, min(len(sorted_values) - 1, round(p / 100 * len(sorted_values)) - 1))
+  return sorted_values[index]
+
+
+class LoadBenchmark:
+  """
+  サーバを起動し、複数のコネクションから並行してリクエストを送信するベンチマーク
+  シナリオごとのスループットとレイテンシのパーセンタイルをJSONに保存する
+  """
+  CLIENTS = ["thread", "asyncio", "process"]
+
+  def __init__(
+    self,
+    engine: str = "thread",
+    client: str = "thread",
+    concurrency: int = 16,
+    requests: int = 2000,
+    warmup: int = 100,
+    host: str = "localhost",
+    port: int = 8080,
+    start_server: bool = True,
+  ):
+    self.engine = engine
+    self.client = client
+    self.concurrency = concurrency
+    self.requests = requests
+    self.warmup = warmup
+    self.address = (host, port)
+    self.start_server = start_server
+    self.server_process: Optional[subprocess.Popen] = None
+
+  def run(self, scenarios: List[str]) -> dict:
+    """
+    全てのシナリオを実行し、結果を返す
+    """
+    if self.start_server:
+      self.launch_server()
+    try:
+      results = {}
+      for name in scenarios:
+        results[name] = self.run_scenario(name, SCENARIOS[name])
+        print(self.format_result(name, results[name]))
+    finally:
+      self.stop_server()
+
+    return {
+      "commit": self.git_commit(),
+      "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+      "python": platform.python_version(),
+      "platform": platform.platform(),
+      "cpu_count": os.cpu_count(),
+      "engine": self.engine,
+      "client": self.client,
+      "concurrency": self.concurrency,
+      "requests": self.requests,
+      "scenarios": results,
+    }
+
+  def run_scenario(self, name: str, data: bytes) -> dict:
+    # 各種キャッシュを温めてから計測する
+    run_client(self.address, data, self.warmup)
+
+    counts = [self.requests // self.concurrency] * self.concurrency
+    for i in range(self.requests % self.concurrency):
+      counts[i] += 1
+
+    start = time.perf_counter()
+    outcomes = self.dispatch(data, counts)
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for client_latencies, _ in outcomes for latency in client_latencies)
+    errors = sum(client_errors for _, client_errors in outcomes)
+    return {
+      "requests": len(latencies),
+      "errors": errors,
+      "elapsed": elapsed,
+      "throughput": len(latencies) / elapsed if elapsed else 0.0,
+      "latency": {
+        "mean": statistics.fmean(latencies) if latencies else 0.0,
+        "p50": percentile(latencies, 50),
+        "p95": percentile(latencies, 95),
+        "p99": percentile(latencies, 99),
+        "max": latencies[-1] if latencies else 0.0,
+      },
+    }
+
+  def dispatch(self, data: bytes, counts: List[int]) -> List[Tuple[List[float], int]]:
+    """
+    クライアントの種類に応じて、並行にリクエストを送信する
+    """
+    if self.client == "asyncio":
+      return run_async_clients(self.address, data, counts)
+
+    args = [(self.address, data, count) for count in counts]
+    if self.client == "process":
+      with multiprocessing.Pool(self.concurrency) as pool:
+        return pool.starmap(run_client, args)
+    with ThreadPoolExecutor(self.concurrency) as executor:
+      return list(executor.map(lambda arg: run_client(*arg), args))
+
+  def launch_server(self) -> None:
+    """
+    start.pyでサーバを起動し、接続できるようになるまで待つ
+    """
+    self.server_process = subprocess.Popen(
+      [sys.executable, "start.py", "--engine", self.engine],
+      cwd=ROOT_DIR,
+      stdout=subprocess.DEVNULL,
+      stderr=subprocess.DEVNULL,
+    )
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+      if self.server_process.poll() is not None:
+        raise RuntimeError("サーバの起動に失敗しました")
+      try:
+        socket.create_connection(self.address, timeout=1).close()
+        return
+      except OSError:
+        time.sleep(0.1)
+    self.stop_server()
+    raise RuntimeError("サーバに接続できませんでした")
+
+  def stop_server(self) -> None:
+    if self.server_process is None:
+      return
+    self.server_process.terminate()
+    try:
+      self.server_process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+      self.server_process.kill()
+    self.server_process = None
+
+  def git_commit(self) -> Optional[str]:
+    try:
+      return subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR, capture_output=True, text=True, check=True
+      ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+      return None
+
+  @staticmethod
+  def format_result(name: str, result: dict) -> str:
+    latency = result["latency"]
+    return (
+      f"{name:<14} {result['throughput']:9.1f} req/sec"
+      f"  p50 {latency['p50'] * 1000:7.2f}ms"
+      f"  p95 {latency['p95'] * 1000:7.2f}ms"
+      f"  p99 {latency['p99'] * 1000:7.2f}ms"
+      f"  errors {result['errors']}"
+    )
+
+
+def compare(baseline: dict, current: dict, threshold: float) -> bool:
+  """
+  2つの結果を比較して表示する
+  スループットかp99がthreshold以上悪化したシナリオがあればFalseを返す
+  """
+  ok = True
+  print(f"=== {baseline.get('commit')} -> {current.get('commit')} ===")
+  for name, result in current["scenarios"].items():
+    if name not in baseline["scenarios"]:
+      continue
+    before = baseline["scenarios"][name]
+    throughput_change = result["throughput"] / before["throughput"] - 1 if before["throughput"] else 0.0
+    p99_change = result["latency"]["p99"] / before["latency"]["p99"] - 1 if before["latency"]["p99"] else 0.0
+    regressed = throughput_change < -threshold or p99_change > threshold
+    ok = ok and not regressed
+    print(
+      f"{name:<14} throughput {throughput_change:+7.1%}  p99 {p99_change:+7.1%}"
+      + ("  <- 悪化" if regressed else "")
+    )
+  return ok
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="サーバを起動して負荷をかけ、結果をJSONに保存する")
+  parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+  parser.add_argument("--client", choices=LoadBenchmark.CLIENTS, default="thread")
+  parser.add_argument("--concurrency", type=int, default=16)
+  parser.add_argument("--requests", type=int, default=2000, help="シナリオごとのリクエスト数")
+  parser.add_argument("--warmup", type=int, default=100)
+  parser.add_argument("--scenario", action="append", choices=list(SCENARIOS), help="複数指定可（省略時は全て）")
+  parser.add_argument("--no-server", action="store_true", help="起動済みのサーバに対して計測する")
+  parser.add_argument("--output", help="結果を保存するファイル（省略時は benchmarks/results/<commit>.json）")
+  parser.add_argument("--compare", help="比較する過去の結果ファイル")
+  parser.add_argument("--threshold", type=float, default=0.1, help="悪化とみなす変化率")
+  args = parser.parse_args()
+
+  benchmark = LoadBenchmark(
+    engine=args.engine,
+    client=args.client,
+    concurrency=args.concurrency,
+    requests=args.requests,
+    warmup=args.warmup,
+    start_server=not args.no_server,
+  )
+  print(f"=== engine: {args.engine} / client: {args.client} / concurrency: {args.concurrency} ===")
+  result = benchmark.run(args.scenario or list(SCENARIOS))
+
+  output = args.output or os.path.join(RESULTS_DIR, f"{result['commit'] or 'result'}-{args.engine}.json")
+  os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+  with open(output, "w") as f:
+    json.dump(result, f, indent=2)
+  print(f"結果を {output} に保存しました")
+
+  if args.compare:
+    with open(args.compare) as f:
+      if not compare(json.load(f), result, args.threshold):
+        sys.exit(1)
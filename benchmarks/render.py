@@ -0,0 +1,54 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import settings
+from henango.template.engine import TemplateEngine
+
+class RenderBenchmark:
+  """
+  テンプレートのレンダリングにかかる時間を、
+  以前の方式（毎回ファイルを読み込んでstr.formatする）と比較するベンチマーク
+  """
+  # {{ name }}だけを使っていて、以前の方式でもレンダリングできるテンプレート
+  TEMPLATES = {
+    "now.html": {"now": "2021-04-24 13:35:51"},
+    "user_profile.html": {"user_id": 100},
+  }
+
+  def run(self, number: int) -> None:
+    engine = TemplateEngine(settings.TEMPLATES_DIR)
+
+    with tempfile.TemporaryDirectory() as legacy_dir:
+      # 以前の方式用に、{{ name }}を{name}に書き換えたテンプレートを用意する
+      for template_name in self.TEMPLATES:
+        with open(os.path.join(settings.TEMPLATES_DIR, template_name)) as f:
+          source = re.sub(r"\{\{ *(\w+) *\}\}", r"{\1}", f.read())
+        with open(os.path.join(legacy_dir, template_name), "w") as f:
+          f.write(source)
+
+      for template_name, context in self.TEMPLATES.items():
+        legacy = timeit.timeit(lambda: self.legacy_render(legacy_dir, template_name, context), number=number)
+        compiled = timeit.timeit(lambda: engine.render(template_name, context), number=number)
+        print(f"{template_name}: str.format {legacy / number * 1e6:.1f} us / compiled {compiled / number * 1e6:.1f} us")
+
+  def legacy_render(self, templates_dir: str, template_name: str, context: dict) -> str:
+    """
+    以前のtemplates/renderer.pyのrenderと同じ処理
+    """
+    template_path = os.path.join(templates_dir, template_name)
+
+    with open(template_path) as f:
+      template = f.read()
+
+    return template.format(**context)
+
+if __name__ == '__main__':
+  number = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+  RenderBenchmark().run(number)
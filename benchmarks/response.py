@@ -0,0 +1,85 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import timeit
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from henango.http.cookie import Cookie
+from henango.http.request import HTTPRequest
+from henango.http.response import HTTPResponse
+from henango.server.handler import HTTPHandler
+
+class ResponseBenchmark:
+  """
+  レスポンスライン+ヘッダーの構築にかかる時間を、
+  以前の方式（文字列を+=で連結し、毎回Dateをstrftimeしてからencodeする）と比較するベンチマーク
+  """
+  # 以前のHTTPHandler.STATUS_LINES
+  LEGACY_STATUS_LINES = {200: "200 OK", 302: "302 Found", 404: "404 Not Found", 405: "405 Method Not Allowed"}
+
+  def __init__(self):
+    self.handler = HTTPHandler()
+    self.request = HTTPRequest("/now", "GET", "HTTP/1.1", {}, {})
+
+  def responses(self) -> dict:
+    return {
+      "plain": HTTPResponse(body=b"<html></html>" * 100, content_type="text/html; charset=UTF-8"),
+      "cookies": HTTPResponse(
+        status_code=302,
+        headers={"Location": "/welcome"},
+        cookies=[Cookie("username", "hena", max_age=30), Cookie("email", "hena@example.com", max_age=30)],
+        content_type="text/html; charset=UTF-8",
+      ),
+    }
+
+  def run(self, number: int) -> None:
+    for name, response in self.responses().items():
+      # 他のプロセスの影響を減らすため、何回か計測した中で最も速い結果を使う
+      legacy = min(timeit.repeat(lambda: self.legacy_build(response, True), number=number, repeat=5))
+      current = min(timeit.repeat(lambda: bytes(self.handler.build_response_head(response, self.request, True)), number=number, repeat=5))
+      print(f"{name}: legacy {legacy / number * 1e6:.2f} us / current {current / number * 1e6:.2f} us")
+
+  def legacy_build(self, response: HTTPResponse, keep_alive: bool) -> bytes:
+    """
+    以前のbuild_response_line + build_response_headerと同じ処理
+    """
+    response_line = f"HTTP/1.1 {self.LEGACY_STATUS_LINES[response.status_code]}\r\n"
+
+    response_header = ""
+    response_header += f"Date: {datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')}\r\n"
+    response_header += "Host: HenaServer//0.1\r\n"
+    response_header += f"Content-Length: {len(response.body)}\r\n"
+    if keep_alive:
+      response_header += "Connection: keep-alive\r\n"
+      response_header += "Keep-Alive: timeout=5, max=100\r\n"
+    else:
+      response_header += "Connection: Close\r\n"
+    response_header += f"Content-Type: {response.content_type}\r\n"
+
+    for cookie in response.cookies:
+      cookie_header = f"Set-Cookie: {cookie.name}={cookie.value}"
+      if cookie.expires is not None:
+        cookie_header += f"; Expires={cookie.expires.strftime('%a, %d %b %Y %H:%M:%S GMT')}"
+      if cookie.max_age is not None:
+        cookie_header += f"; Max-Age={cookie.max_age}"
+      if cookie.domain:
+        cookie_header += f"; Domain={cookie.domain}"
+      if cookie.path:
+        cookie_header += f"; Path={cookie.path}"
+      if cookie.secure:
+        cookie_header += f"; Secure"
+      if cookie.http_only:
+        cookie_header += f"; HttpOnly"
+      response_header += cookie_header + "\r\n"
+
+    for header_name, header_value in response.headers.items():
+      response_header += f"{header_name}: {header_value}\r\n"
+
+    return (response_line + response_header + "\r\n").encode()
+
+if __name__ == '__main__':
+  number = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+  ResponseBenchmark().run(number)
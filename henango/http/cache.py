@@ -0,0 +1,235 @@
+import functools
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Tuple
+
+import settings
+from henango.http.compression import add_vary, choose_encoding, prepare_body
+from henango.http.headers import write_header_fields
+from henango.http.request import HTTPRequest
+from henango.http.response import FileResponse, HTTPResponse
+from henango.server.metrics import metrics
+
+# キャッシュのキー（path, Varyの対象の値..., 圧縮方式）
+CacheKey = Tuple[Optional[str], ...]
+
+# キャッシュするステータスコード
+CACHEABLE_STATUS_CODES = {200, 203, 301, 404, 410}
+
+
+class CachePolicy:
+  """
+  URLPatternごとのレスポンスキャッシュの設定
+  vary_headers, vary_cookiesに指定したリクエストヘッダー/Cookieの値が異なる場合は、別々にキャッシュする
+  """
+  ttl: float
+  vary_headers: List[str]
+  vary_cookies: List[str]
+
+  def __init__(self, ttl: float = 60, vary_headers: List[str] = None, vary_cookies: List[str] = None):
+    self.ttl = ttl
+    self.vary_headers = vary_headers or []
+    self.vary_cookies = vary_cookies or []
+
+
+class CachedResponse(HTTPResponse):
+  """
+  キャッシュから返すレスポンス
+  ボディは圧縮まで済ませてあり、Content-Type以降のヘッダーはエンコード済みのheader_fieldsをそのまま送る
+  複数のリクエストで共有するので、書き換えてはいけない
+  """
+  header_fields: bytes
+
+  def __init__(self, response: HTTPResponse, header_fields: bytes):
+    super().__init__(
+      status_code=response.status_code,
+      headers=response.headers,
+      content_type=response.content_type,
+      body=response.body,
+    )
+    self.header_fields = header_fields
+
+  @property
+  def memory_size(self) -> int:
+    return len(self.body) + len(self.header_fields)
+
+
+class ResponseCache:
+  """
+  viewが返したレスポンスを、TTLとメモリ使用量の上限付きでLRUキャッシュする
+  同じキーのキャッシュが無いリクエストが同時に来た場合は、最初の1つだけがviewを呼び出し、
+  残りはその結果を待つ（キャッシュスタンピードの防止）
+  """
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+    self.size = 0
+    self.entries: "OrderedDict[CacheKey, Tuple[float, CachedResponse]]" = OrderedDict()
+    # viewを実行中のキーと、完了を知らせるEvent
+    self.inflight: Dict[CacheKey, threading.Event] = {}
+    self.lock = threading.Lock()
+
+  def get(self, key: CacheKey) -> Optional[CachedResponse]:
+    with self.lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        return None
+      expires_at, response = entry
+      if expires_at <= time.monotonic():
+        self.evict(key)
+        return None
+      self.entries.move_to_end(key)
+      return response
+
+  def put(self, key: CacheKey, response: CachedResponse, ttl: float) -> None:
+    if response.memory_size > self.max_size:
+      return
+    with self.lock:
+      if key in self.entries:
+        self.evict(key)
+      self.entries[key] = (time.monotonic() + ttl, response)
+      self.size += response.memory_size
+      while self.size > self.max_size:
+        self.evict(next(iter(self.entries)))
+
+  def evict(self, key: CacheKey) -> None:
+    """
+    self.lockを取得した状態で呼び出すこと
+    """
+    _, response = self.entries.pop(key)
+    self.size -= response.memory_size
+
+  def begin(self, key: CacheKey) -> Optional[threading.Event]:
+    """
+    keyのviewを実行する権利を取得する
+    取得できた場合はNoneを、他のリクエストが実行中の場合は完了を待つためのEventを返す
+    """
+    with self.lock:
+      event = self.inflight.get(key)
+      if event is None:
+        self.inflight[key] = threading.Event()
+      return event
+
+  def end(self, key: CacheKey) -> None:
+    with self.lock:
+      event = self.inflight.pop(key)
+    event.set()
+
+  def clear(self) -> None:
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+
+def build_key(request: HTTPRequest, policy: CachePolicy) -> CacheKey:
+  """
+  リクエストからキャッシュのキーを作る
+  """
+  return (
+    request.full_path,
+    *(request.get_header(name) for name in policy.vary_headers),
+    *(request.cookies.get(name) for name in policy.vary_cookies),
+    choose_encoding(request.get_header("Accept-Encoding")),
+  )
+
+
+def is_cacheable(request: HTTPRequest, response: HTTPResponse) -> bool:
+  """
+  viewが返したレスポンスを、他のリクエストに使い回してよいかを判定する
+  セッションを参照したレスポンスはユーザーごとに内容が異なるかもしれないので、キャッシュしない
+  """
+  return (
+    response.status_code in CACHEABLE_STATUS_CODES
+    and not isinstance(response, FileResponse)
+    and not response.streaming
+    and not response.cookies
+    and "Cache-Control" not in response.headers
+    and not (request.session is not None and (request.session.loaded or request.session.modified))
+  )
+
+
+def store(cache: ResponseCache, key: CacheKey, request: HTTPRequest, response: HTTPResponse, policy: CachePolicy) -> HTTPResponse:
+  """
+  キャッシュできるレスポンスであれば、送信できる形に変換してキャッシュする
+  """
+  if not is_cacheable(request, response):
+    return response
+
+  prepare_body(response, request)
+  for name in policy.vary_headers:
+    add_vary(response.headers, name)
+  if policy.vary_cookies:
+    add_vary(response.headers, "Cookie")
+
+  header_fields = bytearray()
+  write_header_fields(header_fields, response)
+  cached = CachedResponse(response, bytes(header_fields))
+  cache.put(key, cached, policy.ttl)
+  return cached
+
+
+def cache_view(view: Callable, policy: CachePolicy, cache: "ResponseCache" = None) -> Callable:
+  """
+  viewのレスポンスをキャッシュするviewを返す
+  GET/HEAD以外のリクエストは、キャッシュを使わずにそのままviewを呼び出す
+  """
+  if cache is None:
+    cache = response_cache
+  # 先にviewを実行しているリクエストを待つ時間の上限（秒）
+  wait_timeout = getattr(settings, "RESPONSE_CACHE_WAIT_TIMEOUT", 10)
+
+  def lookup(request: HTTPRequest) -> Tuple[Optional[CacheKey], Optional[HTTPResponse], Optional[threading.Event]]:
+    if request.method not in ("GET", "HEAD"):
+      return None, None, None
+    key = build_key(request, policy)
+    cached = cache.get(key)
+    if cached is not None:
+      metrics.inc("henango_response_cache_requests_total", (("result", "hit"),))
+      return key, cached, None
+    metrics.inc("henango_response_cache_requests_total", (("result", "miss"),))
+    return key, None, cache.begin(key)
+
+  if inspect.iscoroutinefunction(view):
+    # asyncioはコルーチン関数のviewをキャッシュする場合だけ読み込む
+    import asyncio
+
+    @functools.wraps(view)
+    async def cached_view(request: HTTPRequest) -> HTTPResponse:
+      key, cached, event = lookup(request)
+      if cached is not None:
+        return cached
+      if key is None:
+        return await view(request)
+      if event is not None:
+        # 先に実行しているリクエストの完了を、イベントループを止めずに待つ
+        await asyncio.get_running_loop().run_in_executor(None, event.wait, wait_timeout)
+        # キャッシュされなかった場合は、待っていたリクエストそれぞれでviewを呼び出す
+        return cache.get(key) or await view(request)
+      try:
+        return store(cache, key, request, await view(request), policy)
+      finally:
+        cache.end(key)
+  else:
+    @functools.wraps(view)
+    def cached_view(request: HTTPRequest) -> HTTPResponse:
+      key, cached, event = lookup(request)
+      if cached is not None:
+        return cached
+      if key is None:
+        return view(request)
+      if event is not None:
+        event.wait(wait_timeout)
+        return cache.get(key) or view(request)
+      try:
+        return store(cache, key, request, view(request), policy)
+      finally:
+        cache.end(key)
+
+  return cached_view
+
+
+# 全てのWorkerで共有する
+response_cache = ResponseCache(max_size=getattr(settings, "RESPONSE_CACHE_MAX_SIZE", 16 * 1024 * 1024))
+
+metrics.describe("henango_response_cache_requests_total", "counter", "レスポンスキャッシュを参照した回数")
@@ -0,0 +1,128 @@
+import gzip
+import zlib
+from typing import Optional
+
+import settings
+from henango.http.mime import guess_content_type
+from henango.http.request import HTTPRequest
+from henango.http.response import FileResponse, HTTPResponse
+
+# 対応している圧縮方式（同じqの場合は先にあるものを優先する）
+ENCODINGS = ["gzip", "deflate"]
+
+# 圧縮する価値のあるContent-Type
+# 画像（image/png など）はすでに圧縮されているので対象外とする
+COMPRESSIBLE_TYPES = {
+  "application/javascript",
+  "application/json",
+  "application/xml",
+  "image/svg+xml",
+}
+
+
+def is_compressible(content_type: Optional[str]) -> bool:
+  """
+  Content-Typeが圧縮する価値のあるものかどうかを判定する
+  """
+  if not content_type:
+    return False
+  mime_type = content_type.split(";", maxsplit=1)[0].strip().lower()
+  return mime_type.startswith("text/") or mime_type in COMPRESSIBLE_TYPES
+
+
+def choose_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+  """
+  Accept-Encodingヘッダーから、使用する圧縮方式を選ぶ
+  使える圧縮方式がない場合はNoneを返す
+  ex) "gzip, deflate, br" => "gzip", "gzip;q=0, deflate" => "deflate"
+  """
+  if not accept_encoding:
+    return None
+
+  qualities = {}
+  for item in accept_encoding.split(","):
+    name, _, params = item.strip().partition(";")
+    quality = 1.0
+    params = params.strip()
+    if params.startswith("q="):
+      try:
+        quality = float(params[2:])
+      except ValueError:
+        quality = 0.0
+    qualities[name.strip().lower()] = quality
+
+  best = None
+  best_quality = 0.0
+  for encoding in ENCODINGS:
+    quality = qualities.get(encoding, qualities.get("*", 0.0))
+    if quality > best_quality:
+      best, best_quality = encoding, quality
+  return best
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+  """
+  指定された方式でデータを圧縮する
+  """
+  level = getattr(settings, "COMPRESSION_LEVEL", 6)
+  if encoding == "gzip":
+    # mtimeを固定して、同じ内容からは同じ結果が得られるようにする
+    return gzip.compress(data, compresslevel=level, mtime=0)
+  if encoding == "deflate":
+    return zlib.compress(data, level)
+  raise ValueError(f"{encoding} には対応していません")
+
+
+def add_vary(headers: dict, name: str) -> None:
+  """
+  Varyヘッダーに名前を追加する
+  """
+  vary = headers.get("Vary")
+  if not vary:
+    headers["Vary"] = name
+  elif name.lower() not in [value.strip().lower() for value in vary.split(",")]:
+    headers["Vary"] = f"{vary}, {name}"
+
+
+def compress_response(response: HTTPResponse, request: HTTPRequest) -> None:
+  """
+  クライアントが対応していれば、レスポンスボディを圧縮する
+  response.content_typeとresponse.body（bytes）は決まっているものとする
+  """
+  if not getattr(settings, "COMPRESSION_ENABLED", True):
+    return
+  # すでに圧縮済みのレスポンスや、ファイルから直接送るレスポンス、少しずつ送るレスポンスは対象外
+  if isinstance(response, FileResponse) or response.streaming or "Content-Encoding" in response.headers:
+    return
+  if not is_compressible(response.content_type):
+    return
+
+  # 圧縮するかどうかがAccept-Encodingで変わることを、キャッシュに伝える
+  add_vary(response.headers, "Accept-Encoding")
+
+  # 小さなボディは圧縮してもほとんど縮まないので、そのまま送る
+  if len(response.body) < getattr(settings, "COMPRESSION_MIN_SIZE", 1024):
+    return
+
+  encoding = choose_encoding(request.get_header("Accept-Encoding"))
+  if encoding is None:
+    return
+
+  response.body = compress(response.body, encoding)
+  response.headers["Content-Encoding"] = encoding
+
+
+def prepare_body(response: HTTPResponse, request: HTTPRequest, compress: bool = True) -> None:
+  """
+  レスポンスボディをbytesにし、Content-Typeを決める
+  compressがTrueの場合は、クライアントが対応していれば圧縮する
+  """
+  if isinstance(response.body, str):
+    response.body = response.body.encode()
+
+  # Content-Typeが指定されていない場合はpathから特定する
+  if response.content_type is None:
+    response.content_type = guess_content_type(request.path)
+
+  if compress:
+    compress_response(response, request)
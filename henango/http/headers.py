@@ -0,0 +1,117 @@
+import time
+from email.utils import formatdate
+from functools import lru_cache
+from http import HTTPStatus
+from typing import Dict
+
+from henango.http.cookie import Cookie
+from henango.http.response import HTTPResponse
+
+CRLF = b"\r\n"
+
+# サーバを示すヘッダー（全てのレスポンスで同じなので、エンコード済みのものを使い回す）
+SERVER_HEADER = b"Server: HenaServer/0.1\r\n"
+
+# ステータスコードと理由句の対応
+# 標準ライブラリのものをベースに、RFC 9110で名前が変わったものを上書きする
+REASON_PHRASES: Dict[int, str] = {status.value: status.phrase for status in HTTPStatus}
+REASON_PHRASES.update({
+  413: "Payload Too Large",
+  414: "URI Too Long",
+  416: "Range Not Satisfiable",
+})
+
+# ステータスコードと、エンコード済みのステータスライン（CRLFまで）の対応
+STATUS_LINES: Dict[int, bytes] = {
+  status_code: f"HTTP/1.1 {status_code} {reason}\r\n".encode() for status_code, reason in REASON_PHRASES.items()
+}
+
+
+def status_line(status_code: int) -> bytes:
+  """
+  ステータスコードに対応するステータスラインを返す
+  理由句が分からないステータスコードは、理由句を空にする（RFC 9110で省略が認められている）
+  """
+  try:
+    return STATUS_LINES[status_code]
+  except KeyError:
+    if not 100 <= status_code <= 999:
+      raise ValueError(f"不正なステータスコードです: {status_code}")
+    line = STATUS_LINES[status_code] = f"HTTP/1.1 {status_code} \r\n".encode()
+    return line
+
+
+def reason_phrase(status_code: int) -> str:
+  return REASON_PHRASES.get(status_code, "")
+
+
+class DateHeader:
+  """
+  Dateヘッダーの行を、1秒ごとに作り直してキャッシュする
+  (秒, 行)のタプルを丸ごと差し替えるので、複数のスレッドから呼んでもロックは要らない
+  """
+  def __init__(self):
+    self.cached = (0, b"")
+
+  def get(self) -> bytes:
+    now = int(time.time())
+    second, line = self.cached
+    if second != now:
+      line = b"Date: " + formatdate(now, usegmt=True).encode() + CRLF
+      self.cached = (now, line)
+    return line
+
+
+date_header = DateHeader()
+
+
+@lru_cache(maxsize=256)
+def content_type_line(content_type: str) -> bytes:
+  """
+  Content-Typeヘッダーの行を返す
+  使われるContent-Typeの種類は限られているので、エンコード結果をキャッシュする
+  """
+  return f"Content-Type: {content_type}\r\n".encode()
+
+
+def write_cookie(buffer: bytearray, cookie: Cookie) -> None:
+  """
+  Set-Cookieヘッダーの行をbufferへ書き込む
+  """
+  parts = [f"Set-Cookie: {cookie.name}={cookie.value}"]
+  if cookie.expires is not None:
+    parts.append(f"Expires={cookie.expires.strftime('%a, %d %b %Y %H:%M:%S GMT')}")
+  if cookie.max_age is not None:
+    parts.append(f"Max-Age={cookie.max_age}")
+  if cookie.domain:
+    parts.append(f"Domain={cookie.domain}")
+  if cookie.path:
+    parts.append(f"Path={cookie.path}")
+  if cookie.secure:
+    parts.append("Secure")
+  if cookie.http_only:
+    parts.append("HttpOnly")
+  buffer += "; ".join(parts).encode()
+  buffer += CRLF
+
+
+def write_header(buffer: bytearray, name: str, value) -> None:
+  """
+  ヘッダーの行を1つbufferへ書き込む
+  """
+  buffer += f"{name}: {value}\r\n".encode()
+
+
+def write_header_fields(buffer: bytearray, response: HTTPResponse) -> None:
+  """
+  レスポンスごとに決まるヘッダー（Content-Type, Set-Cookie, その他）をbufferへ書き込む
+  """
+  buffer += content_type_line(response.content_type)
+
+  # Cookieヘッダーの生成
+  for cookie in response.cookies:
+    write_cookie(buffer, cookie)
+
+  # その他のヘッダーの生成
+  for header_name, header_value in response.headers.items():
+    write_header(buffer, header_name, header_value)
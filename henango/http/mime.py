@@ -0,0 +1,27 @@
+# 拡張子とMIME Typeの対応
+MIME_TYPE = {
+  "html": "text/html; charset=UTF-8",
+  "css": "text/css",
+  "js": "application/javascript",
+  "json": "application/json",
+  "svg": "image/svg+xml",
+  "txt": "text/plain; charset=UTF-8",
+  "png": "image/png",
+  "jpg": "image/jpg",
+  "gif": "image/gif",
+}
+
+
+def guess_content_type(path: str) -> str:
+  """
+  pathの拡張子からContent-Typeを特定する
+  """
+  # pathから拡張子を取得
+  if "." in path:
+    ext = path.rsplit(".", maxsplit=1)[-1]
+    # 拡張子からMIME Typeを取得
+    # 知らない対応していない拡張子の場合はoctet-streamとする
+    return MIME_TYPE.get(ext,"application/octet-stream")
+  else:
+    # pathに拡張子がない場合はhtml扱いとする
+    return "text/html; charset=UTF-8"
@@ -0,0 +1,266 @@
+import re
+import shutil
+import tempfile
+import urllib.parse
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import settings
+from henango.http.parser import BodyStream, HTTPRequestError, RequestBodyTooLarge
+
+# Content-Type, Content-Dispositionのパラメータ
+# ex) 'form-data; name="file"; filename="a.txt"' => [("name", "file", ""), ("filename", "a.txt", "")]
+HEADER_PARAMETER_PATTERN = re.compile(r';\s*([\w*-]+)\s*=\s*(?:"((?:[^"\\]|\\.)*)"|([^;]*))')
+
+
+class UploadedFile:
+  """
+  multipart/form-dataで送られてきたファイル
+  中身はSpooledTemporaryFileに書き込まれており、MULTIPART_SPOOL_THRESHOLDを超えるとディスク上の一時ファイルに移る
+  """
+  name: str
+  filename: str
+  content_type: str
+  size: int
+  file: BinaryIO
+
+  def __init__(self, name: str, filename: str, content_type: str, file: BinaryIO, size: int):
+    self.name = name
+    self.filename = filename
+    self.content_type = content_type
+    self.file = file
+    self.size = size
+
+  def read(self, size: int = -1) -> bytes:
+    return self.file.read(size)
+
+  def chunks(self, chunk_size: int = 65536) -> Iterator[bytes]:
+    """
+    ファイルの中身を、先頭から少しずつ返す
+    """
+    self.file.seek(0)
+    while True:
+      chunk = self.file.read(chunk_size)
+      if not chunk:
+        return
+      yield chunk
+
+  def save(self, path: str) -> None:
+    """
+    ファイルの中身を、メモリに載せずにpathへコピーする
+    """
+    self.file.seek(0)
+    with open(path, "wb") as f:
+      shutil.copyfileobj(self.file, f)
+
+  def close(self) -> None:
+    self.file.close()
+
+  def __repr__(self) -> str:
+    return f"<UploadedFile: {self.filename} ({self.content_type}, {self.size} bytes)>"
+
+
+def parse_header_parameters(value: str) -> Tuple[str, Dict[str, str]]:
+  """
+  Content-TypeやContent-Dispositionの値を、(値, パラメータの辞書)に分ける
+  filename*=UTF-8''... のように文字コードを指定したパラメータは、デコードしてfilenameとして扱う
+  """
+  main_value, _, rest = value.partition(";")
+  params = {}
+  for name, quoted, token in HEADER_PARAMETER_PATTERN.findall(";" + rest):
+    name = name.lower()
+    if name.endswith("*"):
+      charset, _, encoded = (quoted or token).strip().partition("''")
+      params[name[:-1]] = urllib.parse.unquote(encoded, encoding=charset or "utf-8", errors="replace")
+    elif name not in params:
+      params[name] = re.sub(r"\\(.)", r"\1", quoted) if quoted else token.strip()
+  return main_value.strip().lower(), params
+
+
+class MultipartParser:
+  """
+  multipart/form-dataのボディを、BodyStreamから少しずつ読み込みながらパースするクラス
+  ファイルのパートはSpooledTemporaryFileに書き込んでいくので、アップロードの大きさによらず使うメモリは一定
+  """
+
+  # パートのヘッダーの最大サイズ
+  MAX_HEADER_SIZE = 8 * 1024
+
+  def __init__(
+    self,
+    stream: BodyStream,
+    boundary: bytes,
+    spool_threshold: int = None,
+    max_field_size: int = None,
+    max_file_size: int = None,
+    max_parts: int = None,
+  ):
+    if spool_threshold is None:
+      spool_threshold = getattr(settings, "MULTIPART_SPOOL_THRESHOLD", 1024 * 1024)
+    if max_field_size is None:
+      max_field_size = getattr(settings, "MULTIPART_MAX_FIELD_SIZE", 1024 * 1024)
+    if max_file_size is None:
+      max_file_size = getattr(settings, "MULTIPART_MAX_FILE_SIZE", None)
+    if max_parts is None:
+      max_parts = getattr(settings, "MULTIPART_MAX_PARTS", 1000)
+
+    self.stream = stream
+    # 各パートの区切り（最初の区切りの前にも改行があるとみなして、同じ区切りで探す）
+    self.delimiter = b"\r\n--" + boundary
+    self.spool_threshold = spool_threshold
+    self.max_field_size = max_field_size
+    self.max_file_size = max_file_size
+    self.max_parts = max_parts
+    self.buffer = b"\r\n"
+
+  def parse(self) -> Tuple[Dict[str, List[str]], Dict[str, List[UploadedFile]]]:
+    """
+    ボディを最後まで読み込み、(フィールドの辞書, ファイルの辞書)を返す
+    フィールドの辞書はurllib.parse.parse_qsと同じ形式
+    """
+    fields: Dict[str, List[str]] = {}
+    files: Dict[str, List[UploadedFile]] = {}
+
+    # 最初の区切りより前（プリアンブル）は読み捨てる
+    for _ in self.read_until_delimiter():
+      pass
+
+    parts = 0
+    while self.read_after_delimiter():
+      parts += 1
+      if parts > self.max_parts:
+        raise RequestBodyTooLarge()
+
+      headers = self.read_part_headers()
+      disposition, params = parse_header_parameters(headers.get("content-disposition", ""))
+      name = params.get("name")
+      if disposition != "form-data" or name is None:
+        raise HTTPRequestError()
+
+      if "filename" in params:
+        content_type = headers.get("content-type", "application/octet-stream")
+        files.setdefault(name, []).append(self.read_file(name, params["filename"], content_type))
+      else:
+        _, content_type_params = parse_header_parameters(headers.get("content-type", "text/plain"))
+        value = self.read_field().decode(content_type_params.get("charset", "utf-8"), errors="replace")
+        fields.setdefault(name, []).append(value)
+
+    return fields, files
+
+  def fill(self) -> None:
+    chunk = self.stream.read_some()
+    if not chunk:
+      # 終わりの区切りの前にボディが終わった
+      raise HTTPRequestError()
+    self.buffer += chunk
+
+  def read_until_delimiter(self) -> Iterator[bytes]:
+    """
+    次の区切りの直前までのデータを、受信した分から順に返す
+    区切りの一部かもしれない末尾は、続きを受信するまでbufferに残しておく
+    """
+    while True:
+      index = self.buffer.find(self.delimiter)
+      if index >= 0:
+        data, self.buffer = self.buffer[:index], self.buffer[index + len(self.delimiter):]
+        if data:
+          yield data
+        return
+
+      keep = len(self.delimiter) - 1
+      if len(self.buffer) > keep:
+        data, self.buffer = self.buffer[:-keep], self.buffer[-keep:]
+        yield data
+      self.fill()
+
+  def read_after_delimiter(self) -> bool:
+    """
+    区切りの直後を読み込み、続きのパートがある場合はTrueを、終わりの区切りだった場合はFalseを返す
+    """
+    while len(self.buffer) < 2:
+      self.fill()
+    if self.buffer.startswith(b"--"):
+      # 終わりの区切りより後（エピローグ）は、サーバが読み捨てる
+      return False
+
+    # 区切りの行の末尾の空白は無視する
+    while b"\r\n" not in self.buffer:
+      if len(self.buffer) > self.MAX_HEADER_SIZE:
+        raise HTTPRequestError()
+      self.fill()
+    line, self.buffer = self.buffer.split(b"\r\n", 1)
+    if line.strip(b" \t"):
+      raise HTTPRequestError()
+    return True
+
+  def read_part_headers(self) -> Dict[str, str]:
+    """
+    パートのヘッダーを空行まで読み込み、小文字の名前と値の辞書を返す
+    """
+    if self.buffer.startswith(b"\r\n"):
+      # ヘッダーのないパート
+      self.buffer = self.buffer[2:]
+      return {}
+
+    while True:
+      index = self.buffer.find(b"\r\n\r\n")
+      if index >= 0:
+        break
+      if len(self.buffer) > self.MAX_HEADER_SIZE:
+        raise HTTPRequestError()
+      self.fill()
+    if index > self.MAX_HEADER_SIZE:
+      raise HTTPRequestError()
+
+    raw_headers, self.buffer = self.buffer[:index], self.buffer[index + 4:]
+    headers = {}
+    for row in raw_headers.decode(errors="replace").split("\r\n"):
+      name, colon, value = row.partition(":")
+      if not colon:
+        raise HTTPRequestError()
+      headers[name.strip().lower()] = value.strip()
+    return headers
+
+  def read_field(self) -> bytes:
+    data = bytearray()
+    for chunk in self.read_until_delimiter():
+      data += chunk
+      if len(data) > self.max_field_size:
+        raise RequestBodyTooLarge()
+    return bytes(data)
+
+  def read_file(self, name: str, filename: str, content_type: str) -> UploadedFile:
+    file = tempfile.SpooledTemporaryFile(
+      max_size=self.spool_threshold,
+      dir=getattr(settings, "FILE_UPLOAD_TEMP_DIR", None),
+    )
+    size = 0
+    try:
+      for chunk in self.read_until_delimiter():
+        size += len(chunk)
+        if self.max_file_size is not None and size > self.max_file_size:
+          raise RequestBodyTooLarge()
+        file.write(chunk)
+    except BaseException:
+      file.close()
+      raise
+    file.seek(0)
+    return UploadedFile(name, filename, content_type, file, size)
+
+
+def get_boundary(content_type: str) -> bytes:
+  """
+  multipart/form-dataのContent-Typeから、区切りの文字列を取り出す
+  """
+  _, params = parse_header_parameters(content_type)
+  boundary = params.get("boundary")
+  # RFC 2046: 区切りは1〜70文字
+  if not boundary or len(boundary) > 70:
+    raise HTTPRequestError()
+  return boundary.encode("latin-1", errors="replace")
+
+
+def parse_multipart(stream: BodyStream, content_type: str) -> Tuple[Dict[str, List[str]], Dict[str, List[UploadedFile]]]:
+  """
+  multipart/form-dataのボディをストリームから少しずつ読み込みながらパースし、(フィールドの辞書, ファイルの辞書)を返す
+  """
+  return MultipartParser(stream, get_boundary(content_type)).parse()
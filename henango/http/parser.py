@@ -0,0 +1,230 @@
+import urllib.parse
+from typing import Callable, Iterator, Optional, Tuple
+
+# 受信を行う関数の型
+# 指定したバイト数までのデータを返し、切断された場合は空のbytesを返す
+Recv = Callable[[int], bytes]
+
+
+class HTTPRequestError(Exception):
+  """
+  クライアントから受け取ったリクエストが不正な場合の例外
+  """
+  status_code = 400
+
+
+class RequestHeaderTooLarge(HTTPRequestError):
+  status_code = 431
+
+
+class RequestBodyTooLarge(HTTPRequestError):
+  status_code = 413
+
+
+class RequestTimeout(HTTPRequestError):
+  """
+  リクエストライン+ヘッダーやリクエストボディを、時間内に受信しきれなかった場合の例外
+  """
+  status_code = 408
+
+
+class IncompleteRequestBody(HTTPRequestError):
+  """
+  リクエストボディを受信しきる前に、クライアントが切断した場合の例外
+  """
+  status_code = 400
+
+
+def split_request_head(buffer: bytes, max_header_size: int, search_from: int = 0) -> Optional[Tuple[bytes, bytes]]:
+  """
+  受信済みのbufferから、リクエストライン+リクエストヘッダー（空行まで）を切り出す
+  (リクエストライン+ヘッダー, 残りのbuffer)を返す
+  まだ空行まで受信できていない場合はNoneを返す
+  search_fromを指定すると、前回までに探し終えた位置から空行を探す
+  """
+  index = buffer.find(b"\r\n\r\n", max(search_from - 3, 0))
+  if index < 0:
+    if len(buffer) > max_header_size:
+      raise RequestHeaderTooLarge()
+    return None
+
+  head_end = index + 4
+  if head_end > max_header_size:
+    raise RequestHeaderTooLarge()
+  return buffer[:head_end], buffer[head_end:]
+
+
+class BodyStream:
+  """
+  リクエストボディを、必要になった時点で少しずつ受信するストリーム
+  Content-Lengthで長さが決まっているボディと、Transfer-Encoding: chunkedのボディを扱う
+  """
+
+  # 1回の受信で読み込むバイト数
+  RECV_SIZE = 65536
+  # chunkedのサイズ行・トレイラー行の最大長
+  MAX_LINE_SIZE = 4096
+
+  def __init__(
+    self,
+    recv: Optional[Recv],
+    buffer: bytes = b"",
+    content_length: int = 0,
+    chunked: bool = False,
+    max_size: Optional[int] = None,
+  ):
+    self.recv = recv
+    self.buffer = buffer
+    self.chunked = chunked
+    self.max_size = max_size
+    # これまでにボディとして読み込んだバイト数
+    self.read_size = 0
+
+    # Content-Lengthの場合: ボディの残りバイト数
+    # chunkedの場合: 読み込み中のチャンクの残りバイト数
+    self.remaining = 0 if chunked else content_length
+    # chunkedの場合に、チャンクデータの後ろのCRLFを読み飛ばす必要があるか
+    self.chunk_crlf_pending = False
+    self.finished = not chunked and content_length == 0
+
+  @classmethod
+  def from_bytes(cls, body: bytes) -> "BodyStream":
+    """
+    受信済みのbytesからストリームを生成する
+    """
+    return cls(None, body, len(body))
+
+  def read(self, size: int = -1) -> bytes:
+    """
+    ボディを最大sizeバイト読み込む
+    sizeが負の場合は、ボディの終わりまで全て読み込む
+    ボディの終わりに達している場合は空のbytesを返す
+    """
+    if size < 0:
+      return b"".join(self)
+
+    data = b""
+    while len(data) < size:
+      chunk = self.read_some(size - len(data))
+      if not chunk:
+        break
+      data += chunk
+    return data
+
+  def read_some(self, size: int = RECV_SIZE) -> bytes:
+    """
+    受信済みのデータを優先して、ボディを最大sizeバイト読み込む
+    ボディの終わりに達している場合は空のbytesを返す
+    """
+    if self.finished:
+      return b""
+
+    if self.chunked and self.remaining == 0:
+      self.start_next_chunk()
+      if self.finished:
+        return b""
+
+    if not self.buffer:
+      self.fill()
+
+    size = min(size, self.remaining, len(self.buffer))
+    data = self.buffer[:size]
+    self.buffer = self.buffer[size:]
+    self.remaining -= size
+
+    self.read_size += size
+    if self.max_size is not None and self.read_size > self.max_size:
+      raise RequestBodyTooLarge()
+
+    if self.remaining == 0:
+      if self.chunked:
+        self.chunk_crlf_pending = True
+      else:
+        self.finished = True
+
+    return data
+
+  def __iter__(self) -> Iterator[bytes]:
+    while True:
+      data = self.read_some()
+      if not data:
+        return
+      yield data
+
+  def drain(self) -> None:
+    """
+    読み込まれなかった残りのボディを読み捨てる
+    同じコネクションで次のリクエストを処理する前に呼び出す
+    """
+    for _ in self:
+      pass
+
+  def leftover(self) -> bytes:
+    """
+    ボディの後ろに続けて受信済みのデータ（パイプライン化された次のリクエスト）を返す
+    """
+    return self.buffer
+
+  def fill(self) -> None:
+    """
+    ソケットからデータを受信してbufferに追加する
+    """
+    chunk = self.recv(self.RECV_SIZE) if self.recv else b""
+    if not chunk:
+      raise IncompleteRequestBody()
+    self.buffer += chunk
+
+  def read_line(self) -> bytes:
+    """
+    CRLFまでの1行を読み込む（CRLFは含まない）
+    """
+    while b"\r\n" not in self.buffer:
+      if len(self.buffer) > self.MAX_LINE_SIZE:
+        raise HTTPRequestError()
+      self.fill()
+    line, self.buffer = self.buffer.split(b"\r\n", maxsplit=1)
+    return line
+
+  def start_next_chunk(self) -> None:
+    """
+    chunkedのボディについて、次のチャンクのサイズ行を読み込む
+    最後のチャンク（サイズ0）の場合は、トレイラーを読み飛ばして終了する
+    """
+    if self.chunk_crlf_pending:
+      if self.read_line():
+        raise HTTPRequestError()
+      self.chunk_crlf_pending = False
+
+    # ex) b"1a;name=value" => 0x1a
+    size_line = self.read_line().split(b";", maxsplit=1)[0].strip()
+    try:
+      self.remaining = int(size_line, 16)
+    except ValueError:
+      raise HTTPRequestError()
+
+    if self.remaining == 0:
+      # トレイラーは空行まで読み捨てる
+      while self.read_line():
+        pass
+      self.finished = True
+
+
+def parse_urlencoded(stream: BodyStream) -> dict:
+  """
+  application/x-www-form-urlencodedのボディを、ストリームから少しずつ読み込みながらパースする
+  urllib.parse.parse_qsと同じ形式の辞書を返す
+  """
+  params = {}
+  pending = b""
+  for chunk in stream:
+    pending += chunk
+    # 最後の&以降は、まだ続きがあるかもしれないので次のチャンクに持ち越す
+    complete, _, pending = pending.rpartition(b"&")
+    add_urlencoded_pairs(params, complete)
+  add_urlencoded_pairs(params, pending)
+  return params
+
+
+def add_urlencoded_pairs(params: dict, data: bytes) -> None:
+  for name, value in urllib.parse.parse_qsl(data.decode()):
+    params.setdefault(name, []).append(value)
@@ -0,0 +1,123 @@
+import functools
+import inspect
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Hashable, List, Tuple
+
+import settings
+from henango.http.request import HTTPRequest
+from henango.http.response import HTTPResponse
+from henango.server.metrics import metrics
+
+
+class TokenBucketLimiter:
+  """
+  キーごとのトークンバケットで、リクエストの頻度を制限するクラス
+  バケットには1秒にrate個ずつ、burst個までトークンが貯まり、リクエストごとに1つ使う
+
+  キーの数が増えてもメモリを使い過ぎないよう、MemorySessionStoreと同じくシャードごとのロックとOrderedDictで管理し、
+  満タンに戻ったバケット（記録がない場合と区別できない）とmax_entriesを超えた分を、使われていないものから捨てる
+  """
+  def __init__(self, rate: float, burst: float, max_entries: int = 100000, shards: int = 16):
+    self.rate = rate
+    self.burst = burst
+    # 最後に使われてからこの秒数が経ったバケットは、満タンに戻っている
+    self.expiry = burst / rate
+    self.shard_max_entries = max(1, max_entries // shards)
+    # (トークンの数, 最後に更新した時刻)
+    self.shards: List[Tuple[threading.Lock, "OrderedDict[Hashable, Tuple[float, float]]"]] = [
+      (threading.Lock(), OrderedDict()) for _ in range(shards)
+    ]
+
+  def acquire(self, key: Hashable) -> float:
+    """
+    keyのバケットからトークンを1つ使う
+    使えた場合は0を、バケットが空の場合は次のトークンが貯まるまでの秒数を返す
+    """
+    now = time.monotonic()
+    lock, buckets = self.shards[hash(key) % len(self.shards)]
+    with lock:
+      tokens, updated_at = buckets.pop(key, (self.burst, now))
+      tokens = min(self.burst, tokens + (now - updated_at) * self.rate)
+      if tokens >= 1:
+        tokens -= 1
+        wait = 0.0
+      else:
+        wait = (1 - tokens) / self.rate
+      buckets[key] = (tokens, now)
+
+      # 使われていない順に並んでいるので、先頭から捨てられるものを捨てる
+      while len(buckets) > 1:
+        oldest_key, (_, oldest_updated_at) = next(iter(buckets.items()))
+        if len(buckets) <= self.shard_max_entries and now - oldest_updated_at < self.expiry:
+          break
+        del buckets[oldest_key]
+    return wait
+
+  def __len__(self) -> int:
+    return sum(len(buckets) for _, buckets in self.shards)
+
+
+class RateLimit:
+  """
+  URLPatternごとの、クライアント(IPアドレス)あたりのリクエストの頻度の上限
+  1秒にrate回まで、一時的にはburst回まで受け付ける
+  """
+  rate: float
+  burst: float
+
+  def __init__(self, rate: float, burst: float = None):
+    self.rate = rate
+    self.burst = burst if burst is not None else max(1.0, rate)
+
+
+def retry_after(wait: float) -> str:
+  """
+  次のトークンが貯まるまでの秒数を、Retry-Afterヘッダーの値（1以上の整数）にする
+  """
+  return str(max(1, math.ceil(wait)))
+
+
+def too_many_requests(wait: float) -> HTTPResponse:
+  return HTTPResponse(
+    status_code=429,
+    headers={"Retry-After": retry_after(wait)},
+    content_type="text/html; charset=UTF-8",
+    body=b"<html><body><h1>429 Too Many Requests</h1></body></html>",
+  )
+
+
+def rate_limit_view(view: Callable, route: str, policy: RateLimit) -> Callable:
+  """
+  クライアントごとに頻度の上限を超えたリクエストには、viewを呼び出さずに429を返すviewを返す
+  """
+  limiter = TokenBucketLimiter(policy.rate, policy.burst, getattr(settings, "RATE_LIMIT_MAX_ENTRIES", 100000))
+
+  def limit(request: HTTPRequest) -> float:
+    client = request.client_address[0] if request.client_address else None
+    wait = limiter.acquire(client)
+    if wait:
+      metrics.inc("henango_rate_limited_requests_total", (("scope", "route"), ("route", route)))
+    return wait
+
+  if inspect.iscoroutinefunction(view):
+    @functools.wraps(view)
+    async def limited_view(request: HTTPRequest) -> HTTPResponse:
+      wait = limit(request)
+      if wait:
+        return too_many_requests(wait)
+      return await view(request)
+  else:
+    @functools.wraps(view)
+    def limited_view(request: HTTPRequest) -> HTTPResponse:
+      wait = limit(request)
+      if wait:
+        return too_many_requests(wait)
+      return view(request)
+
+  return limited_view
+
+
+metrics.describe("henango_rate_limited_requests_total", "counter", "頻度の上限を超えたため429を返したリクエストの数")
@@ -1,11 +1,82 @@
+import urllib.parse
+from collections.abc import MutableMapping
+from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
+
+from henango.http.parser import BodyStream, HTTPRequestError, parse_urlencoded
+
+if TYPE_CHECKING:
+  from henango.http.multipart import UploadedFile
+  from henango.http.session import Session
+
+
+class Headers(MutableMapping):
+  """
+  名前の大文字小文字を区別しない、リクエストヘッダーの辞書
+  ex) headers["content-type"] と headers["Content-Type"] は同じ値を返す
+  keys()やitems()では、クライアントが送ってきた時の名前を返す
+  """
+  def __init__(self, headers: dict = None):
+    # 小文字にした名前と(元の名前, 値)の対応
+    self._store: Dict[str, Tuple[str, str]] = {}
+    if headers:
+      self.update(headers)
+
+  def __getitem__(self, name: str) -> str:
+    return self._store[name.lower()][1]
+
+  def __setitem__(self, name: str, value: str) -> None:
+    self._store[name.lower()] = (name, value)
+
+  def __delitem__(self, name: str) -> None:
+    del self._store[name.lower()]
+
+  def __iter__(self) -> Iterator[str]:
+    return (name for name, _ in self._store.values())
+
+  def __len__(self) -> int:
+    return len(self._store)
+
+  def __repr__(self) -> str:
+    return repr(dict(self.items()))
+
+
 class HTTPRequest:
+  """
+  HTTPリクエストを表すクラス
+  リクエストヘッダーは受信したbytesのまま持っておき、
+  headers, cookies, GET, POST, FILESはそれぞれ初めて参照された時点でパースしてキャッシュする
+  """
+  __slots__ = (
+    "path",
+    "query_string",
+    "method",
+    "http_version",
+    "params",
+    "stream",
+    "client_address",
+    "route",
+    "session",
+    "timings",
+    "_raw_headers",
+    "_lower_headers",
+    "_headers",
+    "_cookies",
+    "_get",
+    "_post",
+    "_files",
+    "_body",
+  )
+
   path: str
+  query_string: str
   method: str
   http_version: str
-  headers: dict
-  cookies: dict
-  body: bytes
   params: dict
+  stream: BodyStream
+  client_address: Optional[Tuple[str, int]]
+  route: Optional[str]
+  session: Optional["Session"]
+  timings: dict
 
   def __init__(
     self,
@@ -16,18 +87,162 @@ class HTTPRequest:
     cookies: dict = None,
     body: bytes = b"",
     params:dict = None,
+    stream: BodyStream = None,
+    raw_headers: bytes = None,
     ):
-    if headers is None:
-      headers = {}
-    if cookies is None:
-      cookies = {}
     if params is None:
       params = {}
+    if stream is None:
+      stream = BodyStream.from_bytes(body)
+    if headers is None and raw_headers is None:
+      headers = {}
 
-    self.path = path
+    # クエリ文字列はpathに含めず、別に持っておく
+    # ex) "/now?a=b" => path: "/now", query_string: "a=b"
+    self.path, _, self.query_string = path.partition("?")
     self.method = method
     self.http_version = http_version
-    self.headers = headers
-    self.cookies = cookies
-    self.body = body
     self.params = params
+    self.stream = stream
+    # クライアントの(IPアドレス, ポート)（サーバが設定する）
+    self.client_address = None
+    # マッチしたURLパターン（URL解決の後に設定される）
+    self.route = None
+    # セッション（SessionMiddlewareで設定される。中身はアクセスされた時点で読み込む）
+    self.session = None
+    # フェーズごとの処理時間（秒）
+    self.timings = {}
+
+    # リクエストヘッダー（空行を除く）のbytes
+    # 先頭にCRLFを付けておくと、どの行も"\r\n名前:"で探せる
+    self._raw_headers = b"\r\n" + raw_headers if raw_headers is not None else None
+    self._lower_headers: Optional[bytes] = None
+    self._headers: Optional[Headers] = Headers(headers) if headers is not None else None
+    self._cookies: Optional[Dict[str, str]] = cookies
+    self._get: Optional[Dict[str, List[str]]] = None
+    self._post: Optional[Dict[str, List[str]]] = None
+    self._files: Optional[Dict[str, List["UploadedFile"]]] = None
+    self._body: Optional[bytes] = None
+
+  @property
+  def full_path(self) -> str:
+    """
+    クエリ文字列を含むpath
+    """
+    if self.query_string:
+      return f"{self.path}?{self.query_string}"
+    return self.path
+
+  @property
+  def headers(self) -> Headers:
+    """
+    全てのリクエストヘッダーの、名前の大文字小文字を区別しない辞書
+    1つだけ取得する場合は、辞書にパースせずに探すget_headerの方が速い
+    """
+    if self._headers is None:
+      headers = Headers()
+      raw_headers = self._raw_headers[2:].decode(errors="replace")
+      for header_row in raw_headers.split("\r\n") if raw_headers else []:
+        name, colon, value = header_row.partition(":")
+        if not colon:
+          raise HTTPRequestError()
+        headers[name] = value.strip()
+      self._headers = headers
+    return self._headers
+
+  @property
+  def cookies(self) -> Dict[str, str]:
+    """
+    Cookieヘッダーの辞書
+    ex) "name1=value1; name2=value2" => {"name1": "value1", "name2": "value2"}
+    """
+    if self._cookies is None:
+      cookies = {}
+      cookie_header = self.get_header("Cookie")
+      if cookie_header:
+        for cookie_string in cookie_header.split(";"):
+          name, equal, value = cookie_string.strip().partition("=")
+          if equal:
+            cookies[name] = value
+      self._cookies = cookies
+    return self._cookies
+
+  @property
+  def GET(self) -> Dict[str, List[str]]:
+    """
+    クエリ文字列のパラメータ（urllib.parse.parse_qsと同じ形式）
+    """
+    if self._get is None:
+      self._get = urllib.parse.parse_qs(self.query_string)
+    return self._get
+
+  @property
+  def POST(self) -> Dict[str, List[str]]:
+    """
+    application/x-www-form-urlencoded, multipart/form-dataのボディのパラメータ（urllib.parse.parse_qsと同じ形式）
+    bodyを参照していなければ、ボディ全体をメモリに載せずにストリームから少しずつパースする
+    Content-Typeが指定されていない場合も、urlencodedとみなす
+    """
+    if self._post is None:
+      content_type = self.get_header("Content-Type") or "application/x-www-form-urlencoded"
+      if content_type.startswith("multipart/form-data"):
+        self.parse_multipart(content_type)
+      elif not content_type.startswith("application/x-www-form-urlencoded"):
+        self._post = {}
+      elif self._body is not None:
+        self._post = urllib.parse.parse_qs(self._body.decode())
+      else:
+        self._post = parse_urlencoded(self.stream)
+    return self._post
+
+  @property
+  def FILES(self) -> Dict[str, List["UploadedFile"]]:
+    """
+    multipart/form-dataで送られてきたファイル（名前とUploadedFileのリストの辞書）
+    大きなファイルはディスク上の一時ファイルに書き込まれるので、アップロードの大きさによらず使うメモリは一定
+    """
+    if self._files is None:
+      content_type = self.get_header("Content-Type") or ""
+      if content_type.startswith("multipart/form-data"):
+        self.parse_multipart(content_type)
+      else:
+        self._files = {}
+    return self._files
+
+  def parse_multipart(self, content_type: str) -> None:
+    # multipartはファイルのアップロードがない限り使われないので、必要になった時点でimportする
+    from henango.http.multipart import parse_multipart
+
+    stream = BodyStream.from_bytes(self._body) if self._body is not None else self.stream
+    self._post, self._files = parse_multipart(stream, content_type)
+
+  @property
+  def body(self) -> bytes:
+    """
+    リクエストボディ全体
+    初めて参照された時点でストリームから全て読み込む
+    大きなボディを扱う場合は、代わりにstreamから少しずつ読み込むこと
+    """
+    if self._body is None:
+      self._body = self.stream.read()
+    return self._body
+
+  def get_header(self, name: str) -> Optional[str]:
+    """
+    リクエストヘッダーの値を、名前の大文字小文字を区別せずに取得する
+    存在しない場合はNoneを返す
+    ヘッダー全体を辞書にパースせず、受信したbytesから直接探す
+    """
+    if self._raw_headers is None:
+      return self._headers.get(name)
+
+    if self._lower_headers is None:
+      self._lower_headers = self._raw_headers.lower()
+    start = self._lower_headers.find(b"\r\n" + name.lower().encode() + b":")
+    if start == -1:
+      return None
+    start += len(name) + 3
+    end = self._raw_headers.find(b"\r\n", start)
+    if end == -1:
+      end = len(self._raw_headers)
+    return self._raw_headers[start:end].decode(errors="replace").strip()
@@ -1,13 +1,19 @@
-from typing import List, Optional, Union
+import secrets
+from typing import AsyncIterable, Iterable, List, Optional, Tuple, Union
 
 from henango.http.cookie import Cookie
 
+# レスポンスボディとして使えるもの
+# イテレータ（ジェネレータ、非同期ジェネレータを含む）の場合は、得られた順に少しずつ送信する
+Body = Union[bytes, bytearray, memoryview, str, Iterable[Union[bytes, str]], AsyncIterable[Union[bytes, str]]]
+
+
 class HTTPResponse:
   status_code: int
   headers: dict
   cookies: List[Cookie]
   content_type: Optional[str]
-  body: Union[bytes, str]
+  body: Body
 
   def __init__(
     self,
@@ -15,7 +21,7 @@ class HTTPResponse:
     headers: dict = None,
     cookies: List[Cookie] = None,
     content_type: str = None,
-    body: Union[bytes, str] = b""
+    body: Body = b""
     ):
     if headers is None:
       headers = {}
@@ -27,3 +33,78 @@ class HTTPResponse:
     self.cookies = cookies
     self.content_type = content_type
     self.body = body
+
+  @property
+  def streaming(self) -> bool:
+    """
+    ボディをイテレータから少しずつ送信するかどうか
+    """
+    return not isinstance(self.body, (bytes, bytearray, memoryview, str))
+
+
+class FileResponse(HTTPResponse):
+  """
+  ファイルの内容をボディとするレスポンス
+  ボディをメモリに読み込まず、送信時にsendfileでファイルから直接送る
+  rangesを指定した場合は、その範囲だけを送る（複数の場合はmultipart/byteranges）
+  """
+  path: str
+  file_size: int
+  ranges: List[Tuple[int, int]]
+  # 送信する部分ごとの(前に付けるbytes, ファイル中の開始位置, バイト数)
+  parts: List[Tuple[bytes, int, int]]
+  # 最後の部分の後ろに付けるbytes
+  trailer: bytes
+
+  def __init__(
+    self,
+    path: str,
+    file_size: int,
+    ranges: List[Tuple[int, int]] = None,
+    status_code: int = 200,
+    headers: dict = None,
+    cookies: List[Cookie] = None,
+    content_type: str = None,
+    ):
+    super().__init__(status_code=status_code, headers=headers, cookies=cookies, content_type=content_type)
+    if ranges is None:
+      ranges = [(0, file_size)]
+
+    self.path = path
+    self.file_size = file_size
+    # (開始位置, 終了位置)のリスト。終了位置は含まない
+    self.ranges = ranges
+    self.parts = []
+    self.trailer = b""
+
+  def prepare(self) -> None:
+    """
+    Content-Typeが決まった後に、送信する部分を組み立てる
+    """
+    if len(self.ranges) == 1:
+      start, end = self.ranges[0]
+      if self.status_code == 206:
+        self.headers["Content-Range"] = f"bytes {start}-{end - 1}/{self.file_size}"
+      self.parts = [(b"", start, end - start)]
+      self.trailer = b""
+      return
+
+    # 複数の範囲は、multipart/byteranges として各部分にヘッダーを付けて送る
+    boundary = secrets.token_hex(16)
+    part_content_type = self.content_type
+    self.parts = []
+    for index, (start, end) in enumerate(self.ranges):
+      part_header = (
+        ("\r\n" if index else "")
+        + f"--{boundary}\r\n"
+        + f"Content-Type: {part_content_type}\r\n"
+        + f"Content-Range: bytes {start}-{end - 1}/{self.file_size}\r\n"
+        + "\r\n"
+      )
+      self.parts.append((part_header.encode(), start, end - start))
+    self.trailer = f"\r\n--{boundary}--\r\n".encode()
+    self.content_type = f"multipart/byteranges; boundary={boundary}"
+
+  @property
+  def content_length(self) -> int:
+    return sum(len(prefix) + count for prefix, _, count in self.parts) + len(self.trailer)
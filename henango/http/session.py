@@ -0,0 +1,323 @@
+import abc
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, List, Optional, Tuple
+
+import settings
+
+
+class SessionStore(abc.ABC):
+  """
+  セッションIDとセッションデータ(dict)の対応を保存するストア
+  """
+  @abc.abstractmethod
+  def load(self, session_key: str) -> Optional[dict]:
+    """
+    セッションデータを返す
+    存在しない場合や有効期限が切れている場合はNoneを返す
+    """
+
+  @abc.abstractmethod
+  def save(self, session_key: str, data: dict, ttl: float) -> None:
+    pass
+
+  @abc.abstractmethod
+  def delete(self, session_key: str) -> None:
+    pass
+
+
+class MemorySessionStore(SessionStore):
+  """
+  プロセスのメモリ上にセッションを保存するストア
+  有効期限(TTL)を過ぎたものは読み込み時に捨て、max_sizeを超えたら最も使われていないものから捨てる
+
+  多くのスレッドから同時に使われるので、セッションIDのハッシュでいくつかのシャードに分け、
+  シャードごとのロックとOrderedDictで管理する（どの操作もO(1)）
+  """
+  def __init__(self, max_size: int = 10000, shards: int = 16):
+    self.shard_max_size = max(1, max_size // shards)
+    self.shards: List[Tuple[threading.Lock, "OrderedDict[str, Tuple[float, dict]]"]] = [
+      (threading.Lock(), OrderedDict()) for _ in range(shards)
+    ]
+
+  def shard(self, session_key: str) -> Tuple[threading.Lock, "OrderedDict[str, Tuple[float, dict]]"]:
+    return self.shards[hash(session_key) % len(self.shards)]
+
+  def load(self, session_key: str) -> Optional[dict]:
+    lock, entries = self.shard(session_key)
+    with lock:
+      entry = entries.get(session_key)
+      if entry is None:
+        return None
+      expires_at, data = entry
+      if expires_at <= time.monotonic():
+        del entries[session_key]
+        return None
+      entries.move_to_end(session_key)
+    # 呼び出し側で書き換えてもストアに影響しないように、コピーを返す
+    return dict(data)
+
+  def save(self, session_key: str, data: dict, ttl: float) -> None:
+    lock, entries = self.shard(session_key)
+    with lock:
+      entries[session_key] = (time.monotonic() + ttl, dict(data))
+      entries.move_to_end(session_key)
+      while len(entries) > self.shard_max_size:
+        entries.popitem(last=False)
+
+  def delete(self, session_key: str) -> None:
+    lock, entries = self.shard(session_key)
+    with lock:
+      entries.pop(session_key, None)
+
+
+class SQLiteSessionStore(SessionStore):
+  """
+  SQLiteのファイルにセッションを保存するストア
+  サーバを再起動しても、prefork時に別のプロセスが処理しても、同じセッションを参照できる
+  sqlite3のコネクションはスレッド間で共有できないので、スレッドごとに開く
+  """
+  # saveの何回に1回、有効期限切れのセッションを削除するか
+  CLEANUP_INTERVAL = 1000
+
+  def __init__(self, path: str):
+    self.path = path
+    self.local = threading.local()
+    self.saves = 0
+    # SESSION_BACKENDが"sqlite"の場合にしか使わないので、ここで読み込む
+    import sqlite3
+    # 起動時（fork前）に開いたコネクションを子プロセスに引き継がないよう、ここでは使い捨てのコネクションを使う
+    connection = sqlite3.connect(self.path)
+    try:
+      with connection:
+        connection.execute(
+          "CREATE TABLE IF NOT EXISTS sessions (session_key TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+    finally:
+      connection.close()
+
+  def connection(self) -> "sqlite3.Connection":
+    connection = getattr(self.local, "connection", None)
+    if connection is None:
+      import sqlite3
+      connection = sqlite3.connect(self.path, timeout=5)
+      # 読み込みと書き込みが互いに待たないようにする
+      connection.execute("PRAGMA journal_mode=WAL")
+      self.local.connection = connection
+    return connection
+
+  def load(self, session_key: str) -> Optional[dict]:
+    row = self.connection().execute(
+      "SELECT data FROM sessions WHERE session_key = ? AND expires_at > ?", (session_key, time.time())
+    ).fetchone()
+    if row is None:
+      return None
+    return json.loads(row[0])
+
+  def save(self, session_key: str, data: dict, ttl: float) -> None:
+    now = time.time()
+    with self.connection() as connection:
+      connection.execute(
+        "INSERT OR REPLACE INTO sessions (session_key, data, expires_at) VALUES (?, ?, ?)",
+        (session_key, json.dumps(data), now + ttl),
+      )
+      self.saves += 1
+      if self.saves % self.CLEANUP_INTERVAL == 0:
+        connection.execute("DELETE FROM sessions WHERE expires_at <= ?", (now,))
+
+  def delete(self, session_key: str) -> None:
+    with self.connection() as connection:
+      connection.execute("DELETE FROM sessions WHERE session_key = ?", (session_key,))
+
+
+class Session:
+  """
+  リクエストに紐づくセッション
+  dictのように使える。Cookieの取得とストアからの読み込みは、初めて値を参照した時点で行う
+  （セッションを参照しないリクエストでは、Cookieヘッダーもパースしない）
+
+  Cookieには、セッションIDにHMACの署名を付けた値を保存する
+  署名が合わないCookieは無視し、新しいセッションとして扱う
+  storeとsecret_keyを省略した場合は、設定に応じたもの（get_session_store() / get_secret_key()）を使う
+  """
+  def __init__(
+    self,
+    get_cookie_value: Callable[[], Optional[str]],
+    store: Optional[SessionStore] = None,
+    secret_key: Optional[bytes] = None,
+  ):
+    # セッションIDのCookieの値を返す関数
+    self.get_cookie_value = get_cookie_value
+    self._store = store
+    self._secret_key = secret_key
+    self.session_key: Optional[str] = None
+    self.data: Optional[dict] = None
+    # 値が書き換えられたかどうか（書き換えられた場合だけストアに保存する）
+    self.modified = False
+
+  @property
+  def store(self) -> SessionStore:
+    if self._store is None:
+      self._store = get_session_store()
+    return self._store
+
+  @property
+  def secret_key(self) -> bytes:
+    if self._secret_key is None:
+      self._secret_key = get_secret_key()
+    return self._secret_key
+
+  def load(self) -> dict:
+    if self.data is None:
+      cookie_value = self.get_cookie_value()
+      self.session_key = self.unsign(cookie_value) if cookie_value else None
+      data = self.store.load(self.session_key) if self.session_key else None
+      if data is None:
+        self.session_key = None
+        data = {}
+      self.data = data
+    return self.data
+
+  @property
+  def loaded(self) -> bool:
+    return self.data is not None
+
+  def __getitem__(self, key: str) -> Any:
+    return self.load()[key]
+
+  def __setitem__(self, key: str, value: Any) -> None:
+    self.load()[key] = value
+    self.modified = True
+
+  def __delitem__(self, key: str) -> None:
+    del self.load()[key]
+    self.modified = True
+
+  def __contains__(self, key: str) -> bool:
+    return key in self.load()
+
+  def get(self, key: str, default: Any = None) -> Any:
+    return self.load().get(key, default)
+
+  def pop(self, key: str, default: Any = None) -> Any:
+    self.modified = self.modified or key in self.load()
+    return self.load().pop(key, default)
+
+  def clear(self) -> None:
+    self.load().clear()
+    self.modified = True
+
+  def cycle_key(self) -> None:
+    """
+    データを引き継いだまま、セッションIDを新しくする
+    ログイン時に呼ぶと、セッション固定攻撃を防げる
+    """
+    data = self.load()
+    if self.session_key:
+      self.store.delete(self.session_key)
+    self.session_key = None
+    self.data = data
+    self.modified = True
+
+  def save(self, ttl: float) -> Optional[str]:
+    """
+    セッションをストアに保存し、Cookieに設定する値を返す
+    データが空になった場合はストアから削除し、Noneを返す
+    """
+    data = self.load()
+    if not data:
+      if self.session_key:
+        self.store.delete(self.session_key)
+      self.session_key = None
+      return None
+
+    if self.session_key is None:
+      self.session_key = secrets.token_urlsafe(32)
+    self.store.save(self.session_key, data, ttl)
+    self.modified = False
+    return self.sign(self.session_key)
+
+  def sign(self, session_key: str) -> str:
+    signature = hmac.new(self.secret_key, session_key.encode(), hashlib.sha256).digest()
+    return f"{session_key}.{base64.urlsafe_b64encode(signature).decode().rstrip('=')}"
+
+  def unsign(self, cookie_value: str) -> Optional[str]:
+    session_key, _, _ = cookie_value.rpartition(".")
+    if session_key and hmac.compare_digest(self.sign(session_key), cookie_value):
+      return session_key
+    return None
+
+
+def create_session_store() -> SessionStore:
+  """
+  設定に応じてSessionStoreを生成する
+  """
+  backend = getattr(settings, "SESSION_BACKEND", "memory")
+  if backend == "sqlite":
+    return SQLiteSessionStore(getattr(settings, "SESSION_FILE", os.path.join(settings.BASE_DIR, "sessions.sqlite3")))
+  if backend == "memory":
+    return MemorySessionStore(max_size=getattr(settings, "SESSION_MAX_ENTRIES", 10000))
+  raise ValueError(f"不明なSESSION_BACKENDです: {backend}")
+
+
+def load_secret_key() -> bytes:
+  """
+  セッションIDの署名に使う鍵を返す
+  SECRET_KEYが設定されていない場合は、生成した鍵をSECRET_KEY_FILEに保存して使い回す
+  （プロセスごとに鍵が変わると、再起動やSIGHUPでの入れ替えで全てのセッションが無効になる）
+  ただし、SESSION_BACKENDが"memory"の場合はセッション自体がプロセスと共に消えるので、ファイルに保存しない
+  """
+  key = getattr(settings, "SECRET_KEY", None)
+  if key:
+    return key.encode()
+  if getattr(settings, "SESSION_BACKEND", "memory") == "memory":
+    return secrets.token_bytes(32)
+
+  path = getattr(settings, "SECRET_KEY_FILE", os.path.join(settings.BASE_DIR, ".secret_key"))
+  if not os.path.exists(path):
+    # 同時に起動した別のプロセスと競合しても同じ鍵になるよう、書き終えたファイルを存在しない場合だけリンクする
+    temporary_path = f"{path}.{os.getpid()}"
+    fd = os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+      f.write(secrets.token_hex(32))
+    try:
+      os.link(temporary_path, path)
+    except FileExistsError:
+      pass
+    finally:
+      os.unlink(temporary_path)
+
+  with open(path) as f:
+    return f.read().strip().encode()
+
+
+# 全てのWorkerで共有するストアと、セッションIDの署名に使う鍵
+# モジュールを読み込んだだけでファイルを作らないよう、初めてセッションを読み書きする時点で生成する
+session_store: Optional[SessionStore] = None
+secret_key: Optional[bytes] = None
+lock = threading.Lock()
+
+
+def get_session_store() -> SessionStore:
+  global session_store
+  if session_store is None:
+    with lock:
+      if session_store is None:
+        session_store = create_session_store()
+  return session_store
+
+
+def get_secret_key() -> bytes:
+  global secret_key
+  if secret_key is None:
+    with lock:
+      if secret_key is None:
+        secret_key = load_secret_key()
+  return secret_key
@@ -0,0 +1,115 @@
+import threading
+from typing import Dict, Optional
+
+import settings
+from henango.http.ratelimit import TokenBucketLimiter, retry_after
+from henango.server.metrics import metrics
+
+
+class ConnectionLimiter:
+  """
+  クライアント(IPアドレス)ごとの同時接続数を数え、上限を超える接続を断るクラス
+  接続のないクライアントの記録は残さないので、使うメモリは接続数に比例する
+  """
+  def __init__(self, max_connections: int):
+    self.max_connections = max_connections
+    self.counts: Dict[str, int] = {}
+    self.lock = threading.Lock()
+
+  def acquire(self, host: str) -> bool:
+    with self.lock:
+      count = self.counts.get(host, 0)
+      if count >= self.max_connections:
+        return False
+      self.counts[host] = count + 1
+      return True
+
+  def release(self, host: str) -> None:
+    with self.lock:
+      count = self.counts.pop(host, 0) - 1
+      if count > 0:
+        self.counts[host] = count
+
+  def __len__(self) -> int:
+    return len(self.counts)
+
+
+class AdmissionControl:
+  """
+  リクエストをパースしてviewを呼び出す前に、クライアント(IPアドレス)ごとに受け付けるかどうかを決めるクラス
+  1つのクライアントがWorkerやファイルディスクリプタを使い切って、他のクライアントを待たせることを防ぐ
+
+  - 同時接続数がMAX_CONNECTIONS_PER_CLIENTを超える接続は、acceptした時点で429を返して切断する
+  - リクエストの頻度がRATE_LIMIT_PER_CLIENTを超えたら、リクエストライン+ヘッダーを受信した時点で429を返して切断する
+  - ADMISSION_EXEMPT_CLIENTSのクライアントには、どちらも適用しない
+  """
+  def __init__(self):
+    max_connections = getattr(settings, "MAX_CONNECTIONS_PER_CLIENT", None)
+    rate = getattr(settings, "RATE_LIMIT_PER_CLIENT", None)
+    self.exempt_clients = frozenset(getattr(settings, "ADMISSION_EXEMPT_CLIENTS", ()))
+
+    self.connections: Optional[ConnectionLimiter] = ConnectionLimiter(max_connections) if max_connections else None
+    self.requests: Optional[TokenBucketLimiter] = None
+    if rate:
+      self.requests = TokenBucketLimiter(
+        rate,
+        getattr(settings, "RATE_LIMIT_BURST_PER_CLIENT", None) or rate,
+        getattr(settings, "RATE_LIMIT_MAX_ENTRIES", 100000),
+      )
+
+  def admit_connection(self, host: str) -> bool:
+    """
+    接続を受け付ける場合はTrueを返す
+    受け付けた接続は、切断した時にrelease_connectionを呼び出すこと
+    """
+    if self.connections is None or host in self.exempt_clients or self.connections.acquire(host):
+      return True
+    metrics.inc("henango_admission_rejected_total", (("reason", "connections"),))
+    return False
+
+  def release_connection(self, host: str) -> None:
+    if self.connections is not None and host not in self.exempt_clients:
+      self.connections.release(host)
+
+  def admit_request(self, host: str) -> float:
+    """
+    リクエストを受け付ける場合は0を、断る場合は次に受け付けられるまでの秒数を返す
+    """
+    if self.requests is None or host in self.exempt_clients:
+      return 0.0
+    wait = self.requests.acquire(host)
+    if wait:
+      metrics.inc("henango_admission_rejected_total", (("reason", "rate"),))
+      metrics.inc("henango_rate_limited_requests_total", (("scope", "client"),))
+    return wait
+
+  def collect_metrics(self) -> dict:
+    """
+    /metrics に出力するゲージの値を返す
+    """
+    return {
+      ("henango_admission_connected_clients", ()): len(self.connections) if self.connections is not None else 0,
+      ("henango_admission_rate_limit_buckets", ()): len(self.requests) if self.requests is not None else 0,
+    }
+
+
+def too_many_requests_response(wait: float = 1.0) -> bytes:
+  """
+  リクエストをパースする前に断る場合のレスポンス
+  ボディを読んでいないので、コネクションは維持しない
+  """
+  return (
+    b"HTTP/1.1 429 Too Many Requests\r\n"
+    b"Content-Length: 0\r\n"
+    b"Retry-After: " + retry_after(wait).encode() + b"\r\n"
+    b"Connection: Close\r\n"
+    b"\r\n"
+  )
+
+
+# 全てのWorkerで共有する
+admission_control = AdmissionControl()
+
+metrics.describe("henango_admission_rejected_total", "counter", "クライアントごとの上限を超えたため、パースする前に断った接続とリクエストの数")
+metrics.describe("henango_admission_connected_clients", "gauge", "接続中のクライアント(IPアドレス)の数")
+metrics.describe("henango_admission_rate_limit_buckets", "gauge", "頻度の上限を判定するために記録しているクライアントの数")
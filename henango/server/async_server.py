@@ -0,0 +1,433 @@
+import asyncio
+import concurrent.futures
+import signal
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Set, Tuple, Union
+
+import settings
+from henango.http.parser import HTTPRequestError, Recv, RequestTimeout, split_request_head
+from henango.http.request import HTTPRequest
+from henango.http.response import FileResponse, HTTPResponse
+from henango.server.admission import admission_control, too_many_requests_response
+from henango.server.capture import request_capture
+from henango.server.handler import HTTPHandler
+from henango.server.log import log_access, server_logger, setup_logging, stop_logging
+from henango.server.metrics import metrics, observe_request
+from henango.server.middleware import load_middleware
+from henango.server.pool import WorkerPool
+from henango.server.server import Server, inherit_server_socket, notify_ready, spawn_replacement
+from henango.server.startup import warm_up
+from henango.urls.resolver import URLResolver
+
+
+class AsyncServer(HTTPHandler):
+  """
+  asyncioのイベントループ上で動くWebサーバを表すクラス
+  1つのスレッドで多数のコネクションを扱い、
+  middlewareとコルーチンのviewはイベントループ上で、同期的なviewはスレッドプールで実行する
+
+  シグナルの扱いはServerと同じ
+  """
+
+  def serve(self, server_socket: socket.socket = None, supervised: bool = False):
+    """
+    サーバを起動する
+    server_socketが渡された場合は、新しく生成せずにそれを使って待ち受ける
+    supervisedがTrueの場合（preforkの子プロセス）は、SIGINTとSIGHUPを親プロセスに任せる
+    """
+
+    setup_logging()
+    server_logger.info("AsyncServer: サーバを起動します")
+
+    try:
+      # テンプレートのコンパイルなどを、リクエストを受け付ける前に済ませておく
+      warm_up()
+      asyncio.run(self.main(server_socket, supervised))
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server_logger.info("AsyncServer: サーバを停止します")
+      stop_logging()
+
+  async def main(self, server_socket: socket.socket = None, supervised: bool = False) -> None:
+    """
+    イベントループ上でコネクションの待ち受けを開始し、停止のシグナルを受け取るまで処理を続ける
+    """
+    # middlewareと同期的なviewを実行するスレッドプール
+    self.executor = ThreadPoolExecutor(max_workers=getattr(settings, "ASYNC_EXECUTOR_WORKERS", 16))
+    self.loop = asyncio.get_running_loop()
+    self.loop.set_default_executor(self.executor)
+    # middlewareでラップした、リクエストからレスポンスを生成するコルーチン関数
+    self.get_response = load_middleware(self.dispatch_async)
+
+    self.stopping = asyncio.Event()
+    self.draining = False
+    self.replacement = None
+    # 処理中のコネクションと、そのうち次のリクエストを待っているだけのもの
+    self.connections: Set[asyncio.Task] = set()
+    self.idle_connections: Set[asyncio.StreamWriter] = set()
+
+    metrics.add_collector(admission_control.collect_metrics)
+
+    if server_socket is None:
+      server_socket = inherit_server_socket() or Server().create_server_socket()
+    server = await asyncio.start_server(self.handle_client, sock=server_socket)
+
+    self.loop.add_signal_handler(signal.SIGTERM, self.handle_stop, signal.SIGTERM)
+    if not supervised:
+      self.loop.add_signal_handler(signal.SIGINT, self.handle_stop, signal.SIGINT)
+      self.loop.add_signal_handler(signal.SIGHUP, self.reload, server_socket)
+
+    # 入れ替え前のプロセスがあれば、受け付けを引き継いだことを知らせる
+    notify_ready()
+    await self.stopping.wait()
+
+    # 新しい接続は受け付けず、処理中のリクエストが終わるのを待つ
+    server_logger.info("AsyncServer: 接続の受け付けを停止し、処理中のリクエストの完了を待ちます")
+    server.close()
+    # acceptが済んでいて、まだhandle_clientが始まっていない接続も待つ対象にするため、少しだけイベントループを回す
+    await asyncio.sleep(0.1)
+    if not await self.drain(getattr(settings, "SHUTDOWN_TIMEOUT", 10)):
+      server_logger.warning("AsyncServer: 時間内に完了しなかったリクエストがあります connections: %d", len(self.connections))
+
+  def handle_stop(self, signum: int) -> None:
+    if self.stopping.is_set() and signum == signal.SIGINT:
+      # 停止中にもう一度Ctrl-Cが押された場合は、待たずに終了する
+      raise KeyboardInterrupt
+    self.stopping.set()
+
+  def reload(self, server_socket: socket.socket) -> None:
+    """
+    待ち受け中のsocketを引き継いだ新しいプロセスを起動する
+    新しいプロセスが受け付けを始めるまでは、このプロセスが処理を続ける
+    """
+    if self.replacement is not None and self.replacement.poll() is None:
+      server_logger.warning("AsyncServer: 新しいプロセスの起動中のため、SIGHUPを無視します")
+      return
+
+    self.replacement = spawn_replacement(server_socket)
+    server_logger.info("AsyncServer: 新しいプロセスを起動しました pid: %d", self.replacement.pid)
+
+  async def drain(self, timeout: float) -> bool:
+    """
+    処理中のコネクションが終わるのを待つ
+    次のリクエストを待っているだけのkeep-aliveのコネクションは、WorkerPool.IDLE_CLOSE_DELAY秒後に切断する
+    timeout秒以内に全て終わった場合はTrueを返す
+    """
+    self.draining = True
+    started = self.loop.time()
+    deadline = started + timeout
+    while self.connections:
+      now = self.loop.time()
+      if now >= deadline:
+        return False
+      # 処理中だったリクエストを終えてアイドル状態になったコネクションも切断できるよう、少しずつ待つ
+      if now - started >= WorkerPool.IDLE_CLOSE_DELAY:
+        for writer in list(self.idle_connections):
+          # 読み込みを待っているhandle_clientは、クライアントが切断した場合と同じように処理を終える
+          writer.close()
+      await asyncio.wait(self.connections, timeout=min(deadline - now, 0.1))
+    return True
+
+  async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """
+    1つのコネクションについて、リクエストを処理してレスポンスを送信する
+    keep-aliveが有効な間は、同じコネクションで続けてリクエストを処理する
+    """
+    loop = asyncio.get_running_loop()
+    body_timeout = getattr(settings, "REQUEST_BODY_TIMEOUT", 30)
+    send_timeout = getattr(settings, "SEND_TIMEOUT", 30)
+    max_requests = getattr(settings, "KEEP_ALIVE_MAX_REQUESTS", 100)
+    handled_requests = 0
+    request = None
+    # レスポンスを送信し始めたかどうか（送信し始めた後は、エラーレスポンスを送らずに切断する）
+    responding = False
+    client_address = writer.get_extra_info("peername")
+    # 受信済みでまだ処理していないデータ
+    buffer = b""
+    task = asyncio.current_task()
+
+    # クライアントの同時接続数が上限を超えた場合は、429を返して切断する
+    if not admission_control.admit_connection(client_address[0]):
+      writer.write(too_many_requests_response())
+      writer.close()
+      return
+
+    self.connections.add(task)
+    metrics.inc("henango_active_connections", (), 1)
+    try:
+      while True:
+        # クライアントから送られてきたデータのうち、リクエストライン+ヘッダーを取得する
+        # 受信済みのデータがないまま次のリクエストを待つ間は、停止時に切断してよいアイドル状態とする
+        if handled_requests > 0 and not buffer:
+          self.idle_connections.add(writer)
+        responding = False
+        try:
+          request_head, buffer = await self.receive_request_head(reader, buffer, first=handled_requests == 0)
+        finally:
+          self.idle_connections.discard(writer)
+        if request_head is None:
+          # クライアントが切断したか、何も送らないままタイムアウトした
+          break
+        handled_requests += 1
+        request = None
+
+        # 頻度の上限を超えたクライアントには、パースする前に429を返して切断する
+        wait = admission_control.admit_request(client_address[0])
+        if wait:
+          writer.write(too_many_requests_response(wait))
+          break
+
+        # フェーズごとの処理時間を計測する
+        # asyncioエンジンではacceptとWorkerの間にキューがないので、acceptは0とする
+        started = time.perf_counter()
+        timings = {"accept": 0.0}
+
+        # 設定で有効になっていれば、リクエストを記録する
+        if request_capture is not None:
+          request_capture.record(request_head, client_address)
+
+        # HTTPリクエストをパースする
+        # ボディは、viewが読み込んだ時点で受信する
+        request = self.parse_http_request(request_head)
+        request.client_address = client_address
+        request.stream = self.create_body_stream(request, self.create_recv(reader, body_timeout), buffer)
+        parsed = time.perf_counter()
+        timings["parse"] = parsed - started
+
+        # middlewareを通してURL解決とviewの呼び出しを行い、レスポンスを生成する
+        request.timings = timings
+        response = await self.get_response(request)
+
+        # viewが読み込まなかったボディを読み捨てる
+        # 少しずつ送るレスポンスは送信中にボディを読み込むかもしれないので、送信後に読み捨てる
+        if not request.stream.finished and not response.streaming:
+          await loop.run_in_executor(None, request.stream.drain)
+        viewed = time.perf_counter()
+        # middlewareの処理時間も含めて、URL解決以外をviewの時間とする
+        timings["view"] = viewed - parsed - timings.get("resolve", 0.0)
+
+        # コネクションを維持するかどうかを決める
+        keep_alive = (
+          self.should_keep_alive(request, response)
+          and handled_requests < max_requests
+          and not self.draining
+        )
+
+        # クライアントへレスポンスを送信する
+        response_parts = self.build_response_parts(response, request, keep_alive)
+        responding = True
+        # 送信し始めてからsend_timeout秒以内に送信しきれなければ、切断する
+        send_deadline = loop.time() + send_timeout
+        writer.writelines(response_parts)
+        await self.flush(writer, send_deadline)
+        sent_bytes = sum(len(part) for part in response_parts)
+        if not self.sends_body(request):
+          self.discard_body(response)
+        elif isinstance(response, FileResponse):
+          await self.send_file(writer, response, send_deadline)
+          sent_bytes += response.content_length
+        elif response.streaming:
+          sent_bytes += await self.send_stream(writer, response, request, send_deadline)
+        timings["send"] = time.perf_counter() - viewed
+
+        # 次のリクエストの先頭を取り出す
+        if not request.stream.finished:
+          await loop.run_in_executor(None, request.stream.drain)
+        buffer = request.stream.leftover()
+
+        log_access(request, client_address, response.status_code, sent_bytes, timings)
+        observe_request(request, response.status_code, timings)
+
+        if not keep_alive:
+          break
+
+    except HTTPRequestError as e:
+      # 不正なリクエストには、エラーレスポンスを返して切断する
+      # レスポンスを送信し始めていた場合は、そのまま切断する
+      error_response = self.build_error_response(e) if not responding else b""
+      log_access(request, client_address, e.status_code, len(error_response), {})
+      observe_request(request, e.status_code, {})
+      writer.write(error_response)
+
+    except asyncio.TimeoutError:
+      # クライアントがレスポンスを受信しないまま、時間が経った
+      metrics.inc("henango_timeouts_total", (("phase", "write"),))
+      server_logger.info("AsyncServer: レスポンスの送信がタイムアウトしました remote_address: %s", client_address)
+      writer.transport.abort()
+
+    except ConnectionError:
+      # レスポンスの送信中に、クライアントが切断した
+      server_logger.debug("AsyncServer: クライアントが切断しました remote_address: %s", client_address)
+
+    except Exception:
+      # リクエストの処理中に障害が発生した場合はコンソールにエラーログを出力し、
+      # 処理を続行する
+      server_logger.exception("リクエストの処理中にエラーが発生しました")
+
+    finally:
+      # 例外が発生した場合も、発生しなかった場合も、TCP通信のcloseは行う
+      writer.close()
+      try:
+        # 送信しきれていないデータは、send_timeout秒まで待ってから捨てる
+        await asyncio.wait_for(writer.wait_closed(), send_timeout)
+      except Exception:
+        writer.transport.abort()
+      metrics.inc("henango_active_connections", (), -1)
+      admission_control.release_connection(client_address[0])
+      self.connections.discard(task)
+
+  async def receive_request_head(self, reader: asyncio.StreamReader, buffer: bytes, first: bool = False) -> Tuple[Optional[bytes], bytes]:
+    """
+    bufferに続けてStreamReaderからデータを読み込み、リクエストライン+ヘッダー（空行まで）を切り出す
+    (リクエストライン+ヘッダー, 残りのbuffer)を返す
+    クライアントが切断した場合や、何も受信しないままタイムアウトした場合は、Noneを返す
+    タイムアウトはWorker.receive_request_headと同じ
+    """
+    max_header_size = getattr(settings, "MAX_REQUEST_HEADER_SIZE", 16 * 1024)
+    idle_timeout = getattr(settings, "KEEP_ALIVE_TIMEOUT", 5)
+    header_timeout = getattr(settings, "REQUEST_HEADER_TIMEOUT", 10)
+    deadline = self.loop.time() + header_timeout if first else None
+    searched = 0
+    while True:
+      result = split_request_head(buffer, max_header_size, searched)
+      if result is not None:
+        return result
+
+      if deadline is None and buffer:
+        deadline = self.loop.time() + header_timeout
+      timeout = idle_timeout if deadline is None else deadline - self.loop.time()
+
+      searched = len(buffer)
+      try:
+        chunk = await asyncio.wait_for(reader.read(4096), max(timeout, 0))
+      except asyncio.TimeoutError:
+        if not buffer:
+          # 何も送られてこなかったコネクションは、レスポンスを返さずに切断する
+          metrics.inc("henango_timeouts_total", (("phase", "idle"),))
+          return None, b""
+        metrics.inc("henango_timeouts_total", (("phase", "header"),))
+        raise RequestTimeout()
+      except ConnectionError:
+        return None, b""
+      if not chunk:
+        return None, b""
+      buffer += chunk
+
+  async def flush(self, writer: asyncio.StreamWriter, deadline: float) -> None:
+    """
+    書き込んだデータを送信しきるまで待つ
+    期限（loop.time()）までに送信しきれなかった場合は、asyncio.TimeoutErrorを送出する
+    """
+    await asyncio.wait_for(writer.drain(), max(deadline - self.loop.time(), 0))
+
+  async def send_stream(self, writer: asyncio.StreamWriter, response: HTTPResponse, request: HTTPRequest, deadline: float) -> int:
+    """
+    イテレータのボディを、得られた順に送信する
+    チャンクごとにdrainして、クライアントの受信が追いつかない間は次のチャンクを作らない
+    非同期イテレータはイベントループ上で、通常のイテレータはスレッドプールでたどる
+    （非同期イテレータからは、リクエストボディを読み込めない）
+    """
+    chunked = self.is_chunked(request)
+    sent_bytes = 0
+
+    async def write(chunk: Union[bytes, str]) -> int:
+      parts = self.encode_chunk(chunk, chunked)
+      writer.writelines(parts)
+      await self.flush(writer, deadline)
+      return sum(len(part) for part in parts)
+
+    body = response.body
+    if hasattr(body, "__aiter__"):
+      async for chunk in body:
+        sent_bytes += await write(chunk)
+    else:
+      iterator = iter(body)
+      done = object()
+      try:
+        while True:
+          chunk = await self.loop.run_in_executor(None, next, iterator, done)
+          if chunk is done:
+            break
+          sent_bytes += await write(chunk)
+      finally:
+        if hasattr(iterator, "close"):
+          iterator.close()
+
+    if chunked:
+      writer.write(self.LAST_CHUNK)
+      await self.flush(writer, deadline)
+      sent_bytes += len(self.LAST_CHUNK)
+    return sent_bytes
+
+  async def send_file(self, writer: asyncio.StreamWriter, response: FileResponse, deadline: float) -> None:
+    """
+    ファイルの内容を、メモリにコピーせずにsendfileで送信する
+    SENDFILE_CHUNK_SIZEずつ送信し、期限（loop.time()）までに送信しきれなかった場合は、
+    asyncio.TimeoutErrorを送出する
+    """
+    loop = asyncio.get_running_loop()
+    with open(response.path, "rb") as f:
+      for prefix, offset, count in response.parts:
+        if prefix:
+          writer.write(prefix)
+          await self.flush(writer, deadline)
+        end = offset + count
+        while offset < end:
+          size = min(self.SENDFILE_CHUNK_SIZE, end - offset)
+          await asyncio.wait_for(loop.sendfile(writer.transport, f, offset, size), max(deadline - loop.time(), 0))
+          offset += size
+    if response.trailer:
+      writer.write(response.trailer)
+      await self.flush(writer, deadline)
+
+  def create_recv(self, reader: asyncio.StreamReader, timeout: float) -> Recv:
+    """
+    スレッドプールで実行されるviewから、リクエストボディを受信するための関数を生成する
+    受信自体はイベントループ上で行う
+    最初に受信し始めてからtimeout秒経った場合は、RequestTimeoutを送出する
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None
+
+    def recv(size: int) -> bytes:
+      nonlocal deadline
+      if deadline is None:
+        deadline = time.monotonic() + timeout
+      future = asyncio.run_coroutine_threadsafe(reader.read(size), loop)
+      try:
+        return future.result(max(deadline - time.monotonic(), 0))
+      except concurrent.futures.TimeoutError:
+        future.cancel()
+        metrics.inc("henango_timeouts_total", (("phase", "body"),))
+        raise RequestTimeout()
+      except ConnectionError:
+        return b""
+
+    return recv
+
+  async def dispatch_async(self, request: HTTPRequest) -> HTTPResponse:
+    """
+    URL解決を行い、viewを呼び出してレスポンスを生成する
+    middlewareでラップされる、一番内側の処理
+    """
+    started = time.perf_counter()
+    view = URLResolver().resolve(request)
+    request.timings["resolve"] = time.perf_counter() - started
+    return await self.call_view_async(view, request)
+
+  async def call_view_async(self, view: Callable, request: HTTPRequest) -> HTTPResponse:
+    """
+    viewを呼び出してレスポンスを生成する
+    コルーチン関数のviewはイベントループ上で、同期的なviewはブロックしてもイベントループを止めないようにスレッドプールで実行する
+    """
+    loop = asyncio.get_running_loop()
+    if asyncio.iscoroutinefunction(view):
+      # コルーチンのviewからはボディをイベントループ上で受信できないので、
+      # 先にスレッドプールで読み込んでおく
+      if not request.stream.finished:
+        await loop.run_in_executor(None, lambda: request.body)
+      return await view(request)
+    return await loop.run_in_executor(None, view, request)
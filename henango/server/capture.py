@@ -0,0 +1,144 @@
+import json
+import os
+import random
+import re
+import time
+from collections import deque
+from threading import Condition, Thread
+from typing import List, Optional, Tuple
+
+import settings
+
+# 記録する前に値を伏せるリクエストヘッダー
+# 記録は/recent_requestsで誰でも見られるので、セッションIDや認証情報を残すと乗っ取りに使われてしまう
+REDACTED_HEADER_PATTERN = re.compile(rb"^(cookie|authorization|proxy-authorization)([ \t]*:)[^\r\n]*", re.IGNORECASE | re.MULTILINE)
+
+
+class RequestCapture:
+  """
+  受信したリクエストを記録するクラス
+  リクエストを処理するスレッドではメモリ上のリングバッファに積むだけにし、
+  ファイル（JSONL）への書き込みはバックグラウンドのスレッドでまとめて行う
+  書き込みが追いつかない場合は、古い記録から捨てる
+  """
+
+  def __init__(
+    self,
+    path: str,
+    sample_rate: float = 1.0,
+    buffer_size: int = 1024,
+    recent_size: int = 20,
+    max_bytes: int = 10 * 1024 * 1024,
+    backup_count: int = 3,
+  ):
+    self.path = path
+    self.sample_rate = sample_rate
+    self.max_bytes = max_bytes
+    self.backup_count = backup_count
+
+    # ファイルへの書き込み待ちの記録（リングバッファ）
+    self.pending = deque(maxlen=buffer_size)
+    # 直近のリクエスト（画面表示用）
+    self.recent = deque(maxlen=recent_size)
+    self.condition = Condition()
+    self.dropped = 0
+
+    # 書き込みを行うスレッドは、最初に記録する時に起動する
+    # (preforkモードでは、fork後の子プロセスごとに起動する必要がある)
+    self.writer: Optional[Thread] = None
+    self.writer_pid: Optional[int] = None
+
+  def record(self, request_head: bytes, client_address: Optional[Tuple[str, int]]) -> None:
+    """
+    リクエストを記録する
+    サンプリングの対象外となったリクエストは記録しない
+    """
+    if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+      return
+
+    entry = {
+      "time": time.time(),
+      "client": client_address[0] if client_address else None,
+      "request": REDACTED_HEADER_PATTERN.sub(rb"\1\2 [REDACTED]", request_head).decode("utf-8", "replace"),
+    }
+    self.recent.append(entry)
+
+    with self.condition:
+      if self.writer_pid != os.getpid():
+        self.start_writer()
+      if len(self.pending) == self.pending.maxlen:
+        self.dropped += 1
+      self.pending.append(entry)
+      self.condition.notify()
+
+  def start_writer(self) -> None:
+    self.writer = Thread(target=self.write_loop, name="RequestCaptureWriter", daemon=True)
+    self.writer_pid = os.getpid()
+    self.writer.start()
+
+  def recent_requests(self) -> List[dict]:
+    """
+    直近のリクエストを新しい順に返す
+    """
+    return list(reversed(self.recent))
+
+  def write_loop(self) -> None:
+    """
+    書き込み待ちの記録を、まとめてファイルに書き込み続ける
+    """
+    while True:
+      with self.condition:
+        while not self.pending:
+          self.condition.wait()
+        entries = list(self.pending)
+        self.pending.clear()
+
+      lines = "".join(json.dumps(entry, ensure_ascii=False) + "\n" for entry in entries)
+      try:
+        self.rotate_if_needed()
+        with open(self.path, "a", encoding="utf-8") as f:
+          f.write(lines)
+      except OSError:
+        # 記録に失敗しても、リクエストの処理には影響させない
+        self.dropped += len(entries)
+
+  def rotate_if_needed(self) -> None:
+    """
+    ファイルがmax_bytesを超えていれば、path.1, path.2, ... にずらして新しいファイルにする
+    """
+    try:
+      if os.path.getsize(self.path) < self.max_bytes:
+        return
+    except FileNotFoundError:
+      return
+
+    for index in range(self.backup_count - 1, 0, -1):
+      source = f"{self.path}.{index}"
+      if os.path.exists(source):
+        os.replace(source, f"{self.path}.{index + 1}")
+    if self.backup_count > 0:
+      os.replace(self.path, f"{self.path}.1")
+    else:
+      os.remove(self.path)
+
+
+def create_request_capture() -> Optional[RequestCapture]:
+  """
+  設定に応じてRequestCaptureを生成する
+  無効になっている場合はNoneを返す
+  """
+  if not getattr(settings, "REQUEST_CAPTURE_ENABLED", False):
+    return None
+
+  return RequestCapture(
+    path=getattr(settings, "REQUEST_CAPTURE_FILE", os.path.join(settings.BASE_DIR, "captured_requests.jsonl")),
+    sample_rate=getattr(settings, "REQUEST_CAPTURE_SAMPLE_RATE", 1.0),
+    buffer_size=getattr(settings, "REQUEST_CAPTURE_BUFFER_SIZE", 1024),
+    recent_size=getattr(settings, "REQUEST_CAPTURE_RECENT_SIZE", 20),
+    max_bytes=getattr(settings, "REQUEST_CAPTURE_MAX_BYTES", 10 * 1024 * 1024),
+    backup_count=getattr(settings, "REQUEST_CAPTURE_BACKUP_COUNT", 3),
+  )
+
+
+# 全てのWorkerで共有する（無効の場合はNone）
+request_capture = create_request_capture()
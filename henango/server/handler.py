@@ -0,0 +1,249 @@
+import inspect
+import time
+from typing import AsyncIterable, Callable, Iterable, Iterator, List, Union
+
+import settings
+from henango.http.cache import CachedResponse
+from henango.http.compression import prepare_body
+from henango.http.headers import CRLF, SERVER_HEADER, STATUS_LINES, date_header, reason_phrase, status_line, write_header_fields
+from henango.http.mime import MIME_TYPE
+from henango.http.parser import BodyStream, HTTPRequestError, Recv, RequestBodyTooLarge
+from henango.http.request import HTTPRequest
+from henango.http.response import FileResponse, HTTPResponse
+from henango.urls.resolver import URLResolver
+
+
+class HTTPHandler:
+  """
+  HTTPリクエストのパースとHTTPレスポンスの構築を行うクラス
+  WorkerとAsyncServerの両方から使う
+  """
+
+  # 拡張子とMIME Typeの対応
+  MIME_TYPE = MIME_TYPE
+
+  # ステータスコードとステータスラインの対応
+  STATUS_LINES = STATUS_LINES
+
+  # Connectionヘッダーの行（設定は起動時に決まるので、エンコード済みのものを使い回す）
+  CONNECTION_CLOSE = b"Connection: Close\r\n"
+  CONNECTION_KEEP_ALIVE = (
+    b"Connection: keep-alive\r\n"
+    b"Keep-Alive: timeout=%d, max=%d\r\n"
+    % (getattr(settings, "KEEP_ALIVE_TIMEOUT", 5), getattr(settings, "KEEP_ALIVE_MAX_REQUESTS", 100))
+  )
+  CONTENT_TYPE_HTML = b"Content-Type: text/html; charset=UTF-8\r\n"
+  TRANSFER_ENCODING_CHUNKED = b"Transfer-Encoding: chunked\r\n"
+  # チャンク形式のボディの終わり
+  LAST_CHUNK = b"0\r\n\r\n"
+  # ファイルをsendfileで送信する際に、1回で送る最大のバイト数
+  SENDFILE_CHUNK_SIZE = 256 * 1024
+
+  def should_keep_alive(self, request: HTTPRequest, response: HTTPResponse = None) -> bool:
+    """
+    リクエストの後もコネクションを維持するかどうかを判定する
+    HTTP/1.1ではデフォルトで維持し、HTTP/1.0ではデフォルトで切断する
+    """
+    # チャンク形式を使えない場合は、切断することでボディの終わりを伝える
+    if response is not None and response.streaming and not self.is_chunked(request):
+      return False
+
+    connection = (request.get_header("Connection") or "").lower()
+
+    if request.http_version == "HTTP/1.1":
+      return "close" not in connection
+    else:
+      return "keep-alive" in connection
+
+  def is_chunked(self, request: HTTPRequest) -> bool:
+    """
+    少しずつ送るレスポンスボディを、チャンク形式で送れるかどうか
+    """
+    return request.http_version == "HTTP/1.1"
+
+  def encode_chunk(self, chunk: Union[bytes, str], chunked: bool) -> List[bytes]:
+    """
+    イテレータから得たボディの一部を、送信するbytesのリストにする
+    空のチャンクはボディの終わりを意味してしまうので、空のリストを返す
+    """
+    if isinstance(chunk, str):
+      chunk = chunk.encode()
+    if not chunk:
+      return []
+    if chunked:
+      return [b"%x\r\n" % len(chunk), chunk, CRLF]
+    return [chunk]
+
+  @staticmethod
+  def iterate_body(body: Union[Iterable, AsyncIterable]) -> Iterator:
+    """
+    イテレータのボディを、通常のイテレータとして順にたどる
+    非同期イテレータの場合は、専用のイベントループを回して1つずつ取り出す
+    """
+    if not hasattr(body, "__aiter__"):
+      yield from body
+      return
+
+    # asyncioはスレッドプールのエンジンでは使わないことが多いので、必要になってから読み込む
+    import asyncio
+    loop = asyncio.new_event_loop()
+    iterator = body.__aiter__()
+    try:
+      while True:
+        try:
+          yield loop.run_until_complete(iterator.__anext__())
+        except StopAsyncIteration:
+          break
+    finally:
+      if hasattr(iterator, "aclose"):
+        loop.run_until_complete(iterator.aclose())
+      loop.close()
+
+  def dispatch(self, request: HTTPRequest) -> HTTPResponse:
+    """
+    URL解決を行い、viewを呼び出してレスポンスを生成する
+    middlewareでラップされる、一番内側の処理
+    """
+    started = time.perf_counter()
+    view = URLResolver().resolve(request)
+    request.timings["resolve"] = time.perf_counter() - started
+    return self.call_view(view, request)
+
+  def call_view(self, view: Callable, request: HTTPRequest) -> HTTPResponse:
+    """
+    viewを呼び出してレスポンスを生成する
+    viewがコルーチン関数の場合は、その場でイベントループを回して実行する
+    """
+    if inspect.iscoroutinefunction(view):
+      import asyncio
+      return asyncio.run(view(request))
+    return view(request)
+
+  def parse_http_request(self, request_head: bytes) -> HTTPRequest:
+    """
+    HTTPリクエストのリクエストライン+リクエストヘッダー（空行まで）から、HTTPRequestを生成する
+    ここでパースするのはリクエストラインだけで、
+    リクエストヘッダーはbytesのまま渡し、参照された時点でパースする
+    リクエストボディは、create_body_streamで別途ストリームとして設定する
+    """
+    # リクエストライン（１行目）とリクエストヘッダー（２行目〜空行）に分割する
+    request_line, _, request_header = request_head[:-4].partition(b"\r\n")
+
+    # リクエストラインを文字列に変換してパースする
+    try:
+      method, path, http_version = request_line.decode().split(" ")
+    except (ValueError, UnicodeDecodeError):
+      raise HTTPRequestError()
+
+    return HTTPRequest(path, method, http_version, raw_headers=request_header)
+
+  def create_body_stream(self, request: HTTPRequest, recv: Recv, buffer: bytes) -> BodyStream:
+    """
+    リクエストヘッダーに応じて、リクエストボディを読み込むストリームを生成する
+    bufferには、リクエストヘッダーの後ろに続けて受信済みのデータを渡す
+    """
+    max_body_size = getattr(settings, "MAX_REQUEST_BODY_SIZE", 10 * 1024 * 1024)
+
+    transfer_encoding = (request.get_header("Transfer-Encoding") or "").lower()
+    if "chunked" in transfer_encoding:
+      return BodyStream(recv, buffer, chunked=True, max_size=max_body_size)
+
+    content_length = request.get_header("Content-Length") or "0"
+    if not content_length.isdigit():
+      raise HTTPRequestError()
+    if int(content_length) > max_body_size:
+      # ボディを受信する前に断る
+      raise RequestBodyTooLarge()
+
+    return BodyStream(recv, buffer, int(content_length), max_size=max_body_size)
+
+  def build_error_response(self, error: HTTPRequestError) -> bytes:
+    """
+    不正なリクエストに対するレスポンスを構築する
+    リクエストを最後まで読めていない可能性があるので、コネクションは切断する
+    """
+    body = f"<html><body><h1>{error.status_code} {reason_phrase(error.status_code)}</h1></body></html>".encode()
+    buffer = bytearray(status_line(error.status_code))
+    buffer += date_header.get()
+    buffer += SERVER_HEADER
+    buffer += b"Content-Length: %d\r\n" % len(body)
+    buffer += self.CONTENT_TYPE_HTML
+    buffer += self.CONNECTION_CLOSE
+    buffer += CRLF
+    buffer += body
+    return bytes(buffer)
+
+  def build_response_head(self, response: HTTPResponse, request: HTTPRequest, keep_alive: bool = False) -> bytearray:
+    """
+    レスポンスライン+レスポンスヘッダー+空行を構築する
+    毎回同じになる行はエンコード済みのものを使い、bytearrayへ直接書き込む
+    """
+
+    # ファイルを送るレスポンスは、Content-Typeが決まった後に送信する部分を組み立てる
+    if isinstance(response, FileResponse):
+      response.prepare()
+      content_length = response.content_length
+    elif response.streaming:
+      content_length = None
+    else:
+      content_length = len(response.body)
+
+    # 基本ヘッダーを生成
+    buffer = bytearray(status_line(response.status_code))
+    buffer += date_header.get()
+    buffer += SERVER_HEADER
+    if response.streaming:
+      # 長さが分からないので、HTTP/1.1ではチャンク形式で送る（HTTP/1.0では送信後に切断する）
+      if self.is_chunked(request):
+        buffer += self.TRANSFER_ENCODING_CHUNKED
+    # 304はボディを持たないので、Content-Lengthを付けない
+    elif response.status_code != 304:
+      buffer += b"Content-Length: %d\r\n" % content_length
+    buffer += self.CONNECTION_KEEP_ALIVE if keep_alive else self.CONNECTION_CLOSE
+    # キャッシュから返すレスポンスは、エンコード済みのものをそのまま使う
+    if isinstance(response, CachedResponse):
+      buffer += response.header_fields
+    else:
+      write_header_fields(buffer, response)
+
+    buffer += CRLF
+    return buffer
+
+  def build_response_parts(self, response: HTTPResponse, request: HTTPRequest, keep_alive: bool = False) -> List[bytes]:
+    """
+    レスポンスを(ヘッダー, ボディ)のリストとして構築する
+    ボディをヘッダーの後ろへコピーせずに、sendmsg/writelinesでまとめて送信できる
+    """
+    # キャッシュから返すレスポンスは、ボディの変換が済んでいる
+    # 圧縮はCompressionMiddlewareで行う
+    if not isinstance(response, CachedResponse):
+      prepare_body(response, request, compress=False)
+
+    head = self.build_response_head(response, request, keep_alive)
+    # イテレータのボディは、呼び出し側で少しずつ送信する
+    if response.body and not response.streaming and self.sends_body(request):
+      return [head, response.body]
+    return [head]
+
+  @staticmethod
+  def sends_body(request: HTTPRequest) -> bool:
+    """
+    レスポンスボディを送信するかどうか
+    HEADへのレスポンスは、GETと同じヘッダー（Content-Lengthを含む）だけを送り、ボディは送らない
+    keep-aliveで次のレスポンスと同じコネクションで送るので、ボディを送るとクライアントは次のレスポンスの先頭として読んでしまう
+    """
+    return request.method != "HEAD"
+
+  @staticmethod
+  def discard_body(response: HTTPResponse) -> None:
+    """
+    送信しないイテレータのボディを閉じる（ジェネレータのfinallyなどを実行させる）
+    """
+    if response.streaming and hasattr(response.body, "close"):
+      response.body.close()
+
+  def build_response_bytes(self, response: HTTPResponse, request: HTTPRequest, keep_alive: bool = False) -> bytes:
+    """
+    レスポンス全体をbytesとして構築する
+    """
+    return b"".join(self.build_response_parts(response, request, keep_alive))
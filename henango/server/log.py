@@ -0,0 +1,142 @@
+import json
+import logging
+import logging.handlers
+import os
+import sys
+import time
+from queue import SimpleQueue
+from typing import Dict, Optional, Tuple
+
+import settings
+from henango.http.request import HTTPRequest
+
+# サーバの動作に関するログ
+server_logger = logging.getLogger("henango.server")
+# アクセスログ（1リクエストにつき1行）
+access_logger = logging.getLogger("henango.access")
+
+# 計測するフェーズ
+# accept: acceptしてからWorkerが処理を始めるまで（keep-aliveの2件目以降は0）
+# parse: リクエストヘッダーのパース / resolve: URL解決 / view: viewの実行 / send: レスポンスの構築と送信
+PHASES = ("accept", "parse", "resolve", "view", "send")
+
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+  """
+  ログレコードをそのままキューに積むハンドラ
+  メッセージのフォーマットは、リクエストを処理するスレッドではなく書き込み用のスレッドで行う
+  """
+
+  def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+    return record
+
+
+class CombinedLogFormatter(logging.Formatter):
+  """
+  Apacheのcombined形式に、フェーズごとの処理時間（ミリ秒）を付け足した形式
+  """
+
+  def format(self, record: logging.LogRecord) -> str:
+    access = record.access
+    timestamp = time.strftime("%d/%b/%Y:%H:%M:%S %z", time.localtime(record.created))
+    timings = " ".join(f"{phase}={access['timings'].get(phase, 0.0) * 1000:.3f}" for phase in PHASES)
+    return (
+      f'{access["client"] or "-"} - - [{timestamp}] '
+      f'"{access["method"]} {access["path"]} {access["http_version"]}" {access["status"]} {access["bytes"]} '
+      f'"{access["referer"] or "-"}" "{access["user_agent"] or "-"}" {timings}'
+    )
+
+
+class JSONLogFormatter(logging.Formatter):
+  """
+  1行に1つのJSONを出力する形式
+  """
+
+  def format(self, record: logging.LogRecord) -> str:
+    access = dict(record.access)
+    access["time"] = record.created
+    access["timings"] = {phase: round(seconds * 1000, 3) for phase, seconds in access["timings"].items()}
+    return json.dumps(access, ensure_ascii=False)
+
+
+# 設定を行ったプロセスのpid（fork後の子プロセスでは設定し直す）
+configured_pid: Optional[int] = None
+listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging() -> None:
+  """
+  ログの出力先を設定する
+  ログはキューに積むだけにして、実際の書き込みはバックグラウンドのスレッドで行う
+  """
+  global configured_pid, listener
+  if configured_pid == os.getpid():
+    return
+  configured_pid = os.getpid()
+
+  server_handler = logging.StreamHandler(sys.stderr)
+  server_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+
+  access_log_file = getattr(settings, "ACCESS_LOG_FILE", None)
+  if access_log_file:
+    access_handler = logging.FileHandler(access_log_file, encoding="utf-8")
+  else:
+    access_handler = logging.StreamHandler(sys.stdout)
+  if getattr(settings, "ACCESS_LOG_FORMAT", "combined") == "json":
+    access_handler.setFormatter(JSONLogFormatter())
+  else:
+    access_handler.setFormatter(CombinedLogFormatter())
+  # アクセスログ用のハンドラは、アクセスログだけを書き込む
+  access_handler.addFilter(lambda record: record.name == access_logger.name)
+  server_handler.addFilter(lambda record: record.name != access_logger.name)
+
+  queue = SimpleQueue()
+  queue_handler = DeferredQueueHandler(queue)
+  for logger in (server_logger, access_logger):
+    logger.handlers = [queue_handler]
+    logger.propagate = False
+
+  server_logger.setLevel(getattr(settings, "LOG_LEVEL", "INFO"))
+  access_logger.setLevel(logging.INFO if getattr(settings, "ACCESS_LOG_ENABLED", True) else logging.CRITICAL + 1)
+
+  # fork前の親プロセスのlistenerは子プロセスでは動いていないので、新しく起動する
+  listener = logging.handlers.QueueListener(queue, server_handler, access_handler, respect_handler_level=True)
+  listener.start()
+
+
+def stop_logging() -> None:
+  """
+  キューに残っているログを書き込んでから、書き込み用のスレッドを停止する
+  """
+  global configured_pid, listener
+  if listener is not None and configured_pid == os.getpid():
+    listener.stop()
+  listener = None
+  configured_pid = None
+
+
+def log_access(
+  request: Optional[HTTPRequest],
+  client_address: Optional[Tuple[str, int]],
+  status: int,
+  sent_bytes: int,
+  timings: Dict[str, float],
+) -> None:
+  """
+  アクセスログを記録する
+  アクセスログが無効の場合は何もしない
+  """
+  if not access_logger.isEnabledFor(logging.INFO):
+    return
+
+  access_logger.info("access", extra={"access": {
+    "client": client_address[0] if client_address else None,
+    "method": request.method if request else "-",
+    "path": request.full_path if request else "-",
+    "http_version": request.http_version if request else "-",
+    "status": status,
+    "bytes": sent_bytes,
+    "referer": request.get_header("Referer") if request else None,
+    "user_agent": request.get_header("User-Agent") if request else None,
+    "timings": timings,
+  }})
@@ -0,0 +1,190 @@
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, List, Optional, Tuple
+
+from henango.http.request import HTTPRequest
+
+# ラベルの組（ex: (("route", "/now"), ("status", "200"))）
+Labels = Tuple[Tuple[str, str], ...]
+
+# メトリクスのラベルにそのまま使うHTTPメソッド
+# それ以外はクライアントが任意の文字列を送れるので、"other"にまとめてラベルの組み合わせが増え続けないようにする
+KNOWN_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "DELETE", "CONNECT", "OPTIONS", "TRACE", "PATCH"))
+
+# ヒストグラムのバケットの上限（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Shard:
+  """
+  1つのスレッドだけが更新するメトリクスの値
+  スレッドごとに別のShardへ書き込むことで、更新時にロックを取らずに済ませる
+  """
+
+  def __init__(self):
+    self.counters: Dict[Tuple[str, Labels], float] = {}
+    # (メトリクス名, ラベル)と[バケットごとの件数..., +Infのバケットの件数, 合計, 件数]の対応
+    self.histograms: Dict[Tuple[str, Labels], List[float]] = {}
+
+
+class Metrics:
+  """
+  カウンター・ゲージ・ヒストグラムを集計し、Prometheusのテキスト形式で出力するクラス
+  値はスレッドごとのShardに記録し、出力する時にだけ合算する
+  """
+
+  def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.local = threading.local()
+    self.shards: List[Shard] = []
+    # Shardを追加する時だけ使うロック
+    self.shards_lock = threading.Lock()
+    self.help: Dict[str, Tuple[str, str]] = {}
+    # 出力する時に値を取得するゲージ
+    self.collectors: List[Callable[[], Dict[Tuple[str, Labels], float]]] = []
+
+  def shard(self) -> Shard:
+    shard = getattr(self.local, "shard", None)
+    if shard is None:
+      shard = Shard()
+      self.local.shard = shard
+      with self.shards_lock:
+        self.shards.append(shard)
+    return shard
+
+  def describe(self, name: str, metric_type: str, help_text: str) -> None:
+    self.help[name] = (metric_type, help_text)
+
+  def inc(self, name: str, labels: Labels = (), value: float = 1.0) -> None:
+    """
+    カウンター（またはゲージ）に値を加える
+    """
+    counters = self.shard().counters
+    key = (name, labels)
+    counters[key] = counters.get(key, 0.0) + value
+
+  def observe(self, name: str, labels: Labels, value: float) -> None:
+    """
+    ヒストグラムに値を記録する
+    """
+    histograms = self.shard().histograms
+    key = (name, labels)
+    histogram = histograms.get(key)
+    if histogram is None:
+      histogram = [0.0] * (len(self.buckets) + 3)
+      histograms[key] = histogram
+    # 最大のバケットを超える値は、+Infのバケット（len(self.buckets)番目）に入る
+    histogram[bisect_left(self.buckets, value)] += 1
+    histogram[-2] += value
+    histogram[-1] += 1
+
+  def add_collector(self, collector: Callable[[], Dict[Tuple[str, Labels], float]]) -> None:
+    """
+    出力する時に呼び出され、ゲージの値を返す関数を登録する
+    """
+    self.collectors.append(collector)
+
+  def collect(self) -> Tuple[Dict[Tuple[str, Labels], float], Dict[Tuple[str, Labels], List[float]]]:
+    """
+    全てのShardの値を合算する
+    """
+    with self.shards_lock:
+      shards = list(self.shards)
+
+    counters: Dict[Tuple[str, Labels], float] = {}
+    histograms: Dict[Tuple[str, Labels], List[float]] = {}
+    for shard in shards:
+      for key, value in list(shard.counters.items()):
+        counters[key] = counters.get(key, 0.0) + value
+      for key, values in list(shard.histograms.items()):
+        total = histograms.setdefault(key, [0.0] * len(values))
+        for index, value in enumerate(list(values)):
+          total[index] += value
+
+    for collector in self.collectors:
+      counters.update(collector())
+    return counters, histograms
+
+  def render(self) -> str:
+    """
+    Prometheusのテキスト形式で出力する
+    """
+    counters, histograms = self.collect()
+    lines = []
+
+    names = sorted({name for name, _ in counters} | {name for name, _ in histograms})
+    for name in names:
+      if name in self.help:
+        metric_type, help_text = self.help[name]
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {metric_type}")
+
+      for (metric_name, labels), value in sorted(counters.items()):
+        if metric_name == name:
+          lines.append(f"{name}{format_labels(labels)} {format_value(value)}")
+
+      for (metric_name, labels), values in sorted(histograms.items()):
+        if metric_name != name:
+          continue
+        cumulative = 0.0
+        for bucket, count in zip(self.buckets, values):
+          cumulative += count
+          lines.append(f"{name}_bucket{format_labels(labels + (('le', format_value(bucket)),))} {format_value(cumulative)}")
+        lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {format_value(values[-1])}")
+        lines.append(f"{name}_sum{format_labels(labels)} {values[-2]}")
+        lines.append(f"{name}_count{format_labels(labels)} {format_value(values[-1])}")
+
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels: Labels) -> str:
+  if not labels:
+    return ""
+  return "{" + ",".join(f'{key}="{escape_label_value(value)}"' for key, value in labels) + "}"
+
+
+def escape_label_value(value: str) -> str:
+  return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value: float) -> str:
+  return str(int(value)) if float(value).is_integer() else repr(value)
+
+
+# 全てのスレッドで共有する
+metrics = Metrics()
+metrics.describe("henango_requests_total", "counter", "処理したリクエストの数")
+metrics.describe("henango_request_duration_seconds", "histogram", "リクエストの処理にかかった時間")
+metrics.describe("henango_resolve_duration_seconds", "histogram", "URL解決にかかった時間")
+metrics.describe("henango_view_duration_seconds", "histogram", "viewの実行にかかった時間")
+metrics.describe("henango_render_duration_seconds", "histogram", "テンプレートのレンダリングにかかった時間")
+metrics.describe("henango_active_connections", "gauge", "処理中のコネクションの数")
+metrics.describe("henango_timeouts_total", "counter", "タイムアウトで切断したコネクションの数（phase: idle / header / body / write）")
+metrics.describe("henango_pool_size", "gauge", "Workerスレッドの数")
+metrics.describe("henango_pool_busy_workers", "gauge", "コネクションを処理中のWorkerスレッドの数")
+metrics.describe("henango_pool_queue_length", "gauge", "Workerの処理待ちの接続の数")
+metrics.describe("henango_pool_saturation", "gauge", "Workerスレッドのうち、コネクションを処理中のものの割合")
+metrics.describe("henango_pool_accepted_connections_total", "counter", "キューに積んだ接続の数")
+metrics.describe("henango_pool_rejected_connections_total", "counter", "キューが一杯のため503を返した接続の数")
+metrics.describe("henango_pool_queue_wait_seconds", "histogram", "接続がキューで待った時間")
+
+
+def observe_request(request: Optional[HTTPRequest], status: int, timings: Dict[str, float]) -> None:
+  """
+  リクエスト1件分のメトリクスを記録する
+  """
+  route = getattr(request, "route", None) or "-"
+  if request is None:
+    method = "-"
+  elif request.method in KNOWN_METHODS:
+    method = request.method
+  else:
+    method = "other"
+
+  metrics.inc("henango_requests_total", (("route", route), ("method", method), ("status", str(status))))
+  if timings:
+    metrics.observe("henango_request_duration_seconds", (("route", route),), sum(timings.values()) - timings.get("accept", 0.0))
+  if "resolve" in timings:
+    metrics.observe("henango_resolve_duration_seconds", (("route", route),), timings["resolve"])
+  if "view" in timings:
+    metrics.observe("henango_view_duration_seconds", (("route", route),), timings["view"])
@@ -0,0 +1,215 @@
+import importlib
+import inspect
+import time
+from typing import Awaitable, Callable, List
+
+import settings
+from henango.http.cache import CachedResponse
+from henango.http.compression import prepare_body
+from henango.http.cookie import Cookie
+from henango.http.parser import HTTPRequestError
+from henango.http.request import HTTPRequest
+from henango.http.response import HTTPResponse
+from henango.http.session import Session
+from henango.server.log import server_logger
+
+# リクエストを受け取ってレスポンスを返す関数（viewや、middlewareでラップしたもの）
+GetResponse = Callable[[HTTPRequest], HTTPResponse]
+# AsyncServerで使う、GetResponseのコルーチン関数版
+AsyncGetResponse = Callable[[HTTPRequest], Awaitable[HTTPResponse]]
+
+
+class Middleware:
+  """
+  URL解決〜viewの呼び出しの前後に処理を挟むクラスの基底クラス
+  __call__をオーバーライドし、self.get_responseを呼び出して次のmiddleware（最後はview）へ処理を渡す
+  get_responseを呼び出さずにレスポンスを返せば、以降の処理を省略できる
+
+  AsyncServerでは、__call__の代わりにacallがイベントループ上で呼び出され、self.get_responseはコルーチン関数になる
+  acallをオーバーライドしていないmiddlewareは、__call__をスレッドプールで実行する（load_middlewareを参照）
+
+  CachedResponseは複数のリクエストで共有しているので、書き換えてはいけない
+  """
+  def __init__(self, get_response: GetResponse):
+    self.get_response = get_response
+
+  def __call__(self, request: HTTPRequest) -> HTTPResponse:
+    return self.get_response(request)
+
+  async def acall(self, request: HTTPRequest) -> HTTPResponse:
+    return await self.get_response(request)
+
+
+class ExceptionMiddleware(Middleware):
+  """
+  viewで発生した例外をログに出力し、500のレスポンスを返す
+  不正なリクエストによる例外は、コネクションを切断するためにサーバへそのまま伝える
+  """
+  def __call__(self, request: HTTPRequest) -> HTTPResponse:
+    try:
+      return self.get_response(request)
+    except HTTPRequestError:
+      raise
+    except Exception:
+      server_logger.exception("viewの実行中にエラーが発生しました path: %s", request.path)
+      return self.internal_server_error()
+
+  async def acall(self, request: HTTPRequest) -> HTTPResponse:
+    try:
+      return await self.get_response(request)
+    except HTTPRequestError:
+      raise
+    except Exception:
+      server_logger.exception("viewの実行中にエラーが発生しました path: %s", request.path)
+      return self.internal_server_error()
+
+  @staticmethod
+  def internal_server_error() -> HTTPResponse:
+    return HTTPResponse(
+      status_code=500,
+      content_type="text/html; charset=UTF-8",
+      body=b"<html><body><h1>500 Internal Server Error</h1></body></html>",
+    )
+
+
+class SessionMiddleware(Middleware):
+  """
+  request.sessionを設定し、viewが書き換えた場合はストアに保存してセッションIDのCookieを返す
+  """
+  def __init__(self, get_response: GetResponse):
+    super().__init__(get_response)
+    self.cookie_name = getattr(settings, "SESSION_COOKIE_NAME", "sessionid")
+    self.ttl = getattr(settings, "SESSION_TTL", 1209600)
+
+  def __call__(self, request: HTTPRequest) -> HTTPResponse:
+    request.session = self.create_session(request)
+    response = self.get_response(request)
+
+    if request.session.modified:
+      self.save(request, response)
+    return response
+
+  async def acall(self, request: HTTPRequest) -> HTTPResponse:
+    import asyncio
+
+    request.session = self.create_session(request)
+    response = await self.get_response(request)
+
+    if request.session.modified:
+      # ストアへの書き込みでイベントループを止めないように、スレッドプールで実行する
+      await asyncio.get_running_loop().run_in_executor(None, self.save, request, response)
+    return response
+
+  def create_session(self, request: HTTPRequest) -> Session:
+    """
+    リクエストに紐づくセッションを生成する
+    Cookieのパースとセッションの読み込みは、viewがセッションを参照した時点で行う
+    """
+    return Session(lambda: request.cookies.get(self.cookie_name))
+
+  def save(self, request: HTTPRequest, response: HTTPResponse) -> None:
+    """
+    セッションをストアに保存し、セッションIDのCookieをレスポンスに付ける
+    """
+    cookie_value = request.session.save(self.ttl)
+    if cookie_value is None:
+      # セッションが空になった場合は、Cookieも削除する
+      response.cookies.append(Cookie(name=self.cookie_name, value="", max_age=0, path="/", http_only=True))
+    else:
+      response.cookies.append(Cookie(name=self.cookie_name, value=cookie_value, max_age=int(self.ttl), path="/", http_only=True))
+
+
+class CompressionMiddleware(Middleware):
+  """
+  クライアントが対応していれば、レスポンスボディを圧縮する
+  """
+  def __call__(self, request: HTTPRequest) -> HTTPResponse:
+    response = self.get_response(request)
+    if not isinstance(response, CachedResponse):
+      prepare_body(response, request)
+    return response
+
+  async def acall(self, request: HTTPRequest) -> HTTPResponse:
+    import asyncio
+
+    response = await self.get_response(request)
+    if isinstance(response, CachedResponse):
+      return response
+    if not response.streaming and len(response.body) >= getattr(settings, "COMPRESSION_MIN_SIZE", 1024):
+      # 圧縮でイベントループを止めないように、スレッドプールで実行する
+      await asyncio.get_running_loop().run_in_executor(None, prepare_body, response, request)
+    else:
+      # COMPRESSION_MIN_SIZEより小さいボディと、イテレータのボディは圧縮されない
+      # Content-Typeを決めるなどの軽い処理だけなので、イベントループ上で行う
+      prepare_body(response, request)
+    return response
+
+
+class ServerTimingMiddleware(Middleware):
+  """
+  以降の処理にかかった時間を、Server-Timingヘッダーでクライアントへ伝える
+  """
+  def __call__(self, request: HTTPRequest) -> HTTPResponse:
+    started = time.perf_counter()
+    response = self.get_response(request)
+    if not isinstance(response, CachedResponse):
+      response.headers["Server-Timing"] = f"app;dur={(time.perf_counter() - started) * 1000:.3f}"
+    return response
+
+  async def acall(self, request: HTTPRequest) -> HTTPResponse:
+    started = time.perf_counter()
+    response = await self.get_response(request)
+    if not isinstance(response, CachedResponse):
+      response.headers["Server-Timing"] = f"app;dur={(time.perf_counter() - started) * 1000:.3f}"
+    return response
+
+
+def import_string(path: str) -> type:
+  """
+  "henango.server.middleware.SessionMiddleware" のようなパスから、クラスを取得する
+  """
+  module_name, _, class_name = path.rpartition(".")
+  return getattr(importlib.import_module(module_name), class_name)
+
+
+def load_middleware(get_response: GetResponse, paths: List[str] = None) -> GetResponse:
+  """
+  get_responseを、設定されたmiddlewareで内側から順にラップした関数を返す
+  起動時に一度だけ組み立てておくことで、リクエストごとにmiddlewareの一覧をたどらずに済む
+
+  get_responseがコルーチン関数の場合（AsyncServer）は、各middlewareのacallをつないだコルーチン関数を返す
+  この場合は、イベントループ上で呼び出すこと
+  """
+  if paths is None:
+    paths = getattr(settings, "MIDDLEWARE", [])
+
+  asynchronous = inspect.iscoroutinefunction(get_response)
+  for path in reversed(paths):
+    middleware_class = import_string(path)
+    if not asynchronous:
+      get_response = middleware_class(get_response)
+    elif middleware_class.acall is Middleware.acall and middleware_class.__call__ is not Middleware.__call__:
+      get_response = wrap_sync_middleware(middleware_class, get_response)
+    else:
+      get_response = middleware_class(get_response).acall
+  return get_response
+
+
+def wrap_sync_middleware(middleware_class: type, get_response: AsyncGetResponse) -> AsyncGetResponse:
+  """
+  __call__だけを実装したmiddlewareを、AsyncServerのチェーンに組み込む
+  middlewareはスレッドプールで実行し、そこから呼び出す内側の処理はイベントループ上で実行して完了を待つ
+  """
+  import asyncio
+
+  loop = asyncio.get_running_loop()
+
+  def inner(request: HTTPRequest) -> HTTPResponse:
+    return asyncio.run_coroutine_threadsafe(get_response(request), loop).result()
+
+  middleware = middleware_class(inner)
+
+  async def acall(request: HTTPRequest) -> HTTPResponse:
+    return await loop.run_in_executor(None, middleware, request)
+
+  return acall
@@ -0,0 +1,176 @@
+import socket
+import time
+from queue import Full, Queue
+from threading import Lock
+from typing import List, Tuple
+
+import settings
+from henango.server.admission import admission_control, too_many_requests_response
+from henango.server.metrics import metrics
+from henango.server.worker import Worker
+
+
+class WorkerPool:
+  """
+  接続済みのsocketを、あらかじめ起動しておいたWorkerスレッドへ振り分けるクラス
+  キューが一杯の場合は、設定に応じて待たせる（backpressure）か、すぐに503を返す
+  """
+
+  # キューが一杯の場合に返すレスポンス
+  SERVICE_UNAVAILABLE_RESPONSE = (
+    b"HTTP/1.1 503 Service Unavailable\r\n"
+    b"Content-Length: 0\r\n"
+    b"Retry-After: 1\r\n"
+    b"Connection: Close\r\n"
+    b"\r\n"
+  )
+
+  # 停止を始めてから、次のリクエストを待っているだけのkeep-aliveのコネクションを切断するまでの秒数
+  # この間に届いたリクエストには、Connection: closeを付けて応答する
+  IDLE_CLOSE_DELAY = 1.0
+
+  def __init__(self):
+    self.size = getattr(settings, "WORKER_POOL_SIZE", 16)
+    self.queue_size = getattr(settings, "WORKER_QUEUE_SIZE", 64)
+    self.queue_full_policy = getattr(settings, "WORKER_QUEUE_FULL_POLICY", "reject")
+
+    self.queue = Queue(maxsize=self.queue_size)
+    self.workers: List[Worker] = []
+
+    # メトリクス
+    self.lock = Lock()
+    self.busy_workers = 0
+    self.accepted_connections = 0
+    self.rejected_connections = 0
+    self.queue_wait_count = 0
+    self.queue_wait_total = 0.0
+    self.queue_wait_max = 0.0
+
+    # 停止中かどうか（Trueの間は、keep-aliveでコネクションを維持しない）
+    self.draining = False
+
+  def start(self) -> None:
+    """
+    Workerスレッドを起動する
+    """
+    for _ in range(self.size):
+      worker = Worker(self)
+      worker.start()
+      self.workers.append(worker)
+
+  def submit(self, client_socket: socket.socket, address: Tuple[str, int]) -> bool:
+    """
+    接続済みのsocketをキューに積む
+    キューに積めなかった場合は503を、クライアントの同時接続数が上限を超えた場合は429を返してcloseし、Falseを返す
+    """
+    if not admission_control.admit_connection(address[0]):
+      self.reject(client_socket, too_many_requests_response())
+      return False
+
+    item = (client_socket, address, time.monotonic())
+
+    if self.queue_full_policy == "block":
+      # 空きができるまでaccept側を止めることで、listenのbacklogに接続を溜めさせる
+      self.queue.put(item)
+    else:
+      try:
+        self.queue.put_nowait(item)
+      except Full:
+        with self.lock:
+          self.rejected_connections += 1
+        admission_control.release_connection(address[0])
+        self.reject(client_socket)
+        return False
+
+    with self.lock:
+      self.accepted_connections += 1
+    return True
+
+  def reject(self, client_socket: socket.socket, response: bytes = SERVICE_UNAVAILABLE_RESPONSE) -> None:
+    """
+    処理しきれない接続に、すぐにレスポンス（デフォルトは503）を返して切断する
+    """
+    try:
+      client_socket.sendall(response)
+    except OSError:
+      pass
+    finally:
+      client_socket.close()
+
+  def get(self) -> Tuple[socket.socket, Tuple[str, int], float]:
+    """
+    Workerが次に処理するsocketをキューから取り出す
+    (socket, アドレス, キューで待っていた秒数)を返す
+    """
+    client_socket, address, enqueued_at = self.queue.get()
+    wait = time.monotonic() - enqueued_at
+
+    with self.lock:
+      self.busy_workers += 1
+      self.queue_wait_count += 1
+      self.queue_wait_total += wait
+      self.queue_wait_max = max(self.queue_wait_max, wait)
+    metrics.observe("henango_pool_queue_wait_seconds", (), wait)
+
+    return client_socket, address, wait
+
+  def task_done(self) -> None:
+    """
+    Workerがsocketの処理を終えたことを記録する
+    """
+    with self.lock:
+      self.busy_workers -= 1
+    self.queue.task_done()
+
+  def drain(self, timeout: float) -> bool:
+    """
+    新しい接続の受け付けを止めた後に呼び出し、キューに積まれた接続と処理中のリクエストが終わるのを待つ
+    次のリクエストを待っているだけのkeep-aliveのコネクションは、IDLE_CLOSE_DELAY秒後に切断する
+    timeout秒以内に全て終わった場合はTrueを返す
+    """
+    self.draining = True
+    started = time.monotonic()
+    deadline = started + timeout
+    with self.queue.all_tasks_done:
+      while self.queue.unfinished_tasks:
+        now = time.monotonic()
+        if now >= deadline:
+          return False
+        # 処理中だったリクエストを終えてアイドル状態になったコネクションも切断できるよう、少しずつ待つ
+        if now - started >= self.IDLE_CLOSE_DELAY:
+          for worker in self.workers:
+            worker.close_if_idle()
+        self.queue.all_tasks_done.wait(min(deadline - now, 0.1))
+    return True
+
+  def collect_metrics(self) -> dict:
+    """
+    /metrics に出力するゲージの値を返す
+    """
+    stats = self.stats()
+    return {
+      ("henango_pool_size", ()): stats["pool_size"],
+      ("henango_pool_busy_workers", ()): stats["busy_workers"],
+      ("henango_pool_saturation", ()): stats["saturation"],
+      ("henango_pool_queue_length", ()): stats["queue_length"],
+      ("henango_pool_accepted_connections_total", ()): stats["accepted_connections"],
+      ("henango_pool_rejected_connections_total", ()): stats["rejected_connections"],
+    }
+
+  def stats(self) -> dict:
+    """
+    キューの待ち時間とプールの飽和度を返す
+    """
+    with self.lock:
+      average_wait = self.queue_wait_total / self.queue_wait_count if self.queue_wait_count else 0.0
+      return {
+        "pool_size": self.size,
+        "busy_workers": self.busy_workers,
+        "saturation": self.busy_workers / self.size,
+        "queue_length": self.queue.qsize(),
+        "queue_size": self.queue_size,
+        "accepted_connections": self.accepted_connections,
+        "rejected_connections": self.rejected_connections,
+        "queue_wait_average": average_wait,
+        "queue_wait_max": self.queue_wait_max,
+      }
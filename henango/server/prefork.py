@@ -0,0 +1,224 @@
+import gc
+import os
+import signal
+import socket
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+
+import settings
+from henango.server.log import server_logger, setup_logging, stop_logging
+from henango.server.server import Server, inherit_server_socket, notify_ready, spawn_replacement
+from henango.server.startup import StartupError, warm_up
+
+
+class PreforkServer:
+  """
+  複数の子プロセスを起動し、それぞれにサーバを動かさせる親プロセス（supervisor）を表すクラス
+  GILの制約を受けずに、全てのCPUコアでリクエストを処理するために使う
+
+  - SIGTERM / SIGINT: 子プロセスを停止して終了する（子プロセスは処理中のリクエストを終えてから終了する）
+  - SIGHUP: 待ち受け中のsocketを引き継いだ新しい親プロセスを起動し、
+            新しい親プロセスが子プロセスを起動し終えたら（SIGTERMが送られてくるので）終了する
+            forkした子プロセスは親プロセスが読み込んだurls.pyやviews.pyをそのまま使うので、
+            親プロセスごと入れ替えて読み込み直す
+  - 子プロセスが異常終了した場合は、新しい子プロセスを起動し直す
+    続けて異常終了する場合は起動し直すまでの間隔を倍々に延ばし、
+    1分間の異常終了の回数がPREFORK_MAX_CRASHES_PER_MINUTEを超えたら子プロセスを停止して終了する
+
+  PREFORK_REUSE_PORTがTrueの場合は子プロセスごとにsocketを持つので、
+  入れ替えの際に古い子プロセスのbacklogに残っていた接続は切断される
+  """
+
+  def __init__(self, engine: str = "thread", processes: Optional[int] = None):
+    if processes is None:
+      processes = getattr(settings, "PREFORK_PROCESSES", None) or os.cpu_count()
+
+    self.engine = engine
+    self.processes = processes
+    self.reuse_port = getattr(settings, "PREFORK_REUSE_PORT", False) and hasattr(socket, "SO_REUSEPORT")
+
+    # 子プロセスのpidと、そのプロセスが処理を続けるべきかどうかの対応
+    self.children: Dict[int, bool] = {}
+    self.server_socket: Optional[socket.socket] = None
+    self.stopping = False
+    self.reloading = False
+    self.replacement: Optional["subprocess.Popen"] = None
+    # 直近1分間に子プロセスが異常終了した時刻（time.monotonic()）
+    self.crashes: Deque[float] = deque()
+    # 起動し直す予定の子プロセスごとの、起動する時刻（time.monotonic()）
+    self.respawn_at: List[float] = []
+
+  def serve(self):
+    """
+    子プロセスを起動し、終了するまで監視する
+    """
+
+    setup_logging()
+    server_logger.info("PreforkServer: %d個のプロセスでサーバを起動します (engine: %s)", self.processes, self.engine)
+
+    try:
+      if self.processes > 1 and getattr(settings, "SESSION_BACKEND", "memory") == "memory":
+        raise StartupError('SESSION_BACKEND = "memory" ではプロセスごとにセッションが分かれてしまうため、preforkモードでは "sqlite" を使ってください')
+
+      # SO_REUSEPORTを使わない場合は、親プロセスでsocketを生成して子プロセスに引き継ぐ
+      if not self.reuse_port:
+        self.server_socket = inherit_server_socket() or Server().create_server_socket()
+
+      signal.signal(signal.SIGTERM, self.handle_stop)
+      signal.signal(signal.SIGINT, self.handle_stop)
+      signal.signal(signal.SIGHUP, self.handle_reload)
+
+      if getattr(settings, "PREFORK_PRELOAD", True):
+        self.preload()
+
+      for _ in range(self.processes):
+        self.spawn()
+
+      # 入れ替え前の親プロセスがあれば、受け付けを引き継いだことを知らせる
+      notify_ready()
+
+      while not self.stopping:
+        if self.reloading:
+          self.reload()
+        self.reap()
+        self.respawn()
+        time.sleep(0.1)
+
+    finally:
+      self.stop_children(list(self.children))
+      server_logger.info("PreforkServer: サーバを停止します")
+      stop_logging()
+
+  def preload(self) -> None:
+    """
+    テンプレートのコンパイルなどを親プロセスで済ませ、その状態をforkした子プロセスに引き継ぐ
+    子プロセスは起動してすぐに、キャッシュが温まった状態でリクエストを処理できる
+    """
+    warm_up()
+    # ここまでに生成したオブジェクトをGCの対象から外しておく
+    # 子プロセスのGCが参照カウント以外の部分を書き換えず、親プロセスとメモリのページを共有し続けられる
+    gc.freeze()
+
+  def handle_stop(self, signum, frame) -> None:
+    self.stopping = True
+
+  def handle_reload(self, signum, frame) -> None:
+    self.reloading = True
+
+  def spawn(self) -> None:
+    """
+    子プロセスを1つ起動する
+    """
+    pid = os.fork()
+    if pid:
+      self.children[pid] = True
+      return
+
+    # ここから子プロセス
+    # 停止は親プロセスからのSIGTERMで行うので、Ctrl-CのSIGINTとSIGHUPは無視する
+    # SIGTERMを受け取った場合は、サーバが処理中のリクエストを終えてから終了する
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+    exit_code = 0
+    try:
+      server_socket = self.server_socket
+      if server_socket is None:
+        server_socket = Server().create_server_socket(reuse_port=True)
+
+      if self.engine == "asyncio":
+        from henango.server.async_server import AsyncServer
+        AsyncServer().serve(server_socket, supervised=True)
+      else:
+        Server().serve(server_socket, supervised=True)
+    except BaseException:
+      server_logger.exception("PreforkServer: 子プロセスでエラーが発生しました")
+      exit_code = 1
+    finally:
+      os._exit(exit_code)
+
+  def reap(self) -> None:
+    """
+    終了した子プロセスを回収し、異常終了したものを起動し直す予定に加える
+    起動時のエラー（bindの失敗やStartupErrorなど）ですぐに終了する子プロセスを、forkし続けないようにする
+    """
+    while self.children:
+      pid, status = os.waitpid(-1, os.WNOHANG)
+      if pid == 0:
+        return
+
+      active = self.children.pop(pid, False)
+      if not active or self.stopping:
+        continue
+
+      now = time.monotonic()
+      self.crashes.append(now)
+      while self.crashes[0] < now - 60:
+        self.crashes.popleft()
+
+      max_crashes = getattr(settings, "PREFORK_MAX_CRASHES_PER_MINUTE", 20)
+      if len(self.crashes) > max_crashes:
+        raise RuntimeError(f"PreforkServer: 子プロセスが1分間に{len(self.crashes)}回異常終了したため、サーバを停止します")
+
+      # 直近の異常終了が多いほど、起動し直すまでの間隔を延ばす（0.1秒, 0.2秒, 0.4秒, ...）
+      delay = min(0.1 * 2 ** (len(self.crashes) - 1), getattr(settings, "PREFORK_RESPAWN_MAX_DELAY", 30))
+      self.respawn_at.append(now + delay)
+      server_logger.warning(
+        "PreforkServer: 子プロセスが終了したため%.1f秒後に起動し直します pid: %d status: %d", delay, pid, status
+      )
+
+  def respawn(self) -> None:
+    """
+    起動する時刻になった子プロセスを起動し直す
+    """
+    now = time.monotonic()
+    due = [at for at in self.respawn_at if at <= now]
+    if not due:
+      return
+
+    self.respawn_at = [at for at in self.respawn_at if at > now]
+    for _ in due:
+      self.spawn()
+
+  def reload(self) -> None:
+    """
+    待ち受け中のsocketを引き継いだ新しい親プロセスを起動する
+    新しい親プロセスが子プロセスを起動し終えるまでは、このプロセスの子プロセスが処理を続ける
+    """
+    self.reloading = False
+    if self.replacement is not None and self.replacement.poll() is None:
+      server_logger.warning("PreforkServer: 新しいプロセスの起動中のため、SIGHUPを無視します")
+      return
+
+    self.replacement = spawn_replacement(self.server_socket)
+    server_logger.info("PreforkServer: 新しいプロセスを起動しました pid: %d", self.replacement.pid)
+
+  def stop_children(self, pids: list) -> None:
+    """
+    子プロセスを停止し、終了を待つ
+    """
+    for pid in pids:
+      self.terminate(pid)
+
+    deadline = time.monotonic() + getattr(settings, "PREFORK_SHUTDOWN_TIMEOUT", 10)
+    for pid in pids:
+      while time.monotonic() < deadline:
+        try:
+          if os.waitpid(pid, os.WNOHANG)[0]:
+            break
+        except ChildProcessError:
+          break
+        time.sleep(0.05)
+      else:
+        # 時間内に終了しなかったプロセスは強制終了する
+        self.terminate(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+      self.children.pop(pid, None)
+
+  def terminate(self, pid: int, signum: int = signal.SIGTERM) -> None:
+    try:
+      os.kill(pid, signum)
+    except ProcessLookupError:
+      pass
@@ -1,51 +1,177 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 import os
+import signal
 import socket
-import traceback
+import sys
+import threading
+from typing import Optional
+
+import settings
+from henango.server.admission import admission_control
+from henango.server.log import server_logger, setup_logging, stop_logging
+from henango.server.metrics import metrics
+from henango.server.pool import WorkerPool
+from henango.server.startup import warm_up
+
+# 入れ替え時に、新しいプロセスへ待ち受け中のsocketのファイルディスクリプタを伝える環境変数
+LISTEN_FD_ENV = "HENANGO_LISTEN_FD"
+# 入れ替え時に、新しいプロセスへ古いプロセスのpidを伝える環境変数
+REPLACED_PID_ENV = "HENANGO_REPLACED_PID"
 
-from henango.server.worker import Worker
 
 class Server:
   """
   Webサーバを表すクラス
+
+  - SIGTERM / SIGINT: 新しい接続の受け付けを止め、処理中のリクエストが終わるのを待ってから終了する
+  - SIGHUP: 待ち受け中のsocketを引き継いだ新しいプロセスを起動し、
+            新しいプロセスが受け付けを始めたら（SIGTERMが送られてくるので）終了する
   """
 
-  def serve(self):
+  # acceptがシグナルを受け取ったかどうかを確認する間隔（秒）
+  ACCEPT_POLL_INTERVAL = 0.5
+
+  def serve(self, server_socket: socket.socket = None, supervised: bool = False):
     """
     サーバを起動する
+    server_socketが渡された場合は、新しく生成せずにそれを使って待ち受ける
+    supervisedがTrueの場合（preforkの子プロセス）は、SIGINTとSIGHUPを親プロセスに任せる
     """
 
-    print("=== Server: サーバを起動します ===")
+    setup_logging()
+    server_logger.info("Server: サーバを起動します")
+
+    self.stopping = False
+    self.reloading = False
+    self.replacement: Optional["subprocess.Popen"] = None
 
     try:
+      # テンプレートのコンパイルなどを、リクエストを受け付ける前に済ませておく
+      warm_up()
+
       # socketを生成
-      server_socket = self.create_server_socket()
+      if server_socket is None:
+        server_socket = inherit_server_socket() or self.create_server_socket()
+
+      # クライアントを処理するスレッドをあらかじめ起動しておく
+      self.pool = WorkerPool()
+      self.pool.start()
+      metrics.add_collector(self.pool.collect_metrics)
+      metrics.add_collector(admission_control.collect_metrics)
+
+      if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        if not supervised:
+          signal.signal(signal.SIGINT, self.handle_stop)
+          signal.signal(signal.SIGHUP, self.handle_reload)
+
+      # 入れ替え前のプロセスがあれば、受け付けを引き継いだことを知らせる
+      notify_ready()
+
+      # シグナルを受け取ったことに気づけるよう、acceptは一定時間ごとに戻るようにする
+      server_socket.settimeout(self.ACCEPT_POLL_INTERVAL)
+      while not self.stopping:
+        if self.reloading:
+          self.reload(server_socket)
 
-      while True:
         # 外部からの接続を待ち、接続があったらコネクションを確立する
-        print("=== Server: クライアントからの接続を待ちます ===")
-        (client_socket, address) = server_socket.accept()
-        print(f"=== Server: クライアントとの接続が完了しました reote_address: {address} ===")
+        try:
+          (client_socket, address) = server_socket.accept()
+        except socket.timeout:
+          continue
+        server_logger.debug("Server: クライアントとの接続が完了しました remote_address: %s", address)
 
-        # クライアントを処理するスレッドを作成
-        thread = Worker(client_socket, address)
-        # スレッドを実装
-        thread.start()
+        # クライアントの処理をスレッドプールに任せる
+        self.pool.submit(client_socket, address)
+
+      # 新しい接続は受け付けず、処理中のリクエストが終わるのを待つ
+      server_logger.info("Server: 接続の受け付けを停止し、処理中のリクエストの完了を待ちます")
+      server_socket.close()
+      if not self.pool.drain(getattr(settings, "SHUTDOWN_TIMEOUT", 10)):
+        server_logger.warning("Server: 時間内に完了しなかったリクエストがあります busy_workers: %d", self.pool.stats()["busy_workers"])
 
     finally:
-      print("=== サーバを停止します ===")
+      server_logger.info("Server: サーバを停止します")
+      stop_logging()
+
+  def handle_stop(self, signum, frame) -> None:
+    if self.stopping and signum == signal.SIGINT:
+      # 停止中にもう一度Ctrl-Cが押された場合は、待たずに終了する
+      raise KeyboardInterrupt
+    self.stopping = True
+
+  def handle_reload(self, signum, frame) -> None:
+    self.reloading = True
+
+  def reload(self, server_socket: socket.socket) -> None:
+    """
+    待ち受け中のsocketを引き継いだ新しいプロセスを起動する
+    新しいプロセスがurls.pyやviews.pyを読み込んで受け付けを始めるまでは、このプロセスが処理を続ける
+    """
+    self.reloading = False
+    if self.replacement is not None and self.replacement.poll() is None:
+      server_logger.warning("Server: 新しいプロセスの起動中のため、SIGHUPを無視します")
+      return
+
+    self.replacement = spawn_replacement(server_socket)
+    server_logger.info("Server: 新しいプロセスを起動しました pid: %d", self.replacement.pid)
 
-  def create_server_socket(self) -> socket:
+  def create_server_socket(self, reuse_port: bool = False) -> socket:
     """
     通信を待ち受けるためのserver_socketを生成する
+    reuse_portがTrueの場合は、複数のプロセスが同じポートで待ち受けられるようにする
     :return:
     """
     # socketを生成
     server_socket = socket.socket()
     server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+      server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
     # socketをlocalhostのポート8080版に割り当てる
     server_socket.bind(("localhost", 8080))
-    server_socket.listen(10)
+    server_socket.listen(getattr(settings, "LISTEN_BACKLOG", 128))
     return server_socket
+
+
+def inherit_server_socket() -> Optional[socket.socket]:
+  """
+  入れ替え前のプロセスから引き継いだ、待ち受け中のsocketを返す
+  引き継いでいない場合はNoneを返す
+  """
+  fd = os.environ.pop(LISTEN_FD_ENV, None)
+  if fd is None:
+    return None
+  return socket.socket(fileno=int(fd))
+
+
+def spawn_replacement(server_socket: Optional[socket.socket]) -> "subprocess.Popen":
+  """
+  同じコマンドラインで新しいプロセスを起動する
+  server_socketを渡した場合は、新しいプロセスはbindし直さずにそれを使って待ち受けるので、
+  入れ替えの間に届いた接続はlistenのbacklogに溜まり、どちらかのプロセスがacceptする
+  """
+  # 入れ替えの時にしか使わないので、起動を速くするため必要になってから読み込む
+  import subprocess
+
+  env = dict(os.environ)
+  env[REPLACED_PID_ENV] = str(os.getpid())
+  pass_fds = ()
+  if server_socket is not None:
+    env[LISTEN_FD_ENV] = str(server_socket.fileno())
+    pass_fds = (server_socket.fileno(),)
+  return subprocess.Popen([sys.executable, *sys.argv], env=env, pass_fds=pass_fds)
+
+
+def notify_ready() -> None:
+  """
+  入れ替え前のプロセスに、受け付けを引き継いだことをSIGTERMで知らせる
+  """
+  pid = os.environ.pop(REPLACED_PID_ENV, None)
+  if pid is None:
+    return
+  try:
+    os.kill(int(pid), signal.SIGTERM)
+  except ProcessLookupError:
+    pass
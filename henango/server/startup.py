@@ -0,0 +1,140 @@
+import time
+
+# このモジュールを読み込み始めた時刻
+# start.pyで最初に読み込むので、プロセスを起動した時刻とみなす（他のモジュールを読み込む時間も含めるため、先に記録する）
+STARTED_AT = time.perf_counter()
+
+import inspect
+import os
+import types
+from typing import Callable, Dict, Iterator, List
+
+import settings
+from henango.server.log import server_logger
+from henango.server.metrics import metrics
+
+# テンプレートファイルの拡張子
+TEMPLATE_SUFFIX = ".html"
+
+# warm_upが完了したかどうか
+# preforkの親プロセスで完了していれば、forkした子プロセスにも完了した状態が引き継がれる
+warmed_up = False
+
+# 起動にかかった時間（秒）
+# total: プロセスの起動からwarm_upの完了まで / warm_up: warm_upにかかった時間
+durations: Dict[str, float] = {}
+
+
+class StartupError(Exception):
+  """
+  起動時の確認で、リクエストを処理できない設定が見つかった
+  """
+  pass
+
+
+def warm_up() -> None:
+  """
+  リクエストを受け付ける前に、初回のリクエストで行われていた処理を済ませておく
+
+  - テンプレートディレクトリの全てのテンプレートを読み込み、コンパイルしておく
+  - viewが参照しているテンプレートと、{% include %}しているテンプレートが存在するかを確認する
+  - パラメータを含まないURLパターンの解決結果を、URLRouterのキャッシュに入れておく
+
+  問題が見つかった場合は、リクエストを受け付ける前にStartupErrorを送出する
+  （SIGHUPで起動した新しいプロセスの場合は、古いプロセスがそのまま処理を続ける）
+  同じプロセスやforkした子プロセスで2回目以降に呼び出した場合は、何もしない
+  """
+  global warmed_up
+  if warmed_up:
+    return
+
+  started = time.perf_counter()
+  if getattr(settings, "STARTUP_WARM_UP", True):
+    # urls.pyやviews.pyを読み込むので、このモジュールの読み込み時ではなくここで読み込む
+    from henango.urls.resolver import patterns, router
+    from templates.renderer import engine
+
+    errors = compile_templates(engine)
+    for url_pattern in patterns:
+      for template_name in referenced_templates(url_pattern.view):
+        if not os.path.isfile(os.path.join(engine.templates_dir, template_name)):
+          errors.append(f"{url_pattern.pattern}: viewが参照しているテンプレート {template_name} が存在しません")
+
+      if url_pattern.is_static:
+        for method in url_pattern.methods or ["GET"]:
+          router.lookup(method, url_pattern.pattern)
+
+    if errors:
+      raise StartupError("起動時の確認で問題が見つかりました\n" + "\n".join(errors))
+
+    server_logger.info("Startup: テンプレート%d個とURLパターン%d個を準備しました", len(engine.cache), len(patterns))
+
+  finished = time.perf_counter()
+  durations["warm_up"] = finished - started
+  durations["total"] = finished - STARTED_AT
+  warmed_up = True
+  server_logger.info(
+    "Startup: 起動の準備が完了しました total: %.1fms warm_up: %.1fms",
+    durations["total"] * 1000,
+    durations["warm_up"] * 1000,
+  )
+
+
+def compile_templates(engine) -> List[str]:
+  """
+  テンプレートディレクトリの全てのテンプレートをコンパイルしてキャッシュに入れ、見つかった問題の一覧を返す
+  """
+  from henango.template.engine import TemplateSyntaxError
+
+  errors = []
+  for template_name in list_templates(engine.templates_dir):
+    try:
+      template = engine.get_template(template_name)
+    except (TemplateSyntaxError, SyntaxError) as e:
+      errors.append(f"{template_name}: コンパイルできません ({e})")
+      continue
+
+    for include_name in template.includes:
+      if not os.path.isfile(os.path.join(engine.templates_dir, include_name)):
+        errors.append(f"{template_name}: includeしているテンプレート {include_name} が存在しません")
+  return errors
+
+
+def list_templates(templates_dir: str) -> Iterator[str]:
+  """
+  テンプレートディレクトリ以下のテンプレートの名前（ディレクトリからの相対パス）を返す
+  """
+  for directory, _, filenames in os.walk(templates_dir):
+    for filename in sorted(filenames):
+      if filename.endswith(TEMPLATE_SUFFIX):
+        path = os.path.relpath(os.path.join(directory, filename), templates_dir)
+        yield path.replace(os.sep, "/")
+
+
+def referenced_templates(view: Callable) -> Iterator[str]:
+  """
+  viewのコードに含まれる文字列の定数のうち、テンプレートの名前（.htmlで終わるもの）を返す
+  cache_viewなどでラップされている場合は、functools.wrapsで残した元のviewをたどる
+  """
+  code = getattr(inspect.unwrap(view), "__code__", None)
+  codes = [code] if code is not None else []
+  while codes:
+    code = codes.pop()
+    for const in code.co_consts:
+      if isinstance(const, str) and const.endswith(TEMPLATE_SUFFIX):
+        yield const
+      elif isinstance(const, types.CodeType):
+        # viewの中で定義した関数やラムダ式
+        codes.append(const)
+
+
+def collect_metrics() -> dict:
+  """
+  /metrics に出力するゲージの値を返す
+  """
+  return {("henango_startup_duration_seconds", (("phase", phase),)): value for phase, value in durations.items()}
+
+
+metrics.add_collector(collect_metrics)
+
+metrics.describe("henango_startup_duration_seconds", "gauge", "起動にかかった時間（phase: total / warm_up）")
@@ -1,206 +1,355 @@
-import os
-import re
-import traceback
-from datetime import datetime
-from socket import socket
-from threading import Thread
-from typing import Optional, Tuple
+import socket
+import time
+from threading import Lock, Thread
+from typing import TYPE_CHECKING, List, Optional, Tuple
 
 import settings
+from henango.http.parser import HTTPRequestError, RequestTimeout, split_request_head
 from henango.http.request import HTTPRequest
-from henango.http.response import HTTPResponse
-from urls import url_patterns
-from henango.urls.resolver import URLResolver
-
-
-class Worker(Thread):
-  # 拡張子とMIME Typeの対応
-  MIME_TYPE = {
-    "html": "text/html; charset=UTF-8",
-    "css": "text/css",
-    "png": "image/png",
-    "jpg": "image/jpg",
-    "gif": "image/gif",
-  }
-
-  # ステータスコードとステータスラインの対応
-  STATUS_LINES = {
-    200: "200 OK",
-    302: "302 Found",
-    404: "404 Not Found",
-    405:"405 Method Not Allowed",
-  }
-
-  def __init__(self, client_socket: socket, address: Tuple[str, int]):
-    super().__init__()
-
-    self.client_socket = client_socket
-    self.client_address = address
+from henango.http.response import FileResponse, HTTPResponse
+from henango.server.admission import admission_control, too_many_requests_response
+from henango.server.capture import request_capture
+from henango.server.handler import HTTPHandler
+from henango.server.log import log_access, server_logger
+from henango.server.metrics import metrics, observe_request
+from henango.server.middleware import load_middleware
+
+if TYPE_CHECKING:
+  from henango.server.pool import WorkerPool
+
+
+class Worker(Thread, HTTPHandler):
+  def __init__(self, pool: "WorkerPool"):
+    super().__init__(daemon=True)
+
+    self.pool = pool
+    self.client_socket = None
+    self.client_address = None
+    # client_socketに設定済みのタイムアウト
+    self.timeout: Optional[float] = None
+    # 処理中のリクエストのボディを受信しきる期限と、レスポンスを送信しきる期限（time.monotonic()）
+    # ボディの期限は、viewがボディを受信し始めた時点で決める
+    self.body_deadline: Optional[float] = None
+    self.send_deadline: Optional[float] = None
+    # acceptされてから、このWorkerが処理を始めるまでの時間
+    self.accept_wait = 0.0
+    # 前のリクエストへのレスポンスを送り終え、次のリクエストを待っているかどうか
+    self.idle = False
+    self.idle_lock = Lock()
+    # middlewareでラップした、リクエストからレスポンスを生成する関数
+    self.get_response = load_middleware(self.dispatch)
 
   def run(self) -> None:
     """
-    クライアントと接続済のsocketを引数として受け取り、
+    プールのキューからクライアントと接続済のsocketを受け取り、処理し続ける
+    """
+    while True:
+      client_socket, address, accept_wait = self.pool.get()
+      self.client_socket = client_socket
+      self.timeout = None
+      self.client_address = address
+      self.accept_wait = accept_wait
+      try:
+        self.handle_client()
+      finally:
+        self.pool.task_done()
+
+  def handle_client(self) -> None:
+    """
+    クライアントと接続済のsocketについて、
     リクエストを処理してレスポンスを送信する
+    keep-aliveが有効な間は、同じコネクションで続けてリクエストを処理する
     """
 
-    try:
-
-      # クライアントから送られてきたデータを取得する
-      request_bytes = self.client_socket.recv(4096)
-
-      # クライアントから送られてきたデータをファイルに書き出す
-      with open("server_recv.txt", "wb") as f:
-        f.write(request_bytes)
-
-      self.update_request_html(request_bytes)
-
-      # HTTPリクエストをパースする
-      request = self.parse_http_request(request_bytes)
-
-      # URL解決を試みる
-      view = URLResolver().resolve(request)
-
-      # レスポンスを生成する
-      response = view(request)
+    # 受信済みでまだ処理していないデータ
+    # パイプライン化されたリクエストは、ここに溜まった順に処理する
+    buffer = b""
+    # このコネクションで処理したリクエストの数
+    handled_requests = 0
+    request = None
+    # レスポンスを送信し始めたかどうか（送信し始めた後は、エラーレスポンスを送らずに切断する）
+    responding = False
 
-      # レスポンスボディを変換
-      if isinstance(response.body, str):
-        response.body = response.body.encode()
+    send_timeout = getattr(settings, "SEND_TIMEOUT", 30)
 
-      # レスポンスラインを生成
-      response_line = self.build_response_line(response)
-
-      # レスポンスヘッダーを生成
-      response_header = self.build_response_header(response, request)
-
-
-      # ヘッダーとボディを空行でくっつけた上でbytesに変換し、レスポンス全体を生成する
-      response_bytes = (response_line + response_header + "\r\n").encode() + response.body
-
-      # クライアントへレスポンスを送信する
-      self.client_socket.send(response_bytes)
+    metrics.inc("henango_active_connections", (), 1)
+    try:
+      while True:
+        # クライアントから送られてきたデータのうち、リクエストライン+ヘッダーを取得する
+        # 受信済みのデータがないまま次のリクエストを待つ間は、停止時に切断してよいアイドル状態とする
+        # （データが届いた時点で、receive_request_headがアイドル状態を解除する）
+        with self.idle_lock:
+          self.idle = handled_requests > 0 and not buffer
+        responding = False
+        request_head, buffer = self.receive_request_head(buffer, first=handled_requests == 0)
+        if request_head is None:
+          # クライアントが切断したか、タイムアウトした
+          break
+        handled_requests += 1
+        request = None
+
+        # 頻度の上限を超えたクライアントには、パースする前に429を返して切断する
+        wait = admission_control.admit_request(self.client_address[0])
+        if wait:
+          try:
+            self.client_socket.sendall(too_many_requests_response(wait))
+          except OSError:
+            pass
+          break
+
+        # フェーズごとの処理時間を計測する
+        started = time.perf_counter()
+        timings = {"accept": self.accept_wait if handled_requests == 1 else 0.0}
+
+        # 設定で有効になっていれば、リクエストを記録する
+        if request_capture is not None:
+          request_capture.record(request_head, self.client_address)
+
+        # HTTPリクエストをパースする
+        # ボディは、viewが読み込んだ時点で受信する
+        request = self.parse_http_request(request_head)
+        request.client_address = self.client_address
+        request.stream = self.create_body_stream(request, self.recv, buffer)
+        self.body_deadline = None
+        parsed = time.perf_counter()
+        timings["parse"] = parsed - started
+
+        # middlewareを通してURL解決とviewの呼び出しを行い、レスポンスを生成する
+        # viewがボディを受信し始めてからREQUEST_BODY_TIMEOUT秒以内に受信しきれなければ、408を返す
+        request.timings = timings
+        response = self.get_response(request)
+
+        # viewが読み込まなかったボディを読み捨てる
+        # 少しずつ送るレスポンスは送信中にボディを読み込むかもしれないので、送信後に読み捨てる
+        if not response.streaming:
+          request.stream.drain()
+        viewed = time.perf_counter()
+        # middlewareの処理時間も含めて、URL解決以外をviewの時間とする
+        timings["view"] = viewed - parsed - timings.get("resolve", 0.0)
+
+        # コネクションを維持するかどうかを決める
+        max_requests = getattr(settings, "KEEP_ALIVE_MAX_REQUESTS", 100)
+        keep_alive = (
+          self.should_keep_alive(request, response)
+          and handled_requests < max_requests
+          and not self.pool.draining
+        )
+
+        # レスポンスを(ヘッダー, ボディ)として生成する
+        response_parts = self.build_response_parts(response, request, keep_alive)
+
+        # クライアントへレスポンスを送信する
+        # 送信し始めてからsend_timeout秒以内に送信しきれなければ、切断する
+        responding = True
+        self.send_deadline = time.monotonic() + send_timeout
+        sent_bytes = self.send_parts(response_parts)
+        if not self.sends_body(request):
+          self.discard_body(response)
+        elif isinstance(response, FileResponse):
+          self.send_file(response)
+          sent_bytes += response.content_length
+        elif response.streaming:
+          sent_bytes += self.send_stream(response, request)
+        timings["send"] = time.perf_counter() - viewed
+
+        # 次のリクエストの先頭を取り出す
+        request.stream.drain()
+        buffer = request.stream.leftover()
+
+        log_access(request, self.client_address, response.status_code, sent_bytes, timings)
+        observe_request(request, response.status_code, timings)
+
+        if not keep_alive:
+          break
+
+    except HTTPRequestError as e:
+      # 不正なリクエストには、エラーレスポンスを返して切断する
+      # レスポンスを送信し始めていた場合は、そのまま切断する
+      error_response = self.build_error_response(e) if not responding else b""
+      log_access(request, self.client_address, e.status_code, len(error_response), {})
+      observe_request(request, e.status_code, {})
+      try:
+        self.set_timeout(send_timeout)
+        self.client_socket.sendall(error_response)
+      except OSError:
+        pass
+
+    except socket.timeout:
+      # クライアントがレスポンスを受信しないまま、時間が経った
+      metrics.inc("henango_timeouts_total", (("phase", "write"),))
+      server_logger.info("Worker: レスポンスの送信がタイムアウトしました remote_address: %s", self.client_address)
+
+    except ConnectionError:
+      # レスポンスの送信中に、クライアントが切断した
+      server_logger.debug("Worker: クライアントが切断しました remote_address: %s", self.client_address)
 
     except Exception as e:
-      # リクエストの処理中に雷害が発生した場合はコンソールにエラーログを出力し、
+      # リクエストの処理中に雷害が発生した場合はエラーログを出力し、
       # 処理を続行する
-      print("=== リクエストの処理中にエラーが発生しました ===")
-      traceback.print_exc()
+      server_logger.exception("リクエストの処理中にエラーが発生しました")
 
     finally:
       # 例外が発生した場合も、発生しなかった場合も、TCP通信のcloseは行う
-      print(f"=== Worker: クライアントとの通信を終了します remote_address: {self.client_address} ===")
-      self.client_socket.close()
-
-  def update_request_html(self, request: bytes) -> None:
-    """
-    リクエストの内容をrequest.htmlに書き込む
-    """
-    # +
-    # requestをrequest.htmlに書き込む
-    default_static_root = os.path.join(os.path.dirname(__file__), "../../static")
-    static_root = getattr(settings, "STATIC_ROOT", default_static_root)
-
-    request_html_path = os.path.join(static_root, "request.html")
-    with open(request_html_path, "wt") as f:
-      str_request = request.decode().replace('\r\n', '<br>');
-      ## print(f"<html><body>{str_request}</body></html>")
-      f.write(f"<html><body>{str_request}</body></html>")
-
-  def parse_http_request(self, request: bytes) -> HTTPRequest:
-    """
-    HTTPリクエストを
-    1. method: str
-    2. path: str
-    3. http_version: str
-    4. request_header: dict
-    5. request_body: bytes
-    に分割/変換する
-    """
-    # リクエスト全体を
-    # 1. リクエストライン（１行目）
-    # 2. リクエストヘッダー（２行目〜空行）
-    # 3. リクエストボディ（空行〜）
-    # にパースする
-
-    request_line, remain = request.split(b"\r\n", maxsplit=1)
-    request_header, request_body = remain.split(b"\r\n\r\n", maxsplit=1)
-
-    # リクエストラインを文字列に変換してパースする
-    method, path, http_version = request_line.decode().split(" ")
-
-    # リクエストヘッダーを辞書にパースする
-    headers = {}
-    for header_row in request_header.decode().split("\r\n"):
-      key, value = re.split(r": *", header_row, maxsplit=1)
-      headers[key] = value
-
-    cookies = {}
-    if "Cookie" in headers:
-      # str から list へ変換
-      # ex) "name1=value1; name2=value2" => ["name1=value1", "name2=value2"]
-      cookie_strings = headers["Cookie"].split("; ")
-      # list から dict へ変換
-      # ex) ["name1=value1","name2=value2"] => {"name1": "value1", "name2": "value2"}
-      for cookie_string in cookie_strings:
-        name, value = cookie_string.split("=", maxsplit=1)
-        cookies[name] = value
-
-    return HTTPRequest(path, method, http_version, headers, cookies, request_body)
-
-  def build_response_line(self, response: HTTPResponse) -> str:
-    """
-    レスポンスラインを構築する
-    """
-    status_line = self.STATUS_LINES[response.status_code]
-    return f"HTTP/1.1 {status_line}"
-
-
-  def build_response_header(self,response:HTTPResponse,request:HTTPRequest) -> str:
-    """
-    レスポンスヘッダーを構築する
-    """
-
-    # Content-Typeが指定されていない場合はpathから特定する
-    if response.content_type is None:
-      # pathから拡張子を取得
-      if "." in request.path:
-        ext = request.path.split(".", maxsplit=1)[-1]
-        # 拡張子からMIME Typeを取得
-        # 知らない対応していない拡張子の場合はoctet-streamとする
-        response.content_type = self.MIME_TYPE.get(ext,"application/octet-stream")
-      else:
-        # pathに拡張子がない場合はhtml扱いとする
-        response.content_type = "text/html; charset=UTF-8"
-
-
-    # 基本ヘッダーを生成
-    response_header = ""
-    response_header += f"Date: {datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')}\r\n"
-    response_header += "Host: HenaServer//0.1\r\n"
-    response_header += f"Content-Length: {len(response.body)}\r\n"
-    response_header += "Connection: Close\r\n"
-    response_header += f"Content-Type: {response.content_type}\r\n"
-
-    # Cookieヘッダーの生成
-    for cookie in response.cookies:
-      cookie_header = f"Set-Cookie: {cookie.name}={cookie.value}"
-      if cookie.expires is not None:
-        cookie_header += f"; Expires={cookie.expires.strftime('%a, %d %b %Y %H:%M:%S GMT')}"
-      if cookie.max_age is not None:
-        cookie_header += f"; Max-Age={cookie.max_age}"
-      if cookie.domain:
-        cookie_header += f"; Domain={cookie.domain}"
-      if cookie.path:
-        cookie_header += f"; Path={cookie.path}"
-      if cookie.secure:
-        cookie_header += f"; Secure"
-      if cookie.http_only:
-        cookie_header += f"; HttpOnly"
-
-      response_header += cookie_header + "\r\n"
-
-    # その他のヘッダーの生成
-    for header_name, header_value in response.headers.items():
-      response_header += f"{header_name}: {header_value}\r\n"
-
-    return response_header
+      server_logger.debug("Worker: クライアントとの通信を終了します remote_address: %s", self.client_address)
+      with self.idle_lock:
+        self.idle = False
+        self.client_socket.close()
+      metrics.inc("henango_active_connections", (), -1)
+      admission_control.release_connection(self.client_address[0])
+
+  def close_if_idle(self) -> None:
+    """
+    次のリクエストを待っているだけのコネクションであれば、切断してWorkerを解放する
+    """
+    with self.idle_lock:
+      if not self.idle:
+        return
+      try:
+        # recvで待っているWorkerは、クライアントが切断した場合と同じように処理を終える
+        self.client_socket.shutdown(socket.SHUT_RDWR)
+      except OSError:
+        pass
+
+  def receive_request_head(self, buffer: bytes, first: bool = False) -> Tuple[Optional[bytes], bytes]:
+    """
+    bufferに続けてsocketからデータを受信し、リクエストライン+ヘッダー（空行まで）を切り出す
+    (リクエストライン+ヘッダー, 残りのbuffer)を返す
+    クライアントが切断した場合や、何も受信しないままタイムアウトした場合は、Noneを返す
+
+    次のリクエストを待つ間はKEEP_ALIVE_TIMEOUTで切断する
+    受信し始めてから（コネクションの最初のリクエストは接続した時点から）REQUEST_HEADER_TIMEOUT秒以内に
+    空行まで届かない場合はRequestTimeoutを送出し、少しずつ送り続けて接続を占有するクライアントを切断する
+    """
+    max_header_size = getattr(settings, "MAX_REQUEST_HEADER_SIZE", 16 * 1024)
+    idle_timeout = getattr(settings, "KEEP_ALIVE_TIMEOUT", 5)
+    header_timeout = getattr(settings, "REQUEST_HEADER_TIMEOUT", 10)
+    deadline = time.monotonic() + header_timeout if first else None
+    searched = 0
+    while True:
+      result = split_request_head(buffer, max_header_size, searched)
+      if result is not None:
+        return result
+
+      if deadline is None and buffer:
+        deadline = time.monotonic() + header_timeout
+      timeout = idle_timeout if deadline is None else deadline - time.monotonic()
+
+      searched = len(buffer)
+      try:
+        if timeout <= 0:
+          raise socket.timeout()
+        self.set_timeout(timeout)
+        chunk = self.client_socket.recv(4096)
+      except socket.timeout:
+        if not buffer:
+          # 何も送られてこなかったコネクションは、レスポンスを返さずに切断する
+          metrics.inc("henango_timeouts_total", (("phase", "idle"),))
+          return None, b""
+        metrics.inc("henango_timeouts_total", (("phase", "header"),))
+        raise RequestTimeout()
+      except ConnectionResetError:
+        return None, b""
+      if not chunk:
+        return None, b""
+      if self.idle:
+        # 次のリクエストを受信し始めたので、停止時にも切断しない
+        with self.idle_lock:
+          self.idle = False
+      buffer += chunk
+
+  def send_parts(self, parts: List[bytes]) -> int:
+    """
+    複数のbytesを連結せずに、sendmsgでまとめて送信する
+    一部しか送信できなかった場合は、残りを送信し直す
+    """
+    total = sum(len(part) for part in parts)
+    views = [memoryview(part) for part in parts if part]
+    while views:
+      self.set_send_timeout()
+      sent = self.client_socket.sendmsg(views)
+      while sent:
+        if sent >= len(views[0]):
+          sent -= len(views.pop(0))
+        else:
+          views[0] = views[0][sent:]
+          sent = 0
+    return total
+
+  def send_stream(self, response: HTTPResponse, request: HTTPRequest) -> int:
+    """
+    イテレータのボディを、得られた順に送信する
+    sendmsgはクライアントが受信するまでブロックするので、ボディを溜め込まずに済む
+    """
+    chunked = self.is_chunked(request)
+    sent_bytes = 0
+    chunks = self.iterate_body(response.body)
+    try:
+      for chunk in chunks:
+        parts = self.encode_chunk(chunk, chunked)
+        if parts:
+          sent_bytes += self.send_parts(parts)
+    finally:
+      # 途中で送信に失敗した場合も、ジェネレータの後始末を行う
+      chunks.close()
+    if chunked:
+      sent_bytes += self.send_parts([self.LAST_CHUNK])
+    return sent_bytes
+
+  def send_file(self, response: FileResponse) -> None:
+    """
+    ファイルの内容を、メモリにコピーせずにsendfileで送信する
+    socket.sendfileのタイムアウトは待つたびにかかるので、SENDFILE_CHUNK_SIZEずつ送信して期限を確認する
+    """
+    with open(response.path, "rb") as f:
+      for prefix, offset, count in response.parts:
+        if prefix:
+          self.send_parts([prefix])
+        end = offset + count
+        while offset < end:
+          self.set_send_timeout()
+          sent = self.client_socket.sendfile(f, offset, min(self.SENDFILE_CHUNK_SIZE, end - offset))
+          if not sent:
+            # ファイルが途中で短くなった
+            break
+          offset += sent
+    if response.trailer:
+      self.send_parts([response.trailer])
+
+  def recv(self, size: int) -> bytes:
+    """
+    socketからリクエストボディのデータを受信する
+    切断された場合は空のbytesを返し、受信し始めてからREQUEST_BODY_TIMEOUT秒経った場合はRequestTimeoutを送出する
+    少しずつ送り続けてWorkerを占有するクライアントも、期限で切断する
+    """
+    now = time.monotonic()
+    if self.body_deadline is None:
+      self.body_deadline = now + getattr(settings, "REQUEST_BODY_TIMEOUT", 30)
+    try:
+      if self.body_deadline <= now:
+        raise socket.timeout()
+      self.set_timeout(self.body_deadline - now)
+      return self.client_socket.recv(size)
+    except socket.timeout:
+      metrics.inc("henango_timeouts_total", (("phase", "body"),))
+      raise RequestTimeout()
+    except ConnectionResetError:
+      return b""
+
+  def set_send_timeout(self) -> None:
+    """
+    レスポンスを送信しきる期限までの残り時間を、socketのタイムアウトに設定する
+    期限を過ぎている場合は、socket.timeoutを送出する
+    """
+    timeout = self.send_deadline - time.monotonic()
+    if timeout <= 0:
+      raise socket.timeout()
+    self.set_timeout(timeout)
+
+  def set_timeout(self, timeout: float) -> None:
+    """
+    socketの送受信のタイムアウトを設定する
+    同じ値を設定し直すシステムコールは省く
+    """
+    if timeout != self.timeout:
+      self.client_socket.settimeout(timeout)
+      self.timeout = timeout
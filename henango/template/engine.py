@@ -0,0 +1,155 @@
+import html
+import os
+import re
+from threading import Lock
+from typing import Callable, Dict, List, Tuple
+
+# テンプレート中のタグ
+# {{ 式 }}: 式の値を（エスケープして）出力する
+# {% 文 %}: for / if / include などの制御
+# {# コメント #}: 何も出力しない
+TOKEN_PATTERN = re.compile(r"(\{\{.*?\}\}|\{%.*?%\}|\{#.*?#\})", re.DOTALL)
+
+
+class TemplateSyntaxError(Exception):
+  pass
+
+
+class Template:
+  """
+  テンプレートを一度だけPythonのコードオブジェクトにコンパイルしておき、
+  レンダリング時はそのコードを実行するだけで済ませるクラス
+
+  {{ value }}        値をHTMLエスケープして出力する
+  {{ value|safe }}   値をエスケープせずに出力する
+  {% for x in xs %} ... {% endfor %}
+  {% if cond %} ... {% elif cond %} ... {% else %} ... {% endif %}
+  {% include "other.html" %}
+  """
+  name: str
+  source: str
+  includes: List[str]
+
+  def __init__(self, source: str, name: str = "<template>"):
+    self.name = name
+    self.source = source
+    # このテンプレートがincludeしているテンプレートの名前
+    self.includes = []
+    self.code = compile(self.generate(), name, "exec")
+
+  def generate(self) -> str:
+    """
+    テンプレートを、_outにテキストを追加していくPythonのソースコードに変換する
+    """
+    lines = ["_out = []", "_append = _out.append"]
+    # 開いているブロック（for / if）のスタック
+    blocks: List[str] = []
+
+    def emit(line: str) -> None:
+      lines.append("  " * len(blocks) + line)
+
+    for token in TOKEN_PATTERN.split(self.source):
+      if not token:
+        continue
+
+      if token.startswith("{{"):
+        expression = token[2:-2].strip()
+        if expression.endswith("|safe"):
+          emit(f"_append(str({expression[:-len('|safe')].strip()}))")
+        else:
+          emit(f"_append(_escape({expression}))")
+
+      elif token.startswith("{%"):
+        statement = token[2:-2].strip()
+        keyword = statement.split(maxsplit=1)[0] if statement else ""
+
+        if keyword in ("for", "if"):
+          emit(f"{statement}:")
+          blocks.append(keyword)
+          emit("pass")
+        elif keyword in ("elif", "else"):
+          if not blocks or blocks[-1] != "if":
+            raise TemplateSyntaxError(f"{self.name}: 対応するifがない {keyword} です")
+          blocks.pop()
+          emit(f"{statement}:")
+          blocks.append("if")
+          emit("pass")
+        elif keyword in ("endfor", "endif"):
+          if not blocks or blocks[-1] != keyword[len("end"):]:
+            raise TemplateSyntaxError(f"{self.name}: 対応するブロックがない {keyword} です")
+          blocks.pop()
+        elif keyword == "include":
+          include_name = statement[len("include"):].strip()
+          if include_name[:1] in ("'", '"'):
+            self.includes.append(include_name[1:-1])
+          emit(f"_append(_include({include_name}, globals()))")
+        else:
+          raise TemplateSyntaxError(f"{self.name}: 不明なタグ {token} です")
+
+      elif token.startswith("{#"):
+        continue
+
+      else:
+        emit(f"_append({token!r})")
+
+    if blocks:
+      raise TemplateSyntaxError(f"{self.name}: {blocks[-1]} が閉じられていません")
+
+    return "\n".join(lines)
+
+  def render(self, context: dict, include: Callable[[str, dict], str]) -> str:
+    """
+    コンパイル済みのコードを実行して、テンプレートをレンダリングする
+    """
+    namespace = dict(context)
+    namespace["_escape"] = escape
+    namespace["_include"] = include
+    exec(self.code, namespace)
+    return "".join(namespace["_out"])
+
+
+def escape(value) -> str:
+  return html.escape(str(value))
+
+
+class TemplateEngine:
+  """
+  テンプレートディレクトリからテンプレートを読み込み、コンパイル結果をキャッシュするクラス
+  auto_reloadがTrueの場合は、ファイルが更新されていればコンパイルし直す
+  """
+
+  def __init__(self, templates_dir: str, auto_reload: bool = False):
+    self.templates_dir = templates_dir
+    self.auto_reload = auto_reload
+    # テンプレート名と(更新日時, コンパイル済みテンプレート)の対応
+    self.cache: Dict[str, Tuple[float, Template]] = {}
+    self.lock = Lock()
+
+  def get_template(self, template_name: str) -> Template:
+    """
+    コンパイル済みのテンプレートを取得する
+    """
+    cached = self.cache.get(template_name)
+    if cached is not None and not self.auto_reload:
+      return cached[1]
+
+    template_path = os.path.join(self.templates_dir, template_name)
+    mtime = os.stat(template_path).st_mtime
+    if cached is not None and cached[0] == mtime:
+      return cached[1]
+
+    with self.lock:
+      with open(template_path) as f:
+        template = Template(f.read(), template_name)
+      self.cache[template_name] = (mtime, template)
+    return template
+
+  def render(self, template_name: str, context: dict) -> str:
+    return self.get_template(template_name).render(context, self.include)
+
+  def include(self, template_name: str, namespace: dict) -> str:
+    """
+    {% include %}から呼び出され、呼び出し元と同じ変数でテンプレートをレンダリングする
+    """
+    context = {key: value for key, value in namespace.items() if not key.startswith("_")}
+    return self.render(template_name, context)
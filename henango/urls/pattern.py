@@ -1,25 +1,116 @@
 
 import re
 from re import Match
-from typing import Callable, Optional
+from typing import Callable, Dict, List, Optional, Tuple
+from henango.http.cache import CachePolicy, cache_view
+from henango.http.ratelimit import RateLimit, rate_limit_view
 from henango.http.request import HTTPRequest
 from henango.http.response import HTTPResponse
 
 
+class Converter:
+  """
+  URLパターンの<type:name>の部分について、マッチさせる正規表現と値の変換方法を表すクラス
+  """
+  regex: str
+
+  def __init__(self, regex: str, to_python: Callable[[str], object] = str):
+    self.regex = regex
+    self.to_python = to_python
+
+
+# 型名とConverterの対応
+CONVERTERS: Dict[str, Converter] = {
+  "str": Converter(r"[^/]+"),
+  "int": Converter(r"[0-9]+", int),
+  "slug": Converter(r"[-a-zA-Z0-9_]+"),
+  # pathは/を含む残りのパス全体にマッチする
+  "path": Converter(r".+"),
+}
+
+# URLパターン中の<name>または<type:name>
+PARAMETER_PATTERN = re.compile(r"<(?:(?P<type>[a-z]+):)?(?P<name>\w+)>")
+
+
 class URLPattern:
   pattern: str
   view: Callable[[HTTPRequest], HTTPResponse]
+  methods: Optional[List[str]]
+  cache: Optional[CachePolicy]
+  rate_limit: Optional[RateLimit]
+  regex: re.Pattern
+  converters: Dict[str, Converter]
 
-  def __init__(self, pattern: str, view: Callable[[HTTPRequest], HTTPResponse]):
+  def __init__(
+    self,
+    pattern: str,
+    view: Callable[[HTTPRequest], HTTPResponse],
+    methods: List[str] = None,
+    cache: CachePolicy = None,
+    rate_limit: RateLimit = None,
+  ):
     self.pattern = pattern
-    self.view = view
+    # cacheを指定した場合は、GET/HEADのレスポンスをキャッシュする
+    self.view = cache_view(view, cache) if cache is not None else view
+    self.cache = cache
+    # rate_limitを指定した場合は、キャッシュを参照する前にクライアントごとの頻度を制限する
+    if rate_limit is not None:
+      self.view = rate_limit_view(self.view, pattern, rate_limit)
+    self.rate_limit = rate_limit
+    # Noneの場合は全てのメソッドを受け付ける
+    self.methods = [method.upper() for method in methods] if methods is not None else None
+
+    # URLパターンを正規表現パターンに変換し、一度だけコンパイルしておく
+    # ex) '/user/<int:user_id>/profile' => '/user/(?P<user_id>[0-9]+)/profile'
+    self.regex, self.converters = self.compile(pattern)
+
+  @staticmethod
+  def compile(pattern: str) -> Tuple[re.Pattern, Dict[str, Converter]]:
+    """
+    URLパターン（またはその一部）を、正規表現と各パラメータのConverterに変換する
+    """
+    converters = {}
+    regex = ""
+    position = 0
+    for match in PARAMETER_PATTERN.finditer(pattern):
+      converter_type = match.group("type") or "str"
+      if converter_type not in CONVERTERS:
+        raise ValueError(f"URLパターン {pattern} の型 {converter_type} には対応していません")
+
+      converter = CONVERTERS[converter_type]
+      converters[match.group("name")] = converter
+      regex += re.escape(pattern[position:match.start()])
+      regex += f"(?P<{match.group('name')}>{converter.regex})"
+      position = match.end()
+
+    regex += re.escape(pattern[position:])
+    return re.compile(regex + r"\Z"), converters
+
+  @property
+  def is_static(self) -> bool:
+    """
+    パラメータを含まないURLパターンかどうか
+    """
+    return not self.converters
+
+  def accepts(self, method: str) -> bool:
+    """
+    リクエストメソッドを受け付けるかどうか
+    GETを受け付ける場合は、HEADも受け付ける（ボディを送信しないGETとして扱う）
+    """
+    if self.methods is None or method in self.methods:
+      return True
+    return method == "HEAD" and "GET" in self.methods
 
   def match(self, path: str) -> Optional[Match]:
     """
     pathがURLパターンにマッチするか判定する
     マッチした場合はMatchオブジェクトを返し、マッチしなかった場合はNoneを返す
     """
-    # URLパターンを正規表現パターンに変換する
-    # ex) '/user/<user_id>/profile' => '/user/(?P<user_id>[^/]+)//profile'
-    pattern = re.sub(r"<(.+?)>", r"(?P<\1>[^/]+)", self.pattern)
-    return re.match(pattern,path)
+    return self.regex.match(path)
+
+  def convert(self, params: Dict[str, str]) -> dict:
+    """
+    マッチしたパラメータの文字列を、Converterに応じた型に変換する
+    """
+    return {name: self.converters[name].to_python(value) for name, value in params.items()}
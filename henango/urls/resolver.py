@@ -1,21 +1,27 @@
 from typing import Callable, Optional
+
+import settings
 from henango.http.request import HTTPRequest
 from henango.http.response import HTTPResponse
+from henango.urls.pattern import URLPattern
+from henango.urls.router import URLRouter
 from urls import url_patterns
+from henango.views.metrics import metrics
 from henango.views.static import static
 
+patterns = list(url_patterns)
+# 設定で有効になっていれば、メトリクスを返すURLを追加する
+if getattr(settings, "METRICS_ENABLED", True):
+  patterns.append(URLPattern(getattr(settings, "METRICS_PATH", "/metrics"), metrics, methods=["GET"]))
+
+# URLパターンは起動時に一度だけコンパイルし、全てのURLResolverで共有する
+router = URLRouter(patterns, fallback=static, cache_size=getattr(settings, "URL_RESOLVE_CACHE_SIZE", 1024))
+
 class URLResolver:
   def resolve(self, request: HTTPRequest) -> Optional[Callable[[HTTPRequest], HTTPResponse]]:
     """
     URL解決を行う
     pathにマッチするURLパターンが存在した場合は、対応するviewを返す
-    存在しなかった場合は、Noneを返す
+    存在しなかった場合は、静的ファイルを返すviewを返す
     """
-    for url_pattern in url_patterns:
-      match = url_pattern.match(request.path)
-      if match:
-        request.params.update(match.groupdict())
-        return url_pattern.view
-
-    else:
-      return static
+    return router.resolve(request)
@@ -0,0 +1,170 @@
+import re
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from henango.http.request import HTTPRequest
+from henango.http.response import HTTPResponse
+from henango.urls.pattern import URLPattern
+
+View = Callable[[HTTPRequest], HTTPResponse]
+
+
+class RouteNode:
+  """
+  URLパターンを/区切りのセグメントごとに格納する木（trie）のノード
+  """
+
+  def __init__(self):
+    # パラメータを含まないセグメントと子ノードの対応
+    self.static: Dict[str, "RouteNode"] = {}
+    # パラメータを含むセグメントの正規表現と子ノード
+    self.dynamic: List[Tuple[re.Pattern, "RouteNode"]] = []
+    # <path:name>のように、残りのパス全体にマッチするURLパターン
+    self.catch_all: List[URLPattern] = []
+    # このノードでちょうど終わるURLパターン
+    self.patterns: List[URLPattern] = []
+
+  def child(self, segment: str) -> "RouteNode":
+    """
+    セグメントに対応する子ノードを取得する（なければ生成する）
+    """
+    if "<" not in segment:
+      return self.static.setdefault(segment, RouteNode())
+
+    regex, _ = URLPattern.compile(segment)
+    for child_regex, child in self.dynamic:
+      if child_regex.pattern == regex.pattern:
+        return child
+    child = RouteNode()
+    self.dynamic.append((regex, child))
+    return child
+
+
+class URLRouter:
+  """
+  URLパターンを起動時に一度だけコンパイルし、pathから高速にviewを引けるようにしたクラス
+  - パラメータを含まないpathは辞書で完全一致を引く
+  - パラメータを含むpathはセグメントごとの木をたどる（pathの長さに比例する時間で済む）
+  - 解決結果は、最近使われたものをLRUキャッシュに残す
+  """
+
+  # 解決結果をキャッシュするpathの数
+  CACHE_SIZE = 1024
+  # どのURLパターンにもマッチしなかった場合に、request.routeに設定する値
+  FALLBACK_ROUTE = "<fallback>"
+
+  def __init__(self, url_patterns: Iterable[URLPattern], fallback: View, cache_size: int = CACHE_SIZE):
+    self.fallback = fallback
+    self.exact: Dict[str, List[URLPattern]] = {}
+    self.root = RouteNode()
+
+    for url_pattern in url_patterns:
+      self.add(url_pattern)
+
+    self.lookup = lru_cache(maxsize=cache_size)(self._lookup)
+
+  def add(self, url_pattern: URLPattern) -> None:
+    """
+    URLパターンを登録する
+    """
+    if url_pattern.is_static:
+      self.exact.setdefault(url_pattern.pattern, []).append(url_pattern)
+      return
+
+    node = self.root
+    segments = url_pattern.pattern.split("/")
+    for segment in segments:
+      if "<path:" in segment:
+        # 残りのパス全体にマッチするので、ここから先は正規表現でまとめて判定する
+        node.catch_all.append(url_pattern)
+        return
+      node = node.child(segment)
+    node.patterns.append(url_pattern)
+
+  def resolve(self, request: HTTPRequest) -> View:
+    """
+    URL解決を行う
+    pathにマッチするURLパターンが存在した場合は、対応するviewを返す
+    存在しなかった場合は、fallbackのviewを返す
+    """
+    view, params, route = self.lookup(request.method, request.path)
+    if params:
+      request.params.update(params)
+    request.route = route
+    return view
+
+  def _lookup(self, method: str, path: str) -> Tuple[View, dict, str]:
+    """
+    method, pathに対応する(view, パラメータ, マッチしたURLパターン)を返す
+    同じ引数に対しては同じ結果を返すので、LRUキャッシュできる
+    """
+    candidates = self.exact.get(path)
+    if candidates:
+      return self.select(candidates, method, {})
+
+    found = self.search(self.root, path.split("/"), 0, path)
+    if found is not None:
+      url_pattern_candidates, params = found
+      return self.select(url_pattern_candidates, method, params)
+
+    return self.fallback, {}, self.FALLBACK_ROUTE
+
+  def search(self, node: RouteNode, segments: List[str], index: int, path: str) -> Optional[Tuple[List[URLPattern], dict]]:
+    """
+    木をたどってpathにマッチするURLパターンを探す
+    パラメータを含まないセグメントを優先し、マッチしなければパラメータを含むセグメントを試す
+    """
+    if index == len(segments):
+      if node.patterns:
+        return node.patterns, {}
+      return None
+
+    segment = segments[index]
+
+    child = node.static.get(segment)
+    if child is not None:
+      found = self.search(child, segments, index + 1, path)
+      if found is not None:
+        return found
+
+    for regex, child in node.dynamic:
+      match = regex.match(segment)
+      if match is None:
+        continue
+      found = self.search(child, segments, index + 1, path)
+      if found is not None:
+        url_pattern_candidates, params = found
+        return url_pattern_candidates, {**match.groupdict(), **params}
+
+    for url_pattern in node.catch_all:
+      match = url_pattern.match(path)
+      if match:
+        return [url_pattern], match.groupdict()
+
+    return None
+
+  def select(self, candidates: List[URLPattern], method: str, params: dict) -> Tuple[View, dict, str]:
+    """
+    同じpathにマッチしたURLパターンの中から、methodを受け付けるものを選ぶ
+    どれも受け付けない場合は、405を返すviewを返す
+    """
+    for url_pattern in candidates:
+      if url_pattern.accepts(method):
+        return url_pattern.view, url_pattern.convert(params), url_pattern.pattern
+
+    methods = {m for url_pattern in candidates for m in url_pattern.methods}
+    # GETを受け付けるURLパターンは、HEADも受け付ける
+    if "GET" in methods:
+      methods.add("HEAD")
+    return method_not_allowed(sorted(methods)), {}, candidates[0].pattern
+
+
+def method_not_allowed(allowed_methods: List[str]) -> View:
+  """
+  405を返すviewを生成する
+  """
+  def view(request: HTTPRequest) -> HTTPResponse:
+    body = b"<html><body><h1>405 Method Not Allowed</h1></body></html>"
+    return HTTPResponse(body=body, status_code=405, headers={"Allow": ", ".join(allowed_methods)})
+
+  return view
@@ -0,0 +1,10 @@
+from henango.http.request import HTTPRequest
+from henango.http.response import HTTPResponse
+from henango.server.metrics import metrics as registry
+
+
+def metrics(request: HTTPRequest) -> HTTPResponse:
+  """
+  メトリクスをPrometheusのテキスト形式で返す
+  """
+  return HTTPResponse(body=registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
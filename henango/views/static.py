@@ -1,9 +1,148 @@
+import hashlib
 import os
-import traceback
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
 
 import settings
+from henango.http.compression import add_vary, choose_encoding, compress, is_compressible
+from henango.http.mime import guess_content_type
 from henango.http.request import HTTPRequest
-from henango.http.response import HTTPResponse
+from henango.http.response import FileResponse, HTTPResponse
+from henango.server.log import server_logger
+
+
+class StaticFile:
+  """
+  静的ファイルの内容と、キャッシュの検証に使う情報
+  大きなファイルの場合、内容（body）はメモリに読み込まずNoneとする
+  """
+  body: Optional[bytes]
+  mtime: float
+  size: int
+  etag: str
+  last_modified: str
+  # 圧縮方式と、圧縮した内容の対応
+  encoded: Dict[str, "StaticFile"]
+
+  def __init__(self, body: Optional[bytes], mtime: float, size: int):
+    self.body = body
+    self.mtime = mtime
+    self.size = size
+    self.encoded = {}
+    if body is not None:
+      # 内容から強いETagを生成する
+      self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+    else:
+      # 内容を読み込まないファイルは、更新日時とサイズからETagを生成する
+      self.etag = f'"{int(mtime * 1000000):x}-{size:x}"'
+    self.last_modified = format_datetime(datetime.fromtimestamp(int(mtime), timezone.utc), usegmt=True)
+
+  @property
+  def memory_size(self) -> int:
+    """
+    キャッシュとしてメモリを使っているバイト数
+    """
+    size = len(self.body) if self.body is not None else 0
+    return size + sum(encoded.memory_size for encoded in self.encoded.values())
+
+
+class StaticFileCache:
+  """
+  静的ファイルの内容をメモリに保持するLRUキャッシュ
+  合計サイズがmax_sizeを超えた場合は、最も長く使われていないファイルから捨てる
+  ファイルの更新日時が変わった場合は読み込み直す
+  """
+
+  def __init__(self, max_size: int, max_file_size: int):
+    self.max_size = max_size
+    self.max_file_size = max_file_size
+    self.files: "OrderedDict[str, StaticFile]" = OrderedDict()
+    self.size = 0
+    self.lock = Lock()
+
+  def get(self, path: str) -> StaticFile:
+    """
+    ファイルの内容を取得する
+    ファイルが存在しない場合はOSErrorを送出する
+    """
+    stat = os.stat(path)
+
+    with self.lock:
+      static_file = self.files.get(path)
+      if static_file is not None and static_file.mtime == stat.st_mtime and static_file.size == stat.st_size:
+        self.files.move_to_end(path)
+        return static_file
+
+    if stat.st_size > self.max_file_size:
+      # 大きなファイルはメモリに載せず、送信時にファイルから直接送る
+      return StaticFile(None, stat.st_mtime, stat.st_size)
+
+    with open(path, "rb") as f:
+      body = f.read()
+    static_file = StaticFile(body, stat.st_mtime, len(body))
+
+    self.put(path, static_file)
+    return static_file
+
+  def get_encoded(self, path: str, static_file: StaticFile, encoding: str) -> Optional[StaticFile]:
+    """
+    ファイルを圧縮した内容を取得する
+    gzipの場合は、事前に圧縮しておいた.gzファイルがあればそれを使う
+    なければ一度だけ圧縮してキャッシュしておく
+    圧縮しない方がよい場合はNoneを返す
+    """
+    if encoding == "gzip":
+      try:
+        precompressed = self.get(path + ".gz")
+        if precompressed.mtime >= static_file.mtime:
+          return precompressed
+      except OSError:
+        pass
+
+    if static_file.body is None or static_file.size < getattr(settings, "COMPRESSION_MIN_SIZE", 1024):
+      return None
+
+    encoded = static_file.encoded.get(encoding)
+    if encoded is None:
+      body = compress(static_file.body, encoding)
+      encoded = StaticFile(body, static_file.mtime, len(body))
+      with self.lock:
+        static_file.encoded[encoding] = encoded
+        if self.files.get(path) is static_file:
+          self.size += encoded.memory_size
+          self.evict()
+    return encoded
+
+  def put(self, path: str, static_file: StaticFile) -> None:
+    with self.lock:
+      old = self.files.pop(path, None)
+      if old is not None:
+        self.size -= old.memory_size
+
+      self.files[path] = static_file
+      self.size += static_file.memory_size
+      self.evict()
+
+  def evict(self) -> None:
+    """
+    合計サイズがmax_sizeに収まるまで、最も長く使われていないファイルを捨てる
+    lockを取得した状態で呼び出す
+    """
+    while self.size > self.max_size and self.files:
+      _, evicted = self.files.popitem(last=False)
+      self.size -= evicted.memory_size
+
+
+# 1つのリクエストで受け付けるRangeの数
+MAX_RANGES = 16
+
+cache = StaticFileCache(
+  max_size=getattr(settings, "STATIC_CACHE_MAX_SIZE", 64 * 1024 * 1024),
+  max_file_size=getattr(settings, "STATIC_CACHE_MAX_FILE_SIZE", 1024 * 1024),
+)
 
 
 def static(request: HTTPRequest) -> HTTPResponse:
@@ -12,22 +151,145 @@ def static(request: HTTPRequest) -> HTTPResponse:
   """
 
   try:
-    static_root = getattr(settings,"STATIC_ROOT")
+    static_root = os.path.realpath(getattr(settings,"STATIC_ROOT"))
 
     # pathの先頭の/を削除し、相対パスにしておく
     relative_path = request.path.lstrip("/")
     # ファイルのpathを取得
-    static_file_path = os.path.join(static_root, relative_path)
+    # ..やシンボリックリンクを解決した結果がSTATIC_ROOTの外を指す場合は、存在しないものとして扱う
+    static_file_path = os.path.realpath(os.path.join(static_root, relative_path))
+    if os.path.commonpath([static_root, static_file_path]) != static_root:
+      raise FileNotFoundError(static_file_path)
+
+    static_file = cache.get(static_file_path)
+    content_type = guess_content_type(static_file_path)
 
-    with open(static_file_path, "rb") as f:
-      response_body = f.read()
+    headers = {
+      "ETag": static_file.etag,
+      "Last-Modified": static_file.last_modified,
+      "Cache-Control": f"public, max-age={getattr(settings, 'STATIC_CACHE_MAX_AGE', 0)}",
+    }
 
-    content_type = None
-    return HTTPResponse(body=response_body,content_type=content_type,status_code=200)
+    # 圧縮できるファイルは、クライアントが対応していれば圧縮した内容を返す
+    # Rangeが指定されている場合は、圧縮していない内容の範囲を返す
+    encoded = None
+    if getattr(settings, "COMPRESSION_ENABLED", True) and is_compressible(content_type):
+      add_vary(headers, "Accept-Encoding")
+      encoding = choose_encoding(request.get_header("Accept-Encoding"))
+      if encoding is not None and request.get_header("Range") is None:
+        encoded = cache.get_encoded(static_file_path, static_file, encoding)
+      if encoded is not None:
+        headers["ETag"] = encoded.etag
+        headers["Content-Encoding"] = encoding
+
+    # ブラウザのキャッシュが最新であれば、ボディを送らずに304を返す
+    if is_not_modified(request, headers["ETag"], static_file):
+      return HTTPResponse(headers=headers, status_code=304, content_type=content_type)
+
+    if encoded is not None:
+      if encoded.body is None:
+        return FileResponse(static_file_path + ".gz", encoded.size, headers=headers, content_type=content_type)
+      return HTTPResponse(body=encoded.body, content_type=content_type, headers=headers)
+
+    headers["Accept-Ranges"] = "bytes"
+
+    # Rangeが指定されていれば、その範囲だけを返す
+    try:
+      ranges = parse_range(request, static_file)
+    except RangeNotSatisfiable:
+      headers["Content-Range"] = f"bytes */{static_file.size}"
+      return HTTPResponse(headers=headers, status_code=416)
+    if ranges is not None:
+      return FileResponse(static_file_path, static_file.size, ranges, status_code=206, headers=headers, content_type=content_type)
+
+    # メモリに載せていない大きなファイルは、sendfileで送る
+    if static_file.body is None:
+      return FileResponse(static_file_path, static_file.size, headers=headers, content_type=content_type)
+
+    return HTTPResponse(body=static_file.body,content_type=content_type,status_code=200,headers=headers)
 
   except OSError:
     # レスポンスを取得できなかった場合は、ログを出力して404を返す
-    traceback.print_exc()
+    server_logger.debug("静的ファイルを取得できませんでした path: %s", request.path, exc_info=True)
 
     response_body = b"<html><body><h1>404 Not Found</h1></body></html>"
     return HTTPResponse(body=response_body, status_code=404)
+
+
+def is_not_modified(request: HTTPRequest, etag: str, static_file: StaticFile) -> bool:
+  """
+  条件付きリクエスト（If-None-Match / If-Modified-Since）について、
+  クライアントが持っているキャッシュが最新かどうかを判定する
+  etagには、これから返す内容（圧縮した場合は圧縮後）のETagを渡す
+  """
+  # If-None-Matchがある場合は、If-Modified-Sinceより優先する
+  if_none_match = request.get_header("If-None-Match")
+  if if_none_match is not None:
+    if if_none_match.strip() == "*":
+      return True
+    # 弱いETag（W/"..."）も比較の対象とする
+    etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+    return etag in etags
+
+  if_modified_since = request.get_header("If-Modified-Since")
+  if if_modified_since is not None:
+    modified_since = parse_http_date(if_modified_since)
+    return modified_since is not None and int(static_file.mtime) <= modified_since.timestamp()
+
+  return False
+
+
+class RangeNotSatisfiable(Exception):
+  pass
+
+
+def parse_range(request: HTTPRequest, static_file: StaticFile) -> Optional[List[Tuple[int, int]]]:
+  """
+  Rangeヘッダーをパースし、(開始位置, 終了位置)のリストを返す（終了位置は含まない）
+  Rangeを無視してファイル全体を返すべき場合はNoneを返す
+  どの範囲もファイルに含まれない場合はRangeNotSatisfiableを送出する
+  """
+  range_header = request.get_header("Range")
+  if range_header is None or not range_header.startswith("bytes="):
+    return None
+
+  # If-Rangeがあり、ファイルが更新されている場合はファイル全体を返す
+  if_range = request.get_header("If-Range")
+  if if_range is not None and if_range != static_file.etag and if_range != static_file.last_modified:
+    return None
+
+  ranges = []
+  for spec in range_header[len("bytes="):].split(","):
+    start, _, end = spec.strip().partition("-")
+    try:
+      if start:
+        # ex) "100-199", "100-"
+        start = int(start)
+        end = min(int(end) + 1, static_file.size) if end else static_file.size
+      else:
+        # ex) "-500" => 最後の500バイト
+        start = max(static_file.size - int(end), 0)
+        end = static_file.size
+    except ValueError:
+      # 形式が不正なRangeは無視する
+      return None
+    if start < end:
+      ranges.append((start, end))
+
+  if not ranges:
+    raise RangeNotSatisfiable()
+  if len(ranges) > MAX_RANGES:
+    # 範囲の数が多すぎる場合は、細切れの送信を避けてファイル全体を返す
+    return None
+  return ranges
+
+
+def parse_http_date(value: str) -> Optional[datetime]:
+  """
+  HTTPの日付形式の文字列をdatetimeに変換する
+  変換できない場合はNoneを返す
+  """
+  try:
+    return parsedate_to_datetime(value)
+  except (TypeError, ValueError):
+    return None
@@ -7,3 +7,203 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 STATIC_ROOT = os.path.join(BASE_DIR,"static")
 
 TEMPLATES_DIR = os.path.join(BASE_DIR,"templates")
+
+# keep-aliveでコネクションを維持する秒数（この間リクエストがなければ切断する）
+KEEP_ALIVE_TIMEOUT = 5
+
+# リクエストを受信し始めてから（コネクションの最初のリクエストは接続してから）、
+# リクエストライン+ヘッダーを受信しきるまでの秒数（超えた場合は408を返して切断する）
+REQUEST_HEADER_TIMEOUT = 10
+
+# viewがリクエストボディを受信し始めてから、受信しきるまでの秒数（超えた場合は408を返して切断する）
+# 少しずつ送り続けるクライアントも切断できるよう、データが届くたびに延ばさない
+REQUEST_BODY_TIMEOUT = 30
+
+# レスポンスを送信し始めてから、送信しきるまでの秒数（超えた場合は切断する）
+SEND_TIMEOUT = 30
+
+# 1つのコネクションで処理するリクエストの最大数
+KEEP_ALIVE_MAX_REQUESTS = 100
+
+# クライアントを処理するWorkerスレッドの数
+WORKER_POOL_SIZE = 16
+
+# Workerの処理待ちにしておける接続の数
+WORKER_QUEUE_SIZE = 64
+
+# 処理待ちのキューが一杯の場合の動作
+# "reject": すぐに503を返して切断する / "block": 空きができるまでacceptを止める
+WORKER_QUEUE_FULL_POLICY = "reject"
+
+# listenのbacklog（OSが溜めておく、accept前の接続の数）
+LISTEN_BACKLOG = 128
+
+# asyncioエンジンで、同期的なviewを実行するスレッドの数
+ASYNC_EXECUTOR_WORKERS = 16
+
+# preforkモードで起動する子プロセスの数（Noneの場合はCPUコア数）
+PREFORK_PROCESSES = None
+
+# Trueの場合、子プロセスごとにSO_REUSEPORTでsocketを生成する
+# Falseの場合、親プロセスで生成したsocketを子プロセスに引き継ぐ
+PREFORK_REUSE_PORT = False
+
+# preforkモードで停止する際に、子プロセスの終了を待つ秒数（過ぎたらSIGKILLで強制終了する）
+# 子プロセスが処理中のリクエストを終えられるよう、SHUTDOWN_TIMEOUTより長くすること
+PREFORK_SHUTDOWN_TIMEOUT = 15
+
+# Trueの場合、親プロセスでテンプレートのコンパイルなど（STARTUP_WARM_UP）を済ませてから子プロセスをforkする
+# 子プロセスはキャッシュが温まった状態で処理を始め、親プロセスとメモリを共有する
+PREFORK_PRELOAD = True
+
+# preforkモードで、異常終了した子プロセスを起動し直すまでの間隔の上限（秒）
+# 続けて異常終了するたびに0.1秒から倍々に延ばし、この値で頭打ちにする
+PREFORK_RESPAWN_MAX_DELAY = 30
+
+# preforkモードで、子プロセスの異常終了が1分間にこの回数を超えたら、起動し直すのをやめてサーバを停止する
+PREFORK_MAX_CRASHES_PER_MINUTE = 20
+
+# SIGTERMで停止する際に、処理中のリクエストの完了を待つ秒数
+SHUTDOWN_TIMEOUT = 10
+
+# リクエストライン+リクエストヘッダーの最大サイズ（超えた場合は431を返す）
+MAX_REQUEST_HEADER_SIZE = 16 * 1024
+
+# リクエストボディの最大サイズ（超えた場合は413を返す）
+MAX_REQUEST_BODY_SIZE = 10 * 1024 * 1024
+
+# multipart/form-dataでアップロードされたファイルを、メモリ上に置いておく最大サイズ（超えたら一時ファイルに書き込む）
+MULTIPART_SPOOL_THRESHOLD = 1024 * 1024
+
+# multipart/form-dataの、ファイル以外のフィールド1つあたりの最大サイズ（超えた場合は413を返す）
+MULTIPART_MAX_FIELD_SIZE = 1024 * 1024
+
+# multipart/form-dataの、ファイル1つあたりの最大サイズ（Noneの場合はMAX_REQUEST_BODY_SIZEだけで制限する）
+MULTIPART_MAX_FILE_SIZE = None
+
+# multipart/form-dataの、パートの最大数（超えた場合は413を返す）
+MULTIPART_MAX_PARTS = 1000
+
+# アップロードされたファイルを書き込む一時ファイルのディレクトリ（Noneの場合はOSのデフォルト）
+FILE_UPLOAD_TEMP_DIR = None
+
+# URL解決の結果をキャッシュするpathの数
+URL_RESOLVE_CACHE_SIZE = 1024
+
+# 静的ファイルをメモリにキャッシュする合計サイズの上限（バイト）
+STATIC_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+# メモリにキャッシュする静的ファイル1つあたりのサイズの上限（バイト）
+STATIC_CACHE_MAX_FILE_SIZE = 1024 * 1024
+
+# 静的ファイルのCache-Controlに指定するmax-age（秒）
+STATIC_CACHE_MAX_AGE = 3600
+
+# Trueの場合、テンプレートファイルが更新されていればコンパイルし直す（開発用）
+TEMPLATES_AUTO_RELOAD = False
+
+# Trueの場合、リクエストを受け付ける前に全てのテンプレートをコンパイルし、
+# viewが参照しているテンプレートが存在するかを確認する（問題があれば起動しない）
+STARTUP_WARM_UP = True
+
+# Accept-Encodingに応じてレスポンスを圧縮するかどうか
+COMPRESSION_ENABLED = True
+
+# 圧縮するレスポンスボディの最小サイズ（バイト）
+COMPRESSION_MIN_SIZE = 1024
+
+# 圧縮レベル（1〜9）
+COMPRESSION_LEVEL = 6
+
+# 受信したリクエストを記録するかどうか
+REQUEST_CAPTURE_ENABLED = False
+
+# リクエストを記録するファイル（1行に1リクエストのJSON）
+REQUEST_CAPTURE_FILE = os.path.join(BASE_DIR, "captured_requests.jsonl")
+
+# リクエストを記録する割合（0.0〜1.0）
+REQUEST_CAPTURE_SAMPLE_RATE = 1.0
+
+# ファイルへの書き込み待ちにしておける記録の数（超えた場合は古いものから捨てる）
+REQUEST_CAPTURE_BUFFER_SIZE = 1024
+
+# /recent_requests に表示するリクエストの数
+REQUEST_CAPTURE_RECENT_SIZE = 20
+
+# 記録ファイルを切り替えるサイズ（バイト）と、残しておく古いファイルの数
+REQUEST_CAPTURE_MAX_BYTES = 10 * 1024 * 1024
+REQUEST_CAPTURE_BACKUP_COUNT = 3
+
+# サーバのログのレベル（DEBUG / INFO / WARNING / ERROR）
+LOG_LEVEL = "INFO"
+
+# アクセスログを出力するかどうか
+ACCESS_LOG_ENABLED = True
+
+# アクセスログの形式（"combined" / "json"）
+ACCESS_LOG_FORMAT = "combined"
+
+# アクセスログの出力先のファイル（Noneの場合は標準出力）
+ACCESS_LOG_FILE = None
+
+# メトリクスを返すURLを有効にするかどうか
+METRICS_ENABLED = True
+
+# メトリクスを返すURL
+METRICS_PATH = "/metrics"
+
+# セッションを保存するストア（"memory": プロセスのメモリ / "sqlite": ファイル。再起動しても残り、prefork時も共有される）
+# "memory"はプロセスごとにセッションが分かれるので、preforkモード（2プロセス以上）では"sqlite"にすること（"memory"では起動しない）
+SESSION_BACKEND = "memory"
+
+# SESSION_BACKENDが"sqlite"の場合に使うファイル
+SESSION_FILE = os.path.join(BASE_DIR, "sessions.sqlite3")
+
+# SESSION_BACKENDが"memory"の場合に保持するセッションの最大数（超えたら最も使われていないものから捨てる）
+SESSION_MAX_ENTRIES = 10000
+
+# セッションの有効期限（秒）
+SESSION_TTL = 14 * 24 * 60 * 60
+
+# セッションIDを保存するCookieの名前
+SESSION_COOKIE_NAME = "sessionid"
+
+# セッションIDの署名に使う鍵
+# Noneの場合は、SESSION_BACKENDが"memory"ならプロセスごとに生成し、"sqlite"なら初回に生成してSECRET_KEY_FILEに保存したものを使う
+SECRET_KEY = None
+
+# SECRET_KEYがNoneの場合に、生成した鍵を保存するファイル
+SECRET_KEY_FILE = os.path.join(BASE_DIR, ".secret_key")
+
+# レスポンスキャッシュ（URLPatternのcacheで有効にする）に使うメモリの上限（バイト）
+RESPONSE_CACHE_MAX_SIZE = 16 * 1024 * 1024
+
+# キャッシュの無いリクエストが同時に来た場合に、先にviewを実行しているリクエストを待つ時間の上限（秒）
+RESPONSE_CACHE_WAIT_TIMEOUT = 10
+
+# クライアント(IPアドレス)ごとの同時接続数の上限（Noneの場合は制限しない）
+# 1つのクライアントが全てのWorkerを使い切らないよう、WORKER_POOL_SIZEより小さくすること
+# 超えた接続には、acceptした時点で429を返して切断する
+MAX_CONNECTIONS_PER_CLIENT = WORKER_POOL_SIZE // 4
+
+# クライアントごとに、1秒あたりに受け付けるリクエストの数（Noneの場合は制限しない）
+# 超えたリクエストには、パースする前に429を返して切断する
+# URLPatternごとの制限は、URLPatternのrate_limitで指定する
+RATE_LIMIT_PER_CLIENT = None
+
+# クライアントごとに、一時的に受け付けるリクエストの数（Noneの場合はRATE_LIMIT_PER_CLIENTと同じ）
+RATE_LIMIT_BURST_PER_CLIENT = None
+
+# 頻度の上限を判定するために記録しておくクライアントの最大数（超えたら最も使われていないものから捨てる）
+RATE_LIMIT_MAX_ENTRIES = 100000
+
+# MAX_CONNECTIONS_PER_CLIENTとRATE_LIMIT_PER_CLIENTを適用しないクライアント(IPアドレス)
+# 同じホストで動くリバースプロキシやベンチマークからの接続は、全てのクライアントが同じIPアドレスになるため
+ADMISSION_EXEMPT_CLIENTS = ["127.0.0.1", "::1"]
+
+# URL解決〜viewの呼び出しをラップするmiddleware（先に書いたものほど外側で実行される）
+MIDDLEWARE = [
+  "henango.server.middleware.ExceptionMiddleware",
+  "henango.server.middleware.SessionMiddleware",
+  "henango.server.middleware.CompressionMiddleware",
+]
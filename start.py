@@ -1,4 +1,22 @@
+# 起動にかかった時間を計測するため、他のモジュールより先に読み込む
+import henango.server.startup
+import argparse
+
 from henango.server.server import Server
 
 if __name__ == '__main__':
-  Server().serve()
+  parser = argparse.ArgumentParser()
+  # thread: スレッドプールで処理する / asyncio: イベントループで処理する
+  parser.add_argument("--engine", choices=["thread", "asyncio"], default="thread")
+  # 指定した場合は、その数の子プロセスを起動してリクエストを処理する（0の場合はCPUコア数）
+  parser.add_argument("--processes", type=int, default=None)
+  args = parser.parse_args()
+
+  if args.processes is not None:
+    from henango.server.prefork import PreforkServer
+    PreforkServer(args.engine, args.processes or None).serve()
+  elif args.engine == "asyncio":
+    from henango.server.async_server import AsyncServer
+    AsyncServer().serve()
+  else:
+    Server().serve()
@@ -1,11 +1,15 @@
-import os
+import time
 
 import settings
+from henango.server.metrics import metrics
+from henango.template.engine import TemplateEngine
 
-def render(template_name: str, context: dict) -> str:
-  template_path = os.path.join(settings.TEMPLATES_DIR, template_name)
-
-  with open(template_path) as f:
-    template = f.read()
+# テンプレートはコンパイル結果をキャッシュして使い回す
+engine = TemplateEngine(settings.TEMPLATES_DIR, auto_reload=getattr(settings, "TEMPLATES_AUTO_RELOAD", False))
 
-  return template.format(**context)
+def render(template_name: str, context: dict) -> str:
+  started = time.perf_counter()
+  try:
+    return engine.render(template_name, context)
+  finally:
+    metrics.observe("henango_render_duration_seconds", (("template", template_name),), time.perf_counter() - started)
@@ -1,13 +1,17 @@
 import views
+from henango.http.cache import CachePolicy
 from henango.urls.pattern import URLPattern
 
 # pathとview関数の対応
-url_patterns = {
+# 同じpathにマッチする場合は、先に書いたものが優先される
+url_patterns = [
     URLPattern("/now", views.now),
     URLPattern("/show_request", views.show_request),
+    URLPattern("/recent_requests", views.recent_requests),
     URLPattern("/parameters", views.parameters),
-    URLPattern("/user/<user_id>/profile", views.user_profile),
+    URLPattern("/user/<int:user_id>/profile", views.user_profile, cache=CachePolicy(ttl=60)),
     URLPattern("/set_cookie", views.set_cookie),
-    URLPattern("/login", views.login),
+    URLPattern("/login", views.login, methods=["GET", "POST"], cache=CachePolicy(ttl=300)),
     URLPattern("/welcome", views.welcome),
-}
+    URLPattern("/echo", views.echo, methods=["POST"]),
+]
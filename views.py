@@ -1,14 +1,11 @@
 
-import textwrap
-import urllib.parse
 from datetime import datetime
-from pprint import pformat
 from typing import Optional, Tuple
 
 from henango.http.request import HTTPRequest
 from henango.http.response import HTTPResponse
 from templates.renderer import render
-from henango.http.cookie import Cookie
+from henango.server.capture import request_capture
 
 """
 切り出す先のモジュールの名前は、viewsとします。
@@ -31,24 +28,42 @@ def show_request(
   """
   HTTPリクエストの内容を表示するHTMLを生成する
   """
-  context = {"request":request,"headers":pformat(request.headers),"body":request.body.decode("utf-8", "ignore")}
+  context = {"request":request,"headers":request.headers,"body":request.body.decode("utf-8", "ignore")}
   body = render("show_request.html", context)
 
   return HTTPResponse(body=body)
 
+def recent_requests(
+  request:HTTPRequest
+) -> HTTPResponse:
+  """
+  直近に受信したリクエストの一覧を表示するHTMLを生成する
+  """
+  if request_capture is None:
+    entries = None
+  else:
+    entries = [
+      {"time": datetime.fromtimestamp(entry["time"]), "client": entry["client"], "request": entry["request"]}
+      for entry in request_capture.recent_requests()
+    ]
+  body = render("recent_requests.html", {"entries": entries})
+
+  return HTTPResponse(body=body)
+
 def parameters(
   request:HTTPRequest
 ) -> HTTPResponse:
   """
   POSTパラメータを表示するHTMLを表示する
   """
-  if request.method == "GET":
+  if request.method in ("GET", "HEAD"):
     body = b"<html><body><h1>405 Method Not Allowed</h1></body></html>"
 
     return HTTPResponse(body=body,status_code=405)
   elif request.method == "POST":
-    post_params = urllib.parse.parse_qs(request.body.decode())
-    context = {"post_params": post_params}
+    # ボディ全体をメモリに載せないよう、ストリームから少しずつパースされる
+    post_params = request.POST
+    context = {"post_params": post_params, "files": request.FILES}
     body = render("params.html", context)
 
     return HTTPResponse(body=body)
@@ -60,39 +75,44 @@ def user_profile(request: HTTPRequest) -> HTTPResponse:
 
   return HTTPResponse(body=body)
 
+def echo(request: HTTPRequest) -> HTTPResponse:
+  """
+  リクエストボディを、受信した分から順にそのまま返す
+  ボディ全体をメモリに読み込まないので、大きなボディでも使うメモリは一定
+  """
+  return HTTPResponse(body=iter(request.stream), content_type="application/octet-stream")
+
 def set_cookie(request: HTTPRequest) -> HTTPResponse:
   return HTTPResponse(cookies={"username": "TARO"})
 
 def login(request: HTTPRequest) -> HTTPResponse:
-  if request.method == "GET":
+  if request.method in ("GET", "HEAD"):
     body = render("login.html", {})
     return HTTPResponse(body=body)
 
   elif request.method == "POST":
-    post_params = urllib.parse.parse_qs(request.body.decode())
+    post_params = request.POST
     username = post_params["username"][0]
     email = post_params["email"][0]
 
-    cookies = [
-      Cookie(name="username", value=username, max_age=30),
-      Cookie(name="email", value=email, max_age=30),
-    ]
+    # ログインの前後でセッションIDを変える
+    request.session.cycle_key()
+    request.session["username"] = username
+    request.session["email"] = email
 
-    return HTTPResponse(
-      status_code=302, headers={"Location": "/welcome"}, cookies=cookies
-    )
+    return HTTPResponse(status_code=302, headers={"Location": "/welcome"})
 
 def welcome(request: HTTPRequest) -> HTTPResponse:
-  # Cookieにusernameが含まれていなければ、ログインしていないとみなして/loginへリダイレクト
-  if "username" not in request.cookies:
+  # セッションにusernameが含まれていなければ、ログインしていないとみなして/loginへリダイレクト
+  if "username" not in request.session:
     return HTTPResponse(status_code=302, headers={"Location": "/login"})
 
-  if "email" not in request.cookies:
+  if "email" not in request.session:
     return HTTPResponse(status_code=302, headers={"Location": "/login"})
 
   # Welcome画面を表示
-  username = request.cookies["username"]
-  email = request.cookies["email"]
+  username = request.session["username"]
+  email = request.session["email"]
   body = render("welcome.html", context={"username": username,"email": email})
 
   return HTTPResponse(body=body)